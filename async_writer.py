@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections.abc import Iterable
+
+import aiohttp
+from influxdb_client import InfluxDBClient, WriteOptions
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+from influxdb_client.rest import ApiException
+
+from config import config
+from metrics import WRITE_RECORDS, WRITE_RETRIES
+
+# asyncio write stage for InfluxDB with a bounded queue of pending batches
+# the producers (parsers) are blocked while the queue is full
+
+logger = logging.getLogger("chmi.async_writer")
+
+# the synchronous batching write API of the influxdb-client is used when disabled
+ASYNC_WRITE = config.getboolean("influxdb", "async_write", fallback=True)
+BATCH_SIZE = config.getint("influxdb", "batch_size", fallback=5000)
+# a partial batch is sent after this time (seconds)
+FLUSH_INTERVAL = config.getfloat("influxdb", "flush_interval", fallback=1.0)
+# number of batches being written at the same time
+WRITE_CONCURRENCY = config.getint("influxdb", "write_concurrency", fallback=4)
+# number of batches waiting to be written before the producers are blocked
+QUEUE_SIZE = config.getint("influxdb", "queue_size", fallback=2 * WRITE_CONCURRENCY)
+MAX_RETRIES = config.getint("influxdb", "max_retries", fallback=5)
+# the retry delays grow exponentially from the interval up to the maximum (seconds)
+RETRY_INTERVAL = config.getfloat("influxdb", "retry_interval", fallback=1.0)
+MAX_RETRY_DELAY = config.getfloat("influxdb", "max_retry_delay", fallback=30.0)
+TIMEOUT = config.getfloat("influxdb", "timeout", fallback=30.0)
+# responses of an overloaded InfluxDB, the batch is written again later
+RETRY_STATUSES = (429, 503)
+
+
+class WriteError(Exception):
+    pass
+
+
+def retry_delay(attempt: int, retry_after: str | None = None) -> float:
+    """Get the delay before a retry, the server can request a longer one."""
+    delay = min(MAX_RETRY_DELAY, RETRY_INTERVAL * 2**attempt)
+    # full jitter, the writers do not retry all at once
+    delay = random.uniform(0, delay)
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return delay
+
+
+class AsyncWriteStage:
+    """Write API running the asynchronous InfluxDB client in its own thread.
+
+    It has the write and close methods of the synchronous write API, so it can
+    be used by the writers the same way. The records are collected into batches,
+    the full batches are put into a bounded queue and written by concurrent
+    tasks. The write blocks while the queue is full.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: str,
+        org: str,
+        batch_size: int = BATCH_SIZE,
+        flush_interval: float = FLUSH_INTERVAL,
+        concurrency: int = WRITE_CONCURRENCY,
+        queue_size: int = QUEUE_SIZE,
+        max_retries: int = MAX_RETRIES,
+    ) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        # (bucket, precision) -> records of the partial batch
+        self._buffers = {}
+        self._buffered_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.stats = {
+            "batches": 0,
+            "records": 0,
+            "retries": 0,
+            "failed_batches": 0,
+            "failed_records": 0,
+            # time the producers were blocked by a full queue (seconds)
+            "blocked_s": 0.0,
+            "max_queue_depth": 0,
+        }
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="influx-writer", daemon=True
+        )
+        self._thread.start()
+        self._call(self._start(url, token, org, concurrency, queue_size))
+
+    def _call(self, coroutine):
+        """Run a coroutine in the event loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _start(
+        self, url: str, token: str, org: str, concurrency: int, queue_size: int
+    ) -> None:
+        # the client session must be created in the event loop
+        self._client = InfluxDBClientAsync(
+            url=url, token=token, org=org, timeout=int(TIMEOUT * 1000)
+        )
+        self._write_api = self._client.write_api()
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(concurrency)
+        ]
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    async def _worker(self) -> None:
+        while True:
+            key, records = await self._queue.get()
+            try:
+                await self._write_batch(key, records)
+            except Exception as e:
+                # the worker must keep running, the batch is reported as failed
+                logger.error(f"Failed to write a batch: {e!r}", exc_info=True)
+                self.stats["failed_batches"] += 1
+                self.stats["failed_records"] += len(records)
+                WRITE_RECORDS.inc(len(records), status="failed")
+            finally:
+                self._queue.task_done()
+
+    async def _write_batch(self, key: tuple[str, str], records: list) -> None:
+        bucket, precision = key
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._write_api.write(
+                    bucket=bucket, record=records, write_precision=precision
+                )
+                self.stats["batches"] += 1
+                self.stats["records"] += len(records)
+                WRITE_RECORDS.inc(len(records), status="ok")
+                return
+            except ApiException as e:
+                if e.status not in RETRY_STATUSES:
+                    logger.error(f"Failed to write a batch: {e.status} {e.reason}")
+                    break
+                retry_after = e.headers.get("Retry-After") if e.headers else None
+                delay = retry_delay(attempt, retry_after)
+            except (aiohttp.ClientError, OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Failed to connect to InfluxDB: {e!r}")
+                delay = retry_delay(attempt)
+            if attempt < self.max_retries:
+                self.stats["retries"] += 1
+                WRITE_RETRIES.inc()
+                logger.warning(f"Retrying a batch in {delay:.1f} s...")
+                await asyncio.sleep(delay)
+        self.stats["failed_batches"] += 1
+        self.stats["failed_records"] += len(records)
+        WRITE_RECORDS.inc(len(records), status="failed")
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval / 2)
+            if time.monotonic() - self._buffered_at >= self.flush_interval:
+                for batch in self._take_buffers():
+                    await self._queue.put(batch)
+
+    def _take_buffers(self, full_only: bool = False) -> list[tuple[tuple, list]]:
+        """Cut the buffered records into batches."""
+        batches = []
+        with self._lock:
+            for key, records in self._buffers.items():
+                end = len(records)
+                if full_only:
+                    end -= end % self.batch_size
+                for i in range(0, end, self.batch_size):
+                    batches.append((key, records[i : i + self.batch_size]))
+                self._buffers[key] = records[end:]
+            self._buffered_at = time.monotonic()
+        return batches
+
+    def _put(self, batches: list[tuple[tuple, list]]) -> None:
+        started = time.monotonic()
+        for batch in batches:
+            self._call(self._queue.put(batch))
+        self.stats["blocked_s"] += time.monotonic() - started
+        self.stats["max_queue_depth"] = max(
+            self.stats["max_queue_depth"], self._queue.qsize()
+        )
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def write(
+        self, bucket: str, record: Iterable | object, write_precision: str = "ns", **_
+    ) -> None:
+        """Add records to the batches, blocks while the queue of batches is full."""
+        if self._closed:
+            raise WriteError("The write stage is closed.")
+        if isinstance(record, (list, tuple)):
+            records = list(record)
+        else:
+            records = [record]
+        key = (bucket, str(write_precision))
+        with self._lock:
+            buffer = self._buffers.setdefault(key, [])
+            buffer.extend(records)
+            full = len(buffer) >= self.batch_size
+        if full:
+            self._put(self._take_buffers(full_only=True))
+
+    def flush(self) -> None:
+        """Write all the buffered records and wait until they are written."""
+        self._put(self._take_buffers())
+        self._call(self._queue.join())
+
+    def close(self) -> None:
+        """Flush the records and stop the write stage.
+
+        Raises:
+            WriteError: If some batches could not be written.
+        """
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._call(self._stop())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+        logger.info(
+            f"Written {self.stats['records']} records in {self.stats['batches']} "
+            f"batches, {self.stats['retries']} retries, producers blocked for "
+            f"{self.stats['blocked_s']:.1f} s."
+        )
+        if self.stats["failed_batches"]:
+            raise WriteError(
+                f"Failed to write {self.stats['failed_records']} records in "
+                f"{self.stats['failed_batches']} batches."
+            )
+
+    async def _stop(self) -> None:
+        for task in (*self._workers, self._flusher):
+            task.cancel()
+        await asyncio.gather(*self._workers, self._flusher, return_exceptions=True)
+        await self._client.close()
+
+
+def failed_records() -> float:
+    """Get the number of records the write APIs of the process failed to write.
+
+    The batching write API of the influxdb-client only reports the failed
+    batches to its callbacks and its close() does not raise, so the writers
+    compare this count before and after a job.
+    """
+    return WRITE_RECORDS.value(status="failed")
+
+
+def check_written(failed_before: float) -> None:
+    """Raise if some records failed to be written since the count was taken.
+
+    Raises:
+        WriteError: If the number of failed records went up.
+    """
+    failed = failed_records() - failed_before
+    if failed:
+        raise WriteError(f"Failed to write {failed:.0f} records.")
+
+
+def create_write_api(client: InfluxDBClient):
+    """Create the write API used by the writers.
+
+    Args:
+        client (InfluxDBClient): Client with the connection settings.
+
+    Returns:
+        AsyncWriteStage | WriteApi: Write API, it must be closed to flush the data.
+    """
+    if ASYNC_WRITE:
+        return AsyncWriteStage(client.url, client.token, client.org)
+    # the callbacks get the batches of the batching write API
+    return client.write_api(
+        write_options=WriteOptions(
+            batch_size=BATCH_SIZE, flush_interval=int(FLUSH_INTERVAL * 1000)
+        ),
+        success_callback=lambda conf, data: WRITE_RECORDS.inc(
+            _count_records(data), status="ok"
+        ),
+        error_callback=lambda conf, data, e: WRITE_RECORDS.inc(
+            _count_records(data), status="failed"
+        ),
+        retry_callback=lambda conf, data, e: WRITE_RETRIES.inc(),
+    )
+
+
+def _count_records(data: str | bytes) -> int:
+    """Count the line protocol records of a batch."""
+    if isinstance(data, str):
+        data = data.encode()
+    return data.count(b"\n") + 1 if data else 0
@@ -0,0 +1,370 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from influxdb_client import InfluxDBClient
+
+from async_writer import check_written, create_write_api, failed_records
+from config import config
+from downloader import iter_downloads
+from influx_writer_last_month import get_data_files, write_month_files
+from scheduler import WorkerUtilization, size_balanced_shards
+
+# backfill of the CHMI history, the station files of all the months and
+# measurement folders are sharded by their size across a pool of worker processes
+
+# logging setup
+logger = logging.getLogger("backfill_logger")
+logger.setLevel(logging.INFO)
+file_handler = logging.FileHandler("backfill.log")
+file_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(processName)s - %(levelname)s - %(message)s")
+)
+logger.addHandler(file_handler)
+
+# measurement folder -> (file prefix, single measurement to write)
+MEASUREMENT_FOLDERS = {
+    "10min": ("10m", None),
+    "1h": ("1h", None),
+    # only the daily rainfall is written, like in the monthly job
+    "daily": ("dly", "SRA"),
+}
+# every worker gets about this many shards of the same size, the shards are
+# taken by the free workers from the largest, so the last ones are the smallest
+SHARDS_PER_WORKER = 4
+
+
+class RateLimiter:
+    """Token bucket limiting the number of written values per second.
+
+    The state lives in shared memory, so the limit is global for all workers.
+    """
+
+    def __init__(self, rate: float, context=multiprocessing) -> None:
+        self.rate = rate
+        self._tokens = context.Value("d", rate, lock=False)
+        self._updated = context.Value("d", time.time(), lock=False)
+        self._lock = context.Lock()
+
+    def acquire(self, n: int) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens.value = min(
+                    self.rate,
+                    self._tokens.value + (now - self._updated.value) * self.rate,
+                )
+                self._updated.value = now
+                # a large batch may overdraw the bucket, the next batches wait longer
+                if self._tokens.value > 0:
+                    self._tokens.value -= n
+                    return
+                wait_time = -self._tokens.value / self.rate
+            time.sleep(min(wait_time, 1.0))
+
+
+class RateLimitedWriteAPI:
+    def __init__(self, write_api, rate_limiter: RateLimiter) -> None:
+        self.write_api = write_api
+        self.rate_limiter = rate_limiter
+
+    def write(self, bucket: str, record, **kwargs) -> None:
+        self.rate_limiter.acquire(len(record) if isinstance(record, list) else 1)
+        self.write_api.write(bucket=bucket, record=record, **kwargs)
+
+
+_client = None
+_rate_limiter = None
+
+
+def init_worker(rate_limiter: RateLimiter) -> None:
+    """Create the InfluxDB client of the worker process."""
+    global _client, _rate_limiter
+    _client = InfluxDBClient(
+        url=config.get("influxdb", "url"),
+        token=config.get("influxdb", "token"),
+        org=config.get("influxdb", "org"),
+    )
+    _rate_limiter = rate_limiter
+
+
+def read_files(paths: list[str]) -> Iterator[tuple[str, bytes]]:
+    for path in paths:
+        with open(path, "rb") as file:
+            yield path, file.read()
+
+
+def track_sources(
+    data_files: Iterable[tuple[str, bytes]], sources: list[str]
+) -> Iterator[tuple[str, bytes]]:
+    """Add the source of every file to the list as the file is passed on."""
+    for source, content in data_files:
+        sources.append(source)
+        yield source, content
+
+
+def write_shard(
+    measurement_folder: str, year: int, month: int, sources: list[str], remote: bool
+) -> tuple[int, list[str], str, float]:
+    """Write a shard of station files of a single month in a worker process.
+
+    The files that failed to download are skipped by the downloader, they are
+    not among the written sources and are written again by a resumed backfill.
+
+    Returns:
+        tuple[int, list[str], str, float]: Number of written values, the written
+            sources, name of the worker process and the time it spent on the shard.
+
+    Raises:
+        WriteError: If some records of the shard were not written.
+    """
+    started = time.perf_counter()
+    measurement_type, measurement = MEASUREMENT_FOLDERS[measurement_folder]
+    data_files = iter_downloads(sources) if remote else read_files(sources)
+    written = []
+    failed = failed_records()
+    # the write API is closed (flushed) after every shard
+    write_api = create_write_api(_client)
+    try:
+        values = write_month_files(
+            track_sources(data_files, written),
+            year,
+            month,
+            delete_bucket_data=False,
+            measurement=measurement,
+            measurement_type=measurement_type,
+            write_api=RateLimitedWriteAPI(write_api, _rate_limiter),
+        )
+    finally:
+        write_api.close()
+    # the batching write API does not raise on close, a shard with rejected
+    # records fails, so none of its files are recorded as written
+    check_written(failed)
+    worker = multiprocessing.current_process().name
+    return values, written, worker, time.perf_counter() - started
+
+
+def iter_months(start: str, end: str) -> Iterator[tuple[int, int]]:
+    """Iterate over the months between start and end (YYYY-MM, inclusive)."""
+    year, month = map(int, start.split("-"))
+    end_year, end_month = map(int, end.split("-"))
+    while (year, month) <= (end_year, end_month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def list_month_files(
+    measurement_folder: str, year: int, month: int, data_dir: str | None
+) -> list[tuple[str, int | None]]:
+    """List the station files of a month, local paths or remote URLs.
+
+    Returns:
+        list[tuple[str, int | None]]: Files and their sizes, None if unknown.
+    """
+    measurement_type, _ = MEASUREMENT_FOLDERS[measurement_folder]
+    suffix = f"-{year}{month:02d}.json"
+    if data_dir:
+        # the same layout as created by test_scripts/download_data.py
+        folder = os.path.join(data_dir, str(year), "data", measurement_folder)
+        folder = os.path.join(folder, f"{month:02d}")
+        if not os.path.isdir(folder):
+            return []
+        return sorted(
+            (entry.path, entry.stat().st_size)
+            for entry in os.scandir(folder)
+            if entry.name.startswith(f"{measurement_type}-")
+            and entry.name.endswith(suffix)
+        )
+    remote_folder = config.get("folders", "chmi_data_folder")
+    remote_folder = f"{remote_folder}{measurement_folder}/{month:02d}/"
+    return sorted(
+        (entry.url, entry.size)
+        for entry in get_data_files(remote_folder, measurement_type)
+        if entry.name.endswith(suffix)
+    )
+
+
+def load_progress(path: str) -> set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path, "r", encoding="utf-8") as file:
+        return {json.loads(line) for line in file if line.strip()}
+
+
+def build_tasks(
+    months: dict[tuple[str, int, int], list[tuple[str, int | None]]],
+    workers: int,
+    shard_size: int,
+    remote: bool,
+) -> list[tuple[tuple, int]]:
+    """Split the station files of the months into shards of about the same size.
+
+    Args:
+        months (dict): Files and their sizes by the measurement folder and month.
+        workers (int): Number of worker processes.
+        shard_size (int): Maximum number of station files in a shard.
+        remote (bool): The files are remote URLs.
+
+    Returns:
+        list[tuple[tuple, int]]: Arguments of write_shard (measurement folder,
+            year, month, sources, remote) and the size of the shard, the
+            largest shards first.
+    """
+    total_size = sum(size or 0 for sources in months.values() for _, size in sources)
+    target_size = total_size // (workers * SHARDS_PER_WORKER) or 1
+    tasks = [
+        ((measurement_folder, year, month, shard, remote), size)
+        for (measurement_folder, year, month), sources in months.items()
+        for shard, size in size_balanced_shards(sources, target_size, shard_size)
+    ]
+    # the free workers take the largest of the remaining shards
+    tasks.sort(key=lambda task: task[1], reverse=True)
+    return tasks
+
+
+def backfill(
+    start: str,
+    end: str,
+    measurement_folders: list[str],
+    data_dir: str | None = None,
+    workers: int = os.cpu_count() or 1,
+    shard_size: int = 50,
+    rate: float = 0.0,
+    progress_path: str = "backfill_progress.jsonl",
+) -> dict:
+    """Write the station files of a range of months with a pool of processes.
+
+    Args:
+        start (str): First month (YYYY-MM).
+        end (str): Last month (YYYY-MM).
+        measurement_folders (list[str]): Measurement folders (10min, 1h, daily).
+        data_dir (str | None): Local data folder, the CHMI server is used if None.
+        workers (int): Number of worker processes.
+        shard_size (int): Maximum number of station files written by a task.
+        rate (float): Global limit of written values per second, 0 for no limit.
+        progress_path (str): File with the already written station files.
+
+    Returns:
+        dict: Summary of the backfill.
+    """
+    started = time.time()
+    done = load_progress(progress_path)
+    remote = not data_dir
+    months = {}
+    skipped = 0
+    for measurement_folder in measurement_folders:
+        for year, month in iter_months(start, end):
+            listed = list_month_files(measurement_folder, year, month, data_dir)
+            # the already written files are skipped when the backfill is resumed
+            sources = [(source, size) for source, size in listed if source not in done]
+            skipped += len(listed) - len(sources)
+            if sources:
+                months[measurement_folder, year, month] = sources
+    tasks = build_tasks(months, workers, shard_size, remote)
+    summary = {
+        "files": sum(len(task[3]) for task, _ in tasks),
+        "bytes": sum(size for _, size in tasks),
+        "skipped_files": skipped,
+        "tasks": len(tasks),
+        "failed_tasks": 0,
+        "failed_files": 0,
+        "values": 0,
+        "values_by_folder": {folder: 0 for folder in measurement_folders},
+    }
+    utilization = WorkerUtilization()
+    logger.info(f"Backfilling {summary['files']} files in {len(tasks)} tasks.")
+    # spawn, so the workers do not inherit the connections of the main process
+    context = multiprocessing.get_context("spawn")
+    rate_limiter = RateLimiter(rate, context)
+    with (
+        ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=init_worker,
+            initargs=(rate_limiter,),
+        ) as executor,
+        open(progress_path, "a", encoding="utf-8") as progress,
+    ):
+        pending = {
+            executor.submit(write_shard, *task): (task, size) for task, size in tasks
+        }
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                (measurement_folder, year, month, shard, _), size = pending.pop(future)
+                try:
+                    values, written, worker, busy = future.result()
+                except Exception as e:
+                    summary["failed_tasks"] += 1
+                    logger.error(
+                        f"Failed to write {measurement_folder} {year}-{month:02d}: {e}"
+                    )
+                    continue
+                utilization.add(worker, busy, size)
+                summary["values"] += values
+                summary["values_by_folder"][measurement_folder] += values
+                # only the written files are recorded, the failed downloads are
+                # retried when the backfill is resumed
+                for source in written:
+                    progress.write(json.dumps(source) + "\n")
+                progress.flush()
+                logger.info(
+                    f"Written {values} values of {len(written)} {measurement_folder} "
+                    f"files of {year}-{month:02d}."
+                )
+                if len(written) < len(shard):
+                    summary["failed_files"] += len(shard) - len(written)
+                    logger.error(
+                        f"Failed to download {len(shard) - len(written)} "
+                        f"{measurement_folder} files of {year}-{month:02d}."
+                    )
+    summary["elapsed_s"] = round(time.time() - started, 3)
+    summary["values_per_s"] = round(summary["values"] / max(summary["elapsed_s"], 1e-9))
+    summary["workers"] = utilization.summary()
+    logger.info(f"Backfill summary: {json.dumps(summary)}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the CHMI history.")
+    parser.add_argument("start", help="first month (YYYY-MM)")
+    parser.add_argument("end", help="last month (YYYY-MM)")
+    parser.add_argument(
+        "--folders",
+        nargs="+",
+        default=["10min"],
+        choices=list(MEASUREMENT_FOLDERS),
+        help="measurement folders to write",
+    )
+    parser.add_argument(
+        "--data-dir", help="local data folder (<dir>/<year>/data/<folder>/<month>)"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--shard-size", type=int, default=50)
+    parser.add_argument(
+        "--rate", type=float, default=0.0, help="written values per second"
+    )
+    parser.add_argument("--progress", default="backfill_progress.jsonl")
+    args = parser.parse_args()
+    summary = backfill(
+        args.start,
+        args.end,
+        args.folders,
+        args.data_dir,
+        args.workers,
+        args.shard_size,
+        args.rate,
+        args.progress,
+    )
+    print(json.dumps(summary, indent=4))
+
+
+if __name__ == "__main__":
+    main()
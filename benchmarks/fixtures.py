@@ -0,0 +1,328 @@
+import functools
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from collections.abc import Iterable
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+# synthetic CHMI open data for the benchmarks: directory listings, station data
+# files and meta1/meta2 files, a local HTTP server and a fake InfluxDB endpoint
+
+MEASUREMENTS = [
+    ("T", "Teplota vzduchu", "°C", 2.0),
+    ("H", "Relativní vlhkost", "%", 2.0),
+    ("P", "Tlak vzduchu", "hPa", None),
+    ("F", "Rychlost větru", "m/s", 10.0),
+    ("D", "Směr větru", "°", 10.0),
+    ("SRA", "Srážky", "mm", 1.0),
+    ("SCE", "Sníh", "cm", None),
+    ("SSV", "Sluneční svit", "h", 1.0),
+    ("TMA", "Maximální teplota", "°C", 2.0),
+    ("TMI", "Minimální teplota", "°C", 2.0),
+]
+OBS_TYPES = ["10M", "1H", "DLY"]
+# element abbreviations of the station data files, the big stations report
+# dozens of them and most of the precipitation stations only a few
+ELEMENTS = [m[0] for m in MEASUREMENTS] + [
+    "T05",
+    "T10",
+    "T20",
+    "T50",
+    "T100",
+    "TPM",
+    "Fmax",
+    "Dmax",
+    "SRA10M",
+    "SVH",
+    "E",
+    "W",
+    "N",
+    "NL",
+    "VIS",
+    "HS",
+    "SSV10M",
+    "GLBR",
+    "DIFR",
+    "RH",
+]
+STATION_HEADER = "STATION,ELEMENT,DT,VAL,FLAG,QUALITY"
+MONTH_NAMES = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+
+
+def station_wsis(stations: int) -> list[str]:
+    return [f"0-20000-0-{11000 + i}" for i in range(stations)]
+
+
+def write_chmi_file(path: str, header: str, values: list) -> None:
+    data = {
+        "data": {
+            "type": "DataCollection",
+            "data": {"header": header, "values": values},
+        }
+    }
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False)
+
+
+def generate_metadata(folder: str, years: list[int], stations: int) -> None:
+    """Generate meta1/meta2 files in the <year>/metadata/<month> layout."""
+    rng = random.Random(0)
+    wsis = station_wsis(stations)
+    station_measurements = {
+        wsi: {
+            obs_type: rng.sample(MEASUREMENTS, rng.randint(3, len(MEASUREMENTS)))
+            for obs_type in OBS_TYPES
+            if rng.random() < 0.8
+        }
+        for wsi in wsis
+    }
+    for year in years:
+        for month in range(1, 13):
+            month_folder = os.path.join(folder, str(year), "metadata", f"{month:02d}")
+            os.makedirs(month_folder, exist_ok=True)
+            # a few stations are added or closed every month
+            active = [wsi for wsi in wsis if rng.random() < 0.97]
+            meta1 = [
+                [
+                    wsi,
+                    f"GH{i:05d}",
+                    "1990-01-01T00:00:00Z",
+                    "3999-12-31T23:59:00Z",
+                    f"Station {i}",
+                    round(49 + rng.random(), 4),
+                    round(15 + rng.random(), 4),
+                    float(rng.randint(150, 1500)),
+                ]
+                for i, wsi in enumerate(active)
+            ]
+            meta2 = []
+            for wsi in active:
+                for obs_type, measurements in station_measurements[wsi].items():
+                    for abbreviation, name, unit, height in measurements:
+                        meta2.append(
+                            [obs_type, wsi, abbreviation, name, unit, height, obs_type]
+                        )
+            # duplicate rows as in the real metadata
+            meta2.extend(rng.sample(meta2, len(meta2) // 50))
+            write_chmi_file(
+                os.path.join(month_folder, f"meta1-{year}{month:02d}.json"),
+                "WSI,GH_ID,BEGIN_DATE,END_DATE,FULL_NAME,GEOGR1,GEOGR2,ELEVATION",
+                meta1,
+            )
+            write_chmi_file(
+                os.path.join(month_folder, f"meta2-{year}{month:02d}.json"),
+                "OBS_TYPE,WSI,EG_EL_ABBREVIATION,NAME,UNIT,HEIGHT,SCHEDULE",
+                meta2,
+            )
+
+
+def station_values(
+    wsi: str, elements: list[str], start: datetime, steps: int, step: int, rng
+) -> list[list]:
+    """Create the value rows of a station, grouped by the element like CHMI."""
+    values = []
+    times = [
+        (start + timedelta(seconds=step * i)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        for i in range(steps)
+    ]
+    for element in elements:
+        level = rng.uniform(-10.0, 30.0)
+        for dt in times:
+            level += rng.uniform(-0.5, 0.5)
+            # a few values are missing or not verified
+            if rng.random() < 0.005:
+                values.append([wsi, element, dt, None, "N", 3.0])
+            elif rng.random() < 0.01:
+                values.append([wsi, element, dt, round(level, 1), None, 1.0])
+            else:
+                values.append([wsi, element, dt, round(level, 1), None, 0.0])
+    return values
+
+
+def station_elements(rng) -> list[str]:
+    """Pick the elements of a station, the sizes of the files vary widely."""
+    count = min(len(ELEMENTS), max(1, int(rng.paretovariate(1.2) * 2)))
+    return ELEMENTS[:count]
+
+
+def listing_html(path: str, entries: list[tuple[str, int, float]]) -> str:
+    """Render a directory listing like the nginx autoindex of the CHMI server.
+
+    Args:
+        path (str): Path of the folder in the title.
+        entries (list[tuple[str, int, float]]): Names, sizes and mtimes (epoch).
+    """
+    lines = [
+        "<html>",
+        f"<head><title>Index of {path}</title></head>",
+        "<body>",
+        f'<h1>Index of {path}</h1><hr><pre><a href="../">../</a>',
+    ]
+    for name, size, mtime in entries:
+        dt = datetime.fromtimestamp(mtime, timezone.utc)
+        date = f"{dt.day:02d}-{MONTH_NAMES[dt.month - 1]}-{dt.year} {dt:%H:%M}"
+        # the names longer than 50 characters are cut in the link text
+        text = name if len(name) <= 50 else f"{name[:47]}..&gt;"
+        padding = " " * (51 - len(text))
+        lines.append(f'<a href="{name}">{text}</a>{padding}{date} {size:>19}')
+    lines.append("</pre><hr></body>")
+    lines.append("</html>")
+    return "\n".join(lines) + "\n"
+
+
+def write_listing(folder: str, path: str) -> list[str]:
+    """Write index.html of the JSON files of a folder and return their names."""
+    names = sorted(name for name in os.listdir(folder) if name.endswith(".json"))
+    entries = []
+    for name in names:
+        stat = os.stat(os.path.join(folder, name))
+        entries.append((name, stat.st_size, stat.st_mtime))
+    with open(os.path.join(folder, "index.html"), "w", encoding="utf-8") as file:
+        file.write(listing_html(path, entries))
+    return names
+
+
+def generate_month(
+    root: str,
+    year: int,
+    month: int,
+    stations: int,
+    days: int | None = None,
+    measurement_folder: str = "10min",
+    measurement_type: str = "10m",
+    step: int = 600,
+    seed: int = 0,
+) -> list[str]:
+    """Generate the station files of a month in <root>/<folder>/<month>/.
+
+    Args:
+        root (str): Root folder, served as chmi_data_folder.
+        year (int): Year of the data.
+        month (int): Month of the data.
+        stations (int): Number of weather stations.
+        days (int | None): Number of days of values, the whole month if None.
+        measurement_folder (str): Measurement folder (10min, 1h, daily).
+        measurement_type (str): Prefix of the files (10m, 1h, dly).
+        step (int): Seconds between the values.
+        seed (int): Seed of the values.
+
+    Returns:
+        list[str]: Names of the generated files.
+    """
+    rng = random.Random(seed)
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    if days is not None:
+        end = min(end, start + timedelta(days=days))
+    steps = int((end - start).total_seconds()) // step
+    folder = os.path.join(root, measurement_folder, f"{month:02d}")
+    os.makedirs(folder, exist_ok=True)
+    for wsi in station_wsis(stations):
+        write_chmi_file(
+            os.path.join(folder, f"{measurement_type}-{wsi}-{year}{month:02d}.json"),
+            STATION_HEADER,
+            station_values(wsi, station_elements(rng), start, steps, step, rng),
+        )
+    return write_listing(folder, f"/{measurement_folder}/{month:02d}/")
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args) -> None:
+        pass
+
+
+def serve_folder(folder: str, port: int = 0) -> tuple[ThreadingHTTPServer, str]:
+    """Serve a folder over HTTP in a daemon thread.
+
+    Returns:
+        tuple[ThreadingHTTPServer, str]: Server and its base URL (with a slash).
+    """
+    handler = functools.partial(_QuietHandler, directory=folder)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+class FakeInfluxDB(ThreadingHTTPServer):
+    """InfluxDB write endpoint counting the received lines, nothing is stored.
+
+    The lines of the rejected requests are not counted.
+    """
+
+    def __init__(
+        self, port: int = 0, delay: float = 0.0, failures: Iterable[int] = ()
+    ) -> None:
+        super().__init__(("127.0.0.1", port), _InfluxHandler)
+        # simulated latency of a write request (seconds)
+        self.delay = delay
+        # status codes of the next write requests (429, 503, 400...), then 204
+        self.failures = list(failures)
+        self.requests = 0
+        self.lines = 0
+        self.bytes = 0
+        # write requests being handled at the same time
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "FakeInfluxDB":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def reset(self) -> None:
+        with self._lock:
+            self.requests = self.lines = self.bytes = self.max_in_flight = 0
+
+    def begin(self) -> int:
+        """Start a write request and get the status code of its response."""
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return self.failures.pop(0) if self.failures else 204
+
+    def end(self, body: bytes, status: int) -> None:
+        lines = body.count(b"\n") + (not body.endswith(b"\n")) if body else 0
+        with self._lock:
+            self.in_flight -= 1
+            if status == 204:
+                self.lines += lines
+                self.bytes += len(body)
+
+
+class _InfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        status = self.server.begin()
+        try:
+            if self.server.delay:
+                time.sleep(self.server.delay)
+        finally:
+            self.server.end(body, status)
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self) -> None:
+        # /ping and /health of the clients
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# benchmark of the WSI and abbreviation lookups in the metadata db
+# before (no indexes, duplicates) and after metadata_migrate.py
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, select  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from metadata_db import create_metadata_engine  # noqa: E402
+from metadata_migrate import migrate_metadata  # noqa: E402
+from ws_db_models import (  # noqa: E402
+    RESOLUTIONS,
+    Base,
+    Measurement,
+    WeatherStation,
+    weather_station_measurements,
+)
+
+ABBREVIATIONS = [f"M{i:03d}" for i in range(200)]
+
+
+def create_legacy_db(engine, stations: int, duplicates: float) -> list[str]:
+    """Create the schema without the indexes and fill it with synthetic rows."""
+    rng = random.Random(0)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(conn)
+    wsis = [f"0-20000-0-{10000 + i}" for i in range(stations)]
+    # the duplicates of the old schema are added at the end
+    rows = wsis + rng.sample(wsis, int(stations * duplicates))
+    with Session(engine) as session:
+        session.execute(
+            insert(WeatherStation),
+            [
+                {
+                    "wsi": wsi,
+                    "gh_id": f"GH{i:05d}",
+                    "full_name": f"Station {i}",
+                    "X": 49 + rng.random(),
+                    "Y": 15 + rng.random(),
+                    "elevation": float(rng.randint(150, 1500)),
+                }
+                for i, wsi in enumerate(rows)
+            ],
+        )
+        session.execute(
+            insert(Measurement),
+            [
+                {"resolution": r, "abbreviation": a, "name": f"Name {a}", "unit": "-"}
+                for r in RESOLUTIONS
+                for a in ABBREVIATIONS + ABBREVIATIONS[: len(ABBREVIATIONS) // 10]
+            ],
+        )
+        measurement_ids = range(1, len(RESOLUTIONS) * len(ABBREVIATIONS) + 1)
+        session.execute(
+            insert(weather_station_measurements),
+            [
+                {"weather_station_id": ws_id, "measurement_id": m_id}
+                for ws_id in range(1, len(rows) + 1)
+                for m_id in rng.sample(measurement_ids, 30)
+            ],
+        )
+        session.commit()
+    return wsis
+
+
+def time_lookups(engine, wsis: list[str], lookups: int) -> dict:
+    rng = random.Random(1)
+    results = {}
+    queries = {
+        "wsi": (
+            lambda value: select(WeatherStation.gh_id).where(
+                WeatherStation.wsi == value
+            ),
+            wsis,
+        ),
+        "abbreviation": (
+            lambda value: select(Measurement.id).where(
+                Measurement.resolution == "10M", Measurement.abbreviation == value
+            ),
+            ABBREVIATIONS,
+        ),
+    }
+    with Session(engine) as session:
+        for name, (query, values) in queries.items():
+            latencies = []
+            for value in rng.choices(values, k=lookups):
+                started = time.perf_counter()
+                session.execute(query(value)).first()
+                latencies.append(time.perf_counter() - started)
+            latencies.sort()
+            results[name] = {
+                "mean_us": round(statistics.fmean(latencies) * 1e6, 1),
+                "p50_us": round(latencies[len(latencies) // 2] * 1e6, 1),
+                "p99_us": round(latencies[int(len(latencies) * 0.99)] * 1e6, 1),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the metadata lookups.")
+    parser.add_argument("--stations", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument("--duplicates", type=float, default=0.01)
+    parser.add_argument(
+        "--url", default=None, help="scratch db, its tables are dropped"
+    )
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as folder:
+        url = args.url or f"sqlite:///{folder}/metadata.db"
+        engine = create_metadata_engine(url)
+        wsis = create_legacy_db(engine, args.stations, args.duplicates)
+        results = {"stations": args.stations, "lookups": args.lookups}
+        results["before"] = time_lookups(engine, wsis, args.lookups)
+        started = time.perf_counter()
+        results["merged_duplicates"] = migrate_metadata(engine)
+        results["migration_s"] = round(time.perf_counter() - started, 3)
+        results["after"] = time_lookups(engine, wsis, args.lookups)
+        engine.dispose()
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
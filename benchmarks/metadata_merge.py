@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# benchmark of ws_metadata_merge.py on synthetic CHMI metadata of many months
+# the output is compared with the original pandas implementation when available
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parsing_tools  # noqa: E402
+import ws_metadata_merge  # noqa: E402
+from fixtures import OBS_TYPES, generate_metadata  # noqa: E402
+
+
+def legacy_merge(years: list[int]) -> tuple:
+    """The original implementation: pandas dedup and deep_merge month by month."""
+    import pandas as pd
+
+    def drop_duplicates(rows):
+        return pd.DataFrame(rows).drop_duplicates().values.tolist()
+
+    def merge_lists(list1, list2):
+        return sorted(drop_duplicates(list1 + list2))
+
+    def deep_merge(*dicts):
+        merged = {}
+        for d in dicts:
+            for key, value in d.items():
+                if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                    merged[key] = deep_merge(merged[key], value)
+                elif isinstance(value, list) and isinstance(merged.get(key), list):
+                    merged[key] = merge_lists(merged[key], value)
+                else:
+                    merged[key] = value
+        return merged
+
+    def add_measurements(ws_dict, values, meas):
+        prev_wsi = None
+        measurements = []
+        for value in values:
+            if meas in value:
+                current_wsi = value[1]
+                if current_wsi != prev_wsi:
+                    ws_dict[current_wsi][meas] = []
+                ws_dict[current_wsi][meas].append(value[2:-1])
+                measurements.append(value[2:-1])
+                prev_wsi = current_wsi
+        return sorted(drop_duplicates(measurements))
+
+    ws_dicts = []
+    all_measurements = [[], [], []]
+    for year in years:
+        for month in range(1, 13):
+            input_dir = f"{year}/metadata/{month:02d}"
+            headers, values = parsing_tools.extract_chmi_metadata(
+                f"{input_dir}/meta1-{year}{month:02d}.json"
+            )
+            ws_dict = {}
+            for value in values:
+                wsi = value[0].replace(" ", "")
+                if wsi not in ws_dict:
+                    ws_dict[wsi] = dict(zip(headers[1:], value[1:]))
+            _, values = parsing_tools.extract_chmi_metadata(
+                f"{input_dir}/meta2-{year}{month:02d}.json"
+            )
+            values = drop_duplicates(values)
+            for i, meas in enumerate(OBS_TYPES):
+                all_measurements[i].extend(add_measurements(ws_dict, values, meas))
+            ws_dicts.append(ws_dict)
+    merged_ws_dict = {}
+    for ws_dict in ws_dicts:
+        merged_ws_dict = deep_merge(merged_ws_dict, ws_dict)
+    return merged_ws_dict, *(sorted(drop_duplicates(m)) for m in all_measurements)
+
+
+def read_outputs() -> tuple:
+    outputs = []
+    for name in (
+        "weather_stations",
+        "measurements_10m",
+        "measurements_1h",
+        "measurements_dly",
+    ):
+        with open(f"data_db/{name}.json", "r", encoding="utf-8") as file:
+            outputs.append(file.read())
+    return tuple(outputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the metadata merge.")
+    parser.add_argument("--years", type=int, default=2, help="number of years")
+    parser.add_argument("--stations", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+    years = list(range(2024, 2024 + args.years))
+    results = {"months": 12 * len(years), "stations": args.stations}
+    with tempfile.TemporaryDirectory() as folder:
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            os.makedirs("data_db")
+            generate_metadata(folder, years, args.stations)
+            started = time.perf_counter()
+            ws_metadata_merge.main(years, args.workers)
+            results["merge_s"] = round(time.perf_counter() - started, 3)
+            outputs = read_outputs()
+            if not args.skip_legacy:
+                try:
+                    started = time.perf_counter()
+                    legacy = legacy_merge(years)
+                    results["legacy_s"] = round(time.perf_counter() - started, 3)
+                    legacy_outputs = tuple(
+                        json.dumps(value, indent=4, ensure_ascii=False)
+                        for value in legacy
+                    )
+                    results["identical"] = legacy_outputs == outputs
+                except ImportError:
+                    results["legacy_s"] = None
+        finally:
+            os.chdir(cwd)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from dateutil.relativedelta import relativedelta
+
+# benchmark suite of the ingestion pipeline on synthetic CHMI data served from a
+# local HTTP server and written to a fake InfluxDB, the results are printed as
+# JSON for regression tracking
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fixtures import (  # noqa: E402
+    FakeInfluxDB,
+    generate_metadata,
+    generate_month,
+    listing_html,
+    serve_folder,
+    station_wsis,
+)
+
+BENCHMARKS = (
+    "listing",
+    "download",
+    "json_parse",
+    "row_filter",
+    "encoding",
+    "process_metadata",
+    "metadata_merge",
+    "e2e",
+)
+
+
+def timed(func, repeat: int = 1) -> tuple[dict, object]:
+    """Run the function repeatedly, get the best and median time and the result."""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - started)
+    timing = {
+        "best_s": round(min(times), 6),
+        "median_s": round(statistics.median(times), 6),
+    }
+    return timing, result
+
+
+def rate(count: float, seconds: float) -> float:
+    return round(count / max(seconds, 1e-9), 1)
+
+
+def write_config(folder: str, influx_url: str, data_url: str, sync_write: bool) -> None:
+    """Write config.ini of the pipeline, the modules read it when imported."""
+    with open(os.path.join(folder, "config.ini"), "w", encoding="utf-8") as file:
+        file.write(
+            "[metadata]\n"
+            "backend = sqlite\n"
+            f"sqlite_path = {os.path.join(folder, 'metadata.db')}\n"
+            "[influxdb]\n"
+            f"url = {influx_url}\n"
+            "token = benchmark\n"
+            "org = vut\n"
+            f"async_write = {str(not sync_write).lower()}\n"
+            "[download]\n"
+            # every run downloads the files, nothing is revalidated
+            "cache_folder =\n"
+            "[folders]\n"
+            f"chmi_data_folder = {data_url}\n"
+        )
+
+
+def create_metadata_db(stations: int) -> None:
+    """Create the metadata db with the weather stations of the fixtures."""
+    from sqlalchemy import insert
+    from sqlalchemy.orm import Session
+
+    from metadata_db import create_metadata_engine
+    from ws_db_models import Base, WeatherStation
+
+    engine = create_metadata_engine()
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.execute(
+            insert(WeatherStation),
+            [
+                {
+                    "wsi": wsi,
+                    "gh_id": f"GH{i:05d}",
+                    "full_name": f"Station {i}",
+                    "X": 49.0,
+                    "Y": 15.0,
+                    "elevation": 300.0,
+                }
+                for i, wsi in enumerate(station_wsis(stations))
+            ],
+        )
+        session.commit()
+    engine.dispose()
+
+
+def bench_listing(folder: str, base_url: str, entries: int, repeat: int) -> dict:
+    """Fetch and parse a now-folder listing with entries files of 3 types."""
+    from downloader import fetch_file
+    from listing import file_pattern, list_folder, parse_listing
+
+    mtime = time.time()
+    names = [
+        f"{measurement_type}-{wsi}-{20250101 + day}.json"
+        for measurement_type in ("10m", "1h", "dly")
+        for day in range(10)
+        for wsi in station_wsis(entries // 30 + 1)
+    ][:entries]
+    os.makedirs(os.path.join(folder, "listing"), exist_ok=True)
+    with open(os.path.join(folder, "listing", "index.html"), "w") as file:
+        file.write(listing_html("/listing/", [(n, 123456, mtime) for n in names]))
+    url = f"{base_url}listing/"
+    fetch, files = timed(lambda: list_folder(url, "10m", dates=["20250101"]), repeat)
+    # only the parsing, the listing is not downloaded again
+    content = fetch_file(url).content
+    pattern = file_pattern("10m", dates=["20250101"])
+    parse, _ = timed(lambda: parse_listing(content, url, pattern), repeat)
+    parse_all, _ = timed(lambda: parse_listing(content, url), repeat)
+    return {
+        "entries": len(names),
+        "matched": len(files),
+        "bytes": len(content),
+        "fetch_parse": fetch,
+        "parse": parse,
+        "parse_all": parse_all,
+        "entries_per_s": rate(len(names), parse_all["best_s"]),
+    }
+
+
+def bench_download(file_urls: list[str]) -> tuple[dict, list[tuple[str, bytes]]]:
+    from downloader import iter_downloads
+
+    timing, files = timed(lambda: list(iter_downloads(file_urls)))
+    size = sum(len(content) for _, content in files)
+    result = {
+        "files": len(files),
+        "bytes": size,
+        **timing,
+        "mb_per_s": rate(size / 1e6, timing["best_s"]),
+    }
+    return result, files
+
+
+def bench_json_parse(files: list[tuple[str, bytes]], repeat: int) -> tuple[dict, list]:
+    from parsing_tools import iter_station_values
+
+    timing, chunks = timed(
+        lambda: [
+            (url, station_values)
+            for url, content in files
+            for station_values in iter_station_values(content)
+        ],
+        repeat,
+    )
+    rows = sum(len(station_values) for _, station_values in chunks)
+    result = {"rows": rows, **timing, "rows_per_s": rate(rows, timing["best_s"])}
+    return result, chunks
+
+
+def bench_row_filter(chunks: list, repeat: int) -> dict:
+    rows = sum(len(station_values) for _, station_values in chunks)
+    results = {"rows": rows}
+    # all the valid values (last month) and a single measurement (daily rainfall)
+    for name, m in (("valid", None), ("measurement", "SRA")):
+        timing, selected = timed(
+            lambda: sum(
+                len(station_values.select(station_values.mask(measurement=m))[2])
+                for _, station_values in chunks
+            ),
+            repeat,
+        )
+        results[name] = {
+            "selected": selected,
+            **timing,
+            "rows_per_s": rate(rows, timing["best_s"]),
+        }
+    return results
+
+
+def bench_encoding(chunks: list, repeat: int) -> dict:
+    from line_protocol import WidePointAggregator, encode_station, station_points
+
+    masks = [
+        (f"GH{i:05d}", station_values, station_values.mask())
+        for i, (_, station_values) in enumerate(chunks)
+    ]
+    values = sum(int(mask.sum()) for _, _, mask in masks)
+    results = {"values": values}
+
+    def wide_points():
+        aggregator = WidePointAggregator()
+        for gh_id, station_values, mask in masks:
+            aggregator.add(gh_id, *station_values.select(mask))
+        return aggregator.lines()
+
+    encoders = {
+        "line_protocol": lambda: [
+            line
+            for gh_id, station_values, mask in masks
+            for line in encode_station(gh_id, station_values.rows(mask))
+        ],
+        "dict_points": lambda: [
+            point
+            for gh_id, station_values, mask in masks
+            for point in station_points(gh_id, station_values.rows(mask))
+        ],
+        "wide_points": wide_points,
+    }
+    for name, encoder in encoders.items():
+        timing, records = timed(encoder, repeat)
+        results[name] = {
+            "records": len(records),
+            **timing,
+            "values_per_s": rate(values, timing["best_s"]),
+        }
+    return results
+
+
+def bench_process_metadata(folder: str, stations: int, repeat: int) -> dict:
+    from parsing_tools import process_metadata
+
+    year = 2024
+    generate_metadata(folder, [year], stations)
+    input_dir = os.path.join(folder, str(year), "metadata", "01")
+    timing, (ws_dict, *_) = timed(
+        lambda: process_metadata(input_dir, year, 1), repeat
+    )
+    return {"stations": len(ws_dict), **timing}
+
+
+def bench_metadata_merge(folder: str, workers: int | None) -> dict:
+    import ws_metadata_merge
+
+    # ws_metadata_merge reads <year>/metadata of the working directory
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        os.makedirs("data_db", exist_ok=True)
+        timing, _ = timed(lambda: ws_metadata_merge.main((2024,), workers))
+    finally:
+        os.chdir(cwd)
+    return {"months": 12, **timing}
+
+
+def bench_e2e(
+    folder: str, base_url: str, influx: FakeInfluxDB, stations: int, days: int
+) -> dict:
+    """Write the last month of synthetic data with influx_writer_last_month."""
+    import influx_writer_last_month
+    from config import config
+    from metrics import REGISTRY
+
+    last_month = datetime.now(timezone.utc) - relativedelta(months=1)
+    root = os.path.join(folder, f"e2e_{stations}")
+    names = generate_month(
+        root, last_month.year, last_month.month, stations, days, seed=stations
+    )
+    size = sum(
+        os.path.getsize(os.path.join(root, "10min", f"{last_month.month:02d}", n))
+        for n in names
+    )
+    config.set("folders", "chmi_data_folder", f"{base_url}e2e_{stations}/")
+    influx.reset()
+    before = REGISTRY.snapshot()
+    timing, utilization = timed(
+        lambda: influx_writer_last_month.write_last_month_data(
+            "10min", "10m", delete_bucket_data=False, incremental=False
+        )
+    )
+    after = REGISTRY.snapshot()
+    stages = {
+        key.split('stage="')[1].rstrip('"}'): round(value - before.get(key, 0), 6)
+        for key, value in after.items()
+        if key.startswith('chmi_stage_seconds_total{job="last_month"')
+    }
+    key = 'chmi_points_written_total{job="last_month"}'
+    written = after.get(key, 0) - before.get(key, 0)
+    return {
+        "stations": stations,
+        "files": len(names),
+        "bytes": size,
+        **timing,
+        "values": written,
+        "influx_lines": influx.lines,
+        "influx_requests": influx.requests,
+        "values_per_s": rate(written, timing["best_s"]),
+        "stage_seconds": stages,
+        "workers": utilization,
+    }
+
+
+def git_commit() -> str | None:
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    return result.stdout.strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the CHMI pipeline.")
+    parser.add_argument(
+        "--stations", type=int, default=100, help="stations of the stage benchmarks"
+    )
+    parser.add_argument(
+        "--e2e-stations",
+        type=int,
+        nargs="+",
+        default=[10, 50, 200],
+        help="station counts of the end-to-end runs",
+    )
+    parser.add_argument(
+        "--days", type=int, default=7, help="days of values in the station files"
+    )
+    parser.add_argument("--listing-entries", type=int, default=30000)
+    parser.add_argument("--metadata-stations", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--sync-write", action="store_true", help="the batching write API"
+    )
+    parser.add_argument(
+        "--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS)
+    )
+    parser.add_argument("--output", help="file the JSON results are written to")
+    args = parser.parse_args()
+    report = {
+        "suite": "pipeline",
+        "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "results": {},
+    }
+    results = report["results"]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        server, base_url = serve_folder(folder)
+        influx = FakeInfluxDB().start()
+        write_config(folder, influx.url, base_url, args.sync_write)
+        # the modules of the pipeline are imported with the config of the benchmark
+        os.chdir(folder)
+        try:
+            create_metadata_db(max([args.stations, *args.e2e_stations]))
+            if "listing" in args.only:
+                results["listing"] = bench_listing(
+                    folder, base_url, args.listing_entries, args.repeat
+                )
+            stages = {"download", "json_parse", "row_filter", "encoding"}
+            if stages & set(args.only):
+                names = generate_month(folder, 2024, 1, args.stations, args.days)
+                file_urls = [f"{base_url}10min/01/{name}" for name in names]
+                download, files = bench_download(file_urls)
+                if "download" in args.only:
+                    results["download"] = download
+                json_parse, chunks = bench_json_parse(files, args.repeat)
+                if "json_parse" in args.only:
+                    results["json_parse"] = json_parse
+                if "row_filter" in args.only:
+                    results["row_filter"] = bench_row_filter(chunks, args.repeat)
+                if "encoding" in args.only:
+                    results["encoding"] = bench_encoding(chunks, args.repeat)
+                del files, chunks
+            metadata_folder = os.path.join(folder, "metadata")
+            if "process_metadata" in args.only:
+                results["process_metadata"] = bench_process_metadata(
+                    metadata_folder, args.metadata_stations, args.repeat
+                )
+            if "metadata_merge" in args.only:
+                if not os.path.exists(metadata_folder):
+                    generate_metadata(metadata_folder, [2024], args.metadata_stations)
+                results["metadata_merge"] = bench_metadata_merge(
+                    metadata_folder, args.workers
+                )
+            if "e2e" in args.only:
+                results["e2e"] = [
+                    bench_e2e(folder, base_url, influx, stations, args.days)
+                    for stations in args.e2e_stations
+                ]
+        finally:
+            os.chdir(cwd)
+            server.shutdown()
+            influx.shutdown()
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
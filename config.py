@@ -4,18 +4,28 @@ import logging
 config = configparser.ConfigParser()
 config.read("config.ini")
 
-db_user = config["mariadb"]["user"]
-db_password = config["mariadb"]["password"]
-db_url = config["mariadb"]["url"]
-db_name = config["mariadb"]["db_name"]
+# backend of the metadata db, mariadb or a local sqlite file
+db_backend = config.get("metadata", "backend", fallback="mariadb")
 
+if db_backend == "sqlite":
+    db_path = config.get("metadata", "sqlite_path", fallback="chmi_metadata.db")
+    # there is no db server, the db file is created by ws_metadata_create_db.py
+    DB_SERVER_CONNECTION_STRING = None
+    DB_CONNECTION_STRING = f"sqlite:///{db_path}"
+elif db_backend == "mariadb":
+    db_user = config["mariadb"]["user"]
+    db_password = config["mariadb"]["password"]
+    db_url = config["mariadb"]["url"]
+    db_name = config["mariadb"]["db_name"]
 
-# connection to the db server
-DB_SERVER_CONNECTION_STRING = (
-    f"mariadb+mariadbconnector://{db_user}:{db_password}@{db_url}"
-)
+    # connection to the db server
+    DB_SERVER_CONNECTION_STRING = (
+        f"mariadb+mariadbconnector://{db_user}:{db_password}@{db_url}"
+    )
 
-# connection to a single db on the server
-DB_CONNECTION_STRING = (
-    f"mariadb+mariadbconnector://{db_user}:{db_password}@{db_url}/{db_name}"
-)
+    # connection to a single db on the server
+    DB_CONNECTION_STRING = (
+        f"mariadb+mariadbconnector://{db_user}:{db_password}@{db_url}/{db_name}"
+    )
+else:
+    raise ValueError(f"Unknown metadata db backend: {db_backend}")
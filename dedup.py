@@ -0,0 +1,108 @@
+from collections.abc import Iterable
+
+# hash-based replacement of pd.DataFrame(rows).drop_duplicates().values.tolist()
+# the columns are converted the same way as by pandas (2.2), e.g. a column of
+# ints with a None becomes floats with a NaN, so the output stays identical
+
+# all missing values are replaced by this object in the keys of the rows,
+# so the rows with missing values at the same places are equal
+NAN = float("nan")
+
+_INT64_MIN = -(2**63)
+_INT64_MAX = 2**63 - 1
+
+
+def _column_type(values: tuple) -> str:
+    """Get the type pandas infers for a column of a frame created from lists."""
+    types = set(map(type, values))
+    if not types <= {int, float, bool, type(None)}:
+        return "object"
+    if int in types:
+        ints = [value for value in values if type(value) is int]
+        if not _INT64_MIN <= min(ints) <= max(ints) <= _INT64_MAX:
+            # ints out of the int64 range are kept as they are
+            return "object"
+    if bool in types:
+        return "bool" if types == {bool} else "object"
+    if float in types or (int in types and type(None) in types):
+        return "float"
+    if int in types:
+        return "int"
+    # only None values (or no values at all)
+    return "object"
+
+
+def _to_float(value) -> float:
+    # a float column has its own NaN objects
+    if value is None or value != value:
+        return float("nan")
+    return float(value)
+
+
+def _has_missing(values: tuple) -> bool:
+    return any(value is None or value != value for value in values)
+
+
+def _key(value):
+    # None and NaN are both missing values, they are duplicates of each other
+    if value is None or value != value:
+        return NAN
+    return value
+
+
+def _single_key(value):
+    # pandas compares a single column by the values, None is not NaN there
+    return NAN if value is not None and value != value else value
+
+
+def unique_rows(rows: Iterable) -> list[list]:
+    """Drop the duplicate rows, keeping the first ones, like pandas drop_duplicates.
+
+    Args:
+        rows (Iterable): Rows as lists (or scalars, used as single-column rows).
+
+    Returns:
+        list[list]: Unique rows in the order of their first occurrence.
+    """
+    rows = [row if isinstance(row, (list, tuple)) else [row] for row in rows]
+    if not rows:
+        return []
+    width = max(map(len, rows))
+    if not width:
+        # pandas does not drop any rows of a frame without columns
+        return [[] for _ in rows]
+    if min(map(len, rows)) < width:
+        # shorter rows are padded with None
+        rows = [list(row) + [None] * (width - len(row)) for row in rows]
+    columns = list(zip(*rows))
+    column_types = [_column_type(column) for column in columns]
+    # the frame values are floats when there are only int and float columns
+    if set(column_types) == {"int", "float"}:
+        column_types = ["float"] * width
+    converted = False
+    for i, column_type in enumerate(column_types):
+        if column_type == "float":
+            columns[i] = tuple(map(_to_float, columns[i]))
+            converted = True
+    missing = [_has_missing(column) for column in columns]
+    if not any(missing):
+        # the values are the keys, the first row of every key is kept
+        unique = dict.fromkeys(zip(*columns) if converted else map(tuple, rows))
+        return [list(row) for row in unique]
+    key = _key if width > 1 else _single_key
+    keys = zip(
+        *(
+            map(key, column) if has_missing else column
+            for column, has_missing in zip(columns, missing)
+        )
+    )
+    unique = {}
+    for row_key, row in zip(keys, zip(*columns)):
+        if row_key not in unique:
+            unique[row_key] = row
+    return [list(row) for row in unique.values()]
+
+
+def sorted_unique_rows(rows: Iterable) -> list[list]:
+    """Drop the duplicate rows and sort them, like the pandas round-trip."""
+    return sorted(unique_rows(rows))
@@ -0,0 +1,261 @@
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import config
+from http_cache import CachedResponse, HttpCache
+from metrics import DOWNLOAD_BYTES, DOWNLOAD_SECONDS, DOWNLOADS
+from scheduler import WorkerUtilization
+
+# shared downloader for the CHMI open data files
+
+logger = logging.getLogger("chmi.downloader")
+
+# the defaults can be overridden in the [download] section of config.ini
+MAX_WORKERS = config.getint("download", "max_workers", fallback=8)
+RETRIES = config.getint("download", "retries", fallback=3)
+BACKOFF_FACTOR = config.getfloat("download", "backoff_factor", fallback=0.5)
+TIMEOUT = config.getfloat("download", "timeout", fallback=30.0)
+# maximum number of downloaded files held in memory before they are consumed
+QUEUE_SIZE = config.getint("download", "queue_size", fallback=2 * MAX_WORKERS)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session(
+    max_workers: int = MAX_WORKERS,
+    retries: int = RETRIES,
+    backoff_factor: float = BACKOFF_FACTOR,
+) -> requests.Session:
+    """Create a requests session with a connection pool and retries.
+
+    Args:
+        max_workers (int): Number of pooled connections kept open per host.
+        retries (int): Number of retries for failed requests.
+        backoff_factor (float): Exponential backoff factor between retries.
+
+    Returns:
+        requests.Session: Session that can be shared between threads.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+        # the last response is returned, the status code is checked by the caller
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session() -> requests.Session:
+    """Get the session shared by all downloads of the process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def download_file(
+    file_url: str,
+    data_folder: str,
+    session: requests.Session | None = None,
+    cache: HttpCache | None = None,
+) -> str | None:
+    """Download a single file into the data folder.
+
+    Args:
+        file_url (str): URL of the file.
+        data_folder (str): Local folder the file is saved to.
+        session (requests.Session | None): Session to use, the shared one by default.
+        cache (HttpCache | None): Cache used for conditional requests.
+
+    Returns:
+        str | None: Local path of the file or None if the download failed.
+    """
+    response = fetch_file(file_url, session, cache)
+    if response is None:
+        return None
+    local_file_path = os.path.join(data_folder, os.path.basename(file_url))
+    with open(local_file_path, "wb") as file:
+        file.write(response.content)
+    return local_file_path
+
+
+def download_files(
+    file_urls: list[str],
+    data_folder: str,
+    max_workers: int = MAX_WORKERS,
+    session: requests.Session | None = None,
+    cache: HttpCache | None = None,
+) -> list[str]:
+    """Download files concurrently into the data folder.
+
+    Args:
+        file_urls (list[str]): URLs of the files.
+        data_folder (str): Local folder the files are saved to.
+        max_workers (int): Maximum number of concurrent downloads.
+        session (requests.Session | None): Session to use, the shared one by default.
+        cache (HttpCache | None): Cache used for conditional requests.
+
+    Returns:
+        list[str]: Local paths of the successfully downloaded files.
+    """
+    session = session or get_session()
+    local_paths = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(download_file, file_url, data_folder, session, cache)
+            for file_url in file_urls
+        ]
+        for future in as_completed(futures):
+            local_file_path = future.result()
+            if local_file_path:
+                local_paths.append(local_file_path)
+    logger.info(f"Downloaded {len(local_paths)} out of {len(file_urls)} files.")
+    return local_paths
+
+
+def fetch_file(
+    file_url: str,
+    session: requests.Session | None = None,
+    cache: HttpCache | None = None,
+) -> CachedResponse | None:
+    """Download a single file into memory.
+
+    Args:
+        file_url (str): URL of the file.
+        session (requests.Session | None): Session to use, the shared one by default.
+        cache (HttpCache | None): Cache used for conditional requests.
+
+    Returns:
+        CachedResponse | None: Content of the file or None if the download failed.
+    """
+    session = session or get_session()
+    started = time.perf_counter()
+    result = _fetch(file_url, session, cache)
+    DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+    if result is None:
+        DOWNLOADS.inc(status="failed")
+    elif result.modified:
+        DOWNLOADS.inc(status="ok")
+        DOWNLOAD_BYTES.inc(len(result.content))
+    else:
+        DOWNLOADS.inc(status="not_modified")
+    return result
+
+
+def _fetch(
+    file_url: str, session: requests.Session, cache: HttpCache | None
+) -> CachedResponse | None:
+    try:
+        if cache is not None:
+            return cache.fetch(file_url, session, TIMEOUT)
+        response = session.get(file_url, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        logger.warning(f"Failed to download {file_url}: {e}")
+        return None
+    if response.status_code != 200:
+        logger.warning(f"Failed to download {file_url}: {response.status_code}")
+        return None
+    return CachedResponse(response.content, modified=True)
+
+
+def _fetch_tracked(
+    file_url: str,
+    session: requests.Session,
+    cache: HttpCache | None,
+    utilization: WorkerUtilization,
+) -> CachedResponse | None:
+    started = time.perf_counter()
+    response = fetch_file(file_url, session, cache)
+    size = len(response.content) if response is not None and response.modified else 0
+    worker = threading.current_thread().name
+    utilization.add(worker, time.perf_counter() - started, size)
+    return response
+
+
+def iter_downloads(
+    file_urls: Iterable[str],
+    max_workers: int = MAX_WORKERS,
+    queue_size: int = QUEUE_SIZE,
+    session: requests.Session | None = None,
+    cache: HttpCache | None = None,
+    skip_unchanged: bool = False,
+    utilization: WorkerUtilization | None = None,
+) -> Iterator[tuple[str, bytes]]:
+    """Download files concurrently and yield each one as soon as it is complete.
+
+    At most queue_size files are downloading or waiting to be consumed at any
+    time, so the memory stays flat no matter how many files are requested.
+
+    Args:
+        file_urls (Iterable[str]): URLs of the files.
+        max_workers (int): Maximum number of concurrent downloads.
+        queue_size (int): Maximum number of files in flight.
+        session (requests.Session | None): Session to use, the shared one by default.
+        cache (HttpCache | None): Cache used for conditional requests.
+        skip_unchanged (bool): Skip the files that did not change since they were
+            cached.
+        utilization (WorkerUtilization | None): Busy time of the download threads.
+
+    Yields:
+        tuple[str, bytes]: URL and content of every successfully downloaded file.
+    """
+    session = session or get_session()
+    file_urls = iter(file_urls)
+    queue_size = max(queue_size, max_workers)
+    skipped = 0
+
+    def submit(file_url: str) -> Future:
+        if utilization is None:
+            return executor.submit(fetch_file, file_url, session, cache)
+        return executor.submit(_fetch_tracked, file_url, session, cache, utilization)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        for file_url in file_urls:
+            pending[submit(file_url)] = file_url
+            if len(pending) >= queue_size:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_url = pending.pop(future)
+                # refill the queue before handing the file to the consumer
+                next_url = next(file_urls, None)
+                if next_url is not None:
+                    pending[submit(next_url)] = next_url
+                response = future.result()
+                if response is None:
+                    continue
+                if skip_unchanged and not response.modified:
+                    skipped += 1
+                    continue
+                yield file_url, response.content
+    if skipped:
+        logger.info(f"Skipped {skipped} unchanged files.")
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from config import config
+
+# persistent on-disk cache of the downloaded CHMI files and directory listings
+# every URL is stored as <key>.body with its validators in <key>.json
+
+logger = logging.getLogger("chmi.http_cache")
+
+# the cache is disabled when the folder is empty
+CACHE_FOLDER = config.get("download", "cache_folder", fallback="http_cache")
+CACHE_MAX_BYTES = config.getint(
+    "download", "cache_max_bytes", fallback=1024 * 1024 * 1024
+)
+
+
+@dataclass
+class CachedResponse:
+    content: bytes
+    # False when the server confirmed that the cached content is still current
+    modified: bool
+
+
+class HttpCache:
+    def __init__(self, folder: str, max_bytes: int = CACHE_MAX_BYTES) -> None:
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self._size = sum(
+            entry.stat().st_size
+            for entry in os.scandir(folder)
+            if entry.name.endswith(".body")
+        )
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        path = os.path.join(self.folder, key)
+        return f"{path}.body", f"{path}.json"
+
+    def _read(self, url: str) -> tuple[dict, bytes] | None:
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as file:
+                meta = json.load(file)
+            with open(body_path, "rb") as file:
+                content = file.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url:
+            return None
+        return meta, content
+
+    def _write(self, url: str, response: requests.Response) -> None:
+        self._commit(url, self._stage(url, response))
+
+    def _stage(self, url: str, response: requests.Response) -> tuple[str, str]:
+        """Write the body and validators of a response next to its entry."""
+        body_path, meta_path = self._paths(url)
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(f"{body_path}.{suffix}", "wb") as file:
+            file.write(response.content)
+        with open(f"{meta_path}.{suffix}", "w", encoding="utf-8") as file:
+            json.dump(meta, file)
+        return f"{body_path}.{suffix}", f"{meta_path}.{suffix}"
+
+    def _commit(self, url: str, staged: tuple[str, str]) -> None:
+        """Replace the entry of the URL by the staged body and validators."""
+        body_path, meta_path = self._paths(url)
+        staged_body_path, staged_meta_path = staged
+        old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+        size = os.path.getsize(staged_body_path)
+        # the body is replaced first, a stale meta file only causes a full download
+        os.replace(staged_body_path, body_path)
+        os.replace(staged_meta_path, meta_path)
+        with self._lock:
+            self._size += size - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Remove the least recently used entries until the cache fits its size."""
+        bodies = sorted(
+            (
+                entry
+                for entry in os.scandir(self.folder)
+                if entry.name.endswith(".body")
+            ),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in bodies:
+            if self._size <= self.max_bytes:
+                break
+            size = entry.stat().st_size
+            for path in (entry.path, entry.path.removesuffix(".body") + ".json"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size -= size
+            logger.info(f"Evicted {entry.name} from the HTTP cache.")
+
+    def is_current(self, url: str, size: int, mtime: datetime) -> bool:
+        """Check that the cached copy has the size and time shown in a listing.
+
+        The listings show the time in minutes, the Last-Modified time of the
+        cached copy has to be in the same minute. Only the committed copies are
+        compared, the staged downloads of a running job are not.
+        """
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as file:
+                meta = json.load(file)
+            cached_size = os.path.getsize(body_path)
+        except (OSError, ValueError):
+            return False
+        if meta.get("url") != url or cached_size != size:
+            return False
+        try:
+            last_modified = parsedate_to_datetime(meta.get("last_modified"))
+        except (TypeError, ValueError):
+            return False
+        minute = {"second": 0, "microsecond": 0}
+        if last_modified.replace(**minute) != mtime.replace(**minute):
+            return False
+        # mark the entry as recently used like a revalidated one
+        try:
+            os.utime(body_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def fetch(
+        self,
+        url: str,
+        session: requests.Session,
+        timeout: float | None = None,
+        staged: dict | None = None,
+    ) -> CachedResponse | None:
+        """Get the content of the URL, downloading it only if it has changed.
+
+        Args:
+            url (str): URL of the file.
+            session (requests.Session): Session used for the request.
+            timeout (float | None): Request timeout in seconds.
+            staged (dict | None): A new download is staged into this dict
+                (URL -> staged files) instead of replacing the cached copy.
+
+        Returns:
+            CachedResponse | None: Content of the URL or None if the request failed.
+        """
+        cached = self._read(url)
+        headers = {}
+        if cached:
+            meta, _ = cached
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        response = session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and cached:
+            # mark the entry as recently used, it may have been evicted meanwhile
+            try:
+                os.utime(self._paths(url)[0])
+            except FileNotFoundError:
+                pass
+            return CachedResponse(cached[1], modified=False)
+        if response.status_code != 200:
+            logger.warning(f"Failed to download {url}: {response.status_code}")
+            return None
+        if staged is None:
+            self._write(url, response)
+        else:
+            staged[url] = self._stage(url, response)
+        return CachedResponse(response.content, modified=True)
+
+
+class StagedCache:
+    """HTTP cache of a job keeping the new downloads apart until they are committed.
+
+    The cached copy of a file is compared with the listing and revalidated, so
+    once it is replaced the file counts as processed. The job commits the new
+    downloads only after their values are written, a failed job downloads and
+    writes them again in the next run.
+    """
+
+    def __init__(self, cache: HttpCache) -> None:
+        self.cache = cache
+        # URL -> staged body and meta files
+        self._staged = {}
+        self._lock = threading.Lock()
+
+    def is_current(self, url: str, size: int, mtime: datetime) -> bool:
+        return self.cache.is_current(url, size, mtime)
+
+    def fetch(
+        self, url: str, session: requests.Session, timeout: float | None = None
+    ) -> CachedResponse | None:
+        staged = {}
+        response = self.cache.fetch(url, session, timeout, staged)
+        with self._lock:
+            for staged_url, files in staged.items():
+                self._remove(self._staged.pop(staged_url, ()))
+                self._staged[staged_url] = files
+        return response
+
+    def commit(self) -> None:
+        """Replace the cached copies by the new downloads."""
+        with self._lock:
+            staged, self._staged = self._staged, {}
+        for url, files in staged.items():
+            self.cache._commit(url, files)
+        if staged:
+            logger.info(f"Committed {len(staged)} downloads to the HTTP cache.")
+
+    def discard(self) -> None:
+        """Drop the new downloads, the cached copies stay as they were."""
+        with self._lock:
+            staged, self._staged = self._staged, {}
+        for files in staged.values():
+            self._remove(files)
+        if staged:
+            logger.info(f"Discarded {len(staged)} uncommitted downloads.")
+
+    @staticmethod
+    def _remove(files: tuple[str, ...]) -> None:
+        for path in files:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+_http_cache = None
+_http_cache_lock = threading.Lock()
+
+
+def get_http_cache() -> HttpCache | None:
+    """Get the HTTP cache shared by the process or None if it is disabled."""
+    global _http_cache
+    if not CACHE_FOLDER:
+        return None
+    with _http_cache_lock:
+        if _http_cache is None:
+            _http_cache = HttpCache(CACHE_FOLDER)
+        return _http_cache
@@ -1,17 +1,41 @@
 import json
 import logging
 import os
-import shutil
+import time
+from collections.abc import Iterable, Iterator
 from datetime import datetime, timedelta, timezone
 
-import requests
 from dateutil.relativedelta import relativedelta
-from influxdb_client import InfluxDBClient, WriteOptions
-from sqlalchemy import create_engine, select
+from influxdb_client import InfluxDBClient
 from sqlalchemy.orm import Session
 
-from config import DB_CONNECTION_STRING, config
-from ws_db_models import WeatherStation
+from async_writer import check_written, create_write_api, failed_records
+from config import config
+from downloader import iter_downloads
+from http_cache import get_http_cache
+from line_protocol import (
+    MEASUREMENT_SUFFIXES,
+    WIDE_POINTS,
+    WidePointAggregator,
+    write_station_values,
+)
+from listing import ListingEntry, list_folder
+from metadata_db import create_metadata_engine
+from manifest import MonthManifest, content_hash
+from metrics import (
+    FILE_SECONDS,
+    FILES,
+    POINTS_WRITTEN,
+    ROWS_FILTERED,
+    ROWS_PARSED,
+    job_metrics,
+    stage,
+    start_metrics_server,
+    timed_iter,
+)
+from parsing_tools import concat_station_values, iter_station_values
+from scheduler import WorkerUtilization, largest_first
+from station_index import get_station_index
 
 # logging setup
 logger = logging.getLogger("last_month_logger")
@@ -21,32 +45,18 @@ file_handler.setFormatter(
     logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 )
 logger.addHandler(file_handler)
+# the shared modules log into the same file
+logging.getLogger("chmi").setLevel(logging.INFO)
+logging.getLogger("chmi").addHandler(file_handler)
 
+# job name in the metrics
+JOB = "last_month"
 
-def get_data_urls(folder_url: str, measurement_type: str = "10m") -> list[str]:
-    response = requests.get(folder_url)
-    if response.status_code == 200:
-        html_text = response.text
-        file_urls = [
-            folder_url + line.split('"')[1]
-            for line in html_text.splitlines()
-            if ".json" in line and 'href="' in line and measurement_type in line
-        ]
-        return file_urls
-    else:
-        logger.warning(f"Failed to access folder {folder_url}: {response.status_code}")
-        return []
-
-
-def download_file(file_url: str, data_folder: str) -> None:
-    local_file_path = os.path.join(data_folder, os.path.basename(file_url))
-    response = requests.get(file_url, stream=True)
-    if response.status_code == 200:
-        with open(local_file_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-    else:
-        logger.warning(f"Failed to download {file_url}: {response.status_code}")
+
+def get_data_files(
+    folder_url: str, measurement_type: str = "10m"
+) -> list[ListingEntry]:
+    return list_folder(folder_url, measurement_type)
 
 
 def delete_single_month_data(client: InfluxDBClient, year: int, month: int) -> None:
@@ -69,80 +79,162 @@ def delete_single_month_data(client: InfluxDBClient, year: int, month: int) -> N
     logger.info("Data successfully deleted.")
 
 
-def write_single_month_data(
-    data_folder,
-    year,
-    month,
+def read_data_files(data_folder: str) -> Iterator[tuple[str, bytes]]:
+    for data_file in os.listdir(data_folder):
+        with open(os.path.join(data_folder, data_file), "rb") as file:
+            yield data_file, file.read()
+
+
+def write_month_files(
+    data_files: Iterable[tuple[str, bytes]],
+    year: int,
+    month: int,
     delete_bucket_data: bool = True,
     measurement: str = None,
     measurement_type: str = "10m",
-) -> None:
+    incremental: bool = False,
+    write_api=None,
+    utilization: WorkerUtilization | None = None,
+) -> int:
+    """Write the station data files of a single month.
+
+    Args:
+        data_files (Iterable[tuple[str, bytes]]): Names and contents of the files.
+        year (int): Year of the data.
+        month (int): Month of the data.
+        delete_bucket_data (bool): Delete the month from the bucket first.
+        measurement (str): Write only this measurement.
+        measurement_type (str): Prefix of the files (10m, 1h, dly).
+        incremental (bool): Write only the new or changed values.
+        write_api: Write API to use instead of a new one, it is not closed.
+        utilization (WorkerUtilization | None): Busy time of the workers, the
+            time of every written file is added to the "writer".
+
+    Returns:
+        int: Number of written values.
+    """
     client = InfluxDBClient(
         url=config.get("influxdb", "url"),
         token=config.get("influxdb", "token"),
         org=config.get("influxdb", "org"),
     )
-    write_api = client.write_api(write_options=WriteOptions(batch_size=5000))
-    # mariadb connection
-    engine = create_engine(DB_CONNECTION_STRING)
+    own_write_api = write_api is None
+    if own_write_api:
+        write_api = create_write_api(client)
+    failed = failed_records()
+    # metadata db connection
+    engine = create_metadata_engine()
     session = Session(engine)
+    # all weather stations are resolved from memory instead of per-file queries
+    with stage(JOB, "lookup"):
+        station_index = get_station_index(session)
     # delete data that was written using real time writer
-    if delete_bucket_data:
-        delete_single_month_data(client, year, month)
+    if delete_bucket_data and not incremental:
+        with stage(JOB, "delete"):
+            delete_single_month_data(client, year, month)
+    # in the incremental mode only new or changed values are (over)written
+    manifest = None
+    if incremental:
+        manifest = MonthManifest.for_month(year, month, measurement_type, measurement)
+    skipped = 0
+    written = 0
+    # e.g. the hourly values are written under their own measurement names
+    suffix = MEASUREMENT_SUFFIXES.get(measurement_type, "")
 
+    # optionally merge the values of all stations into wide points
+    aggregator = WidePointAggregator() if WIDE_POINTS else None
     logger.info("Writing started.")
-    for data_file in os.listdir(data_folder):
+    # the files are parsed and written one by one as they become available
+    for data_file, content in timed_iter(data_files, JOB, "download"):
+        started = time.perf_counter()
+        data_file = os.path.basename(data_file)
         wsi = data_file.removeprefix(f"{measurement_type}-").removesuffix(
             f"-{year}{month:02d}.json"
         )
-        ws_db = session.scalar(select(WeatherStation).where(WeatherStation.wsi == wsi))
+        station = station_index.get(wsi)
         # if the current weather station is not in the db, don't write any data
-        if not ws_db:
+        if not station:
+            FILES.inc(job=JOB, status="unknown_station")
             continue
-        gh_id = ws_db.gh_id
-        with open(f"{data_folder}/{data_file}", "r", encoding="utf-8") as file:
-            data = json.load(file)
-        values = data["data"]["data"]["values"]
-        data_to_write = []
-        for value in values:
-            if measurement:
-                if (
-                    value[-1] == 0.0
-                    and type(value[-3]) == float
-                    and measurement == value[1]
-                ):
-                    dt = datetime.strptime(value[-4], "%Y-%m-%dT%H:%M:%SZ").replace(
-                        tzinfo=timezone.utc
-                    )
-                    data_to_write.append(
-                        {
-                            "measurement": value[1],
-                            "fields": {gh_id: value[-3]},
-                            # time in nanoseconds for efficiency
-                            "time": int(dt.timestamp() * 1e9),
-                        },
-                    )
-            else:
-                if value[-1] == 0.0 and type(value[-3]) == float:
-                    dt = datetime.strptime(value[-4], "%Y-%m-%dT%H:%M:%SZ").replace(
-                        tzinfo=timezone.utc
-                    )
-                    data_to_write.append(
-                        {
-                            "measurement": value[1],
-                            "fields": {gh_id: value[-3]},
-                            # time in nanoseconds for efficiency
-                            "time": int(dt.timestamp() * 1e9),
-                        },
-                    )
-        # must write in ns
-        write_api.write(bucket="chmi_data", record=data_to_write, write_precision="ns")
-    logger.info("Disconnecting from the DBs...")
-    write_api.close()
+        gh_id = station.gh_id
+        if manifest is not None:
+            file_hash = content_hash(content)
+            if manifest.is_unchanged(wsi, file_hash):
+                skipped += 1
+                FILES.inc(job=JOB, status="skipped")
+                continue
+        # the file is parsed in chunks, the values are never all held as lists
+        chunks = timed_iter(iter_station_values(content), JOB, "decode")
+        if manifest is not None:
+            # the manifest compares whole measurements, the columns are joined
+            chunks = [concat_station_values(list(chunks))]
+        for station_values in chunks:
+            with stage(JOB, "filter"):
+                mask = station_values.mask(measurement=measurement)
+                if manifest is not None:
+                    mask = manifest.update(wsi, file_hash, station_values, mask)
+            with stage(JOB, "write"):
+                write_station_values(
+                    write_api,
+                    gh_id,
+                    station_values,
+                    mask,
+                    aggregator,
+                    measurement_suffix=suffix,
+                )
+            selected = int(mask.sum())
+            ROWS_PARSED.inc(len(station_values), job=JOB)
+            ROWS_FILTERED.inc(len(station_values) - selected, job=JOB)
+            POINTS_WRITTEN.inc(selected, job=JOB)
+            written += selected
+        FILES.inc(job=JOB, status="processed")
+        elapsed = time.perf_counter() - started
+        FILE_SECONDS.observe(elapsed, job=JOB)
+        if utilization is not None:
+            utilization.add("writer", elapsed, len(content))
+    with stage(JOB, "flush"):
+        if aggregator is not None:
+            logger.info(f"Writing {len(aggregator)} values as wide points...")
+            write_api.write(
+                bucket="chmi_data", record=aggregator.flush(), write_precision="ns"
+            )
+        logger.info("Disconnecting from the DBs...")
+        if own_write_api:
+            write_api.close()
     client.close()
     session.close()
     engine.dispose()
     logger.info("Connection closed.")
+    # the manifest is saved only after all the data was flushed and written,
+    # the write API of the caller is checked for the batches it already sent,
+    # the caller checks the rest after closing it
+    check_written(failed)
+    if manifest is not None:
+        manifest.save()
+        logger.info(f"Skipped {skipped} unchanged station files.")
+    return written
+
+
+def write_single_month_data(
+    data_folder,
+    year,
+    month,
+    delete_bucket_data: bool = True,
+    measurement: str = None,
+    measurement_type: str = "10m",
+    incremental: bool = False,
+    write_api=None,
+) -> int:
+    return write_month_files(
+        read_data_files(data_folder),
+        year,
+        month,
+        delete_bucket_data,
+        measurement,
+        measurement_type,
+        incremental,
+        write_api,
+    )
 
 
 def write_last_month_data(
@@ -150,46 +242,64 @@ def write_last_month_data(
     measurement_type: str = "10m",
     delete_bucket_data: bool = True,
     measurement: str = None,
-):
+    incremental: bool = False,
+) -> dict | None:
+    """Write the last month of a measurement folder while it is downloaded.
+
+    Returns:
+        dict | None: Utilization of the download threads and of the writer,
+            None if the data is not ready.
+    """
     logger.info("Checking the CHMI data...")
-    last_month_folder = config.get("folders", "last_month_folder")
-    if os.path.exists(last_month_folder):
-        shutil.rmtree(last_month_folder)
-    os.makedirs(last_month_folder, exist_ok=True)
     last_month_dt = datetime.now(tz=timezone.utc) - relativedelta(months=1)
     # define remote folder
     year = last_month_dt.year
     month = last_month_dt.month
     remote_folder = config.get("folders", "chmi_data_folder")
     remote_folder = f"{remote_folder}{measurement_folder}/{month:02d}/"
-    file_urls = get_data_urls(remote_folder, measurement_type)
-    for file_url in file_urls:
-        if not f"{year}{month:02d}" in file_url:
+    with stage(JOB, "listing"):
+        entries = get_data_files(remote_folder, measurement_type)
+    for entry in entries:
+        if entry.date != f"{year}{month:02d}":
             logger.info("Data is not ready")
-            return
-    logger.info("Downloading data from CHMI...")
-    for file_url in file_urls:
-        download_file(file_url, last_month_folder)
-    # write the last month data
-    write_single_month_data(
-        last_month_folder,
+            return None
+    size = sum(entry.size or 0 for entry in entries)
+    logger.info(
+        f"Downloading and writing {len(entries)} files ({size / 1e6:.1f} MB) "
+        "from CHMI..."
+    )
+    # the largest files are downloaded and written first, the end of the job is
+    # not spent waiting for a single large file
+    file_urls = [entry.url for entry in largest_first(entries, lambda e: e.size)]
+    utilization = WorkerUtilization()
+    # write the last month data while it is being downloaded
+    write_month_files(
+        iter_downloads(file_urls, cache=get_http_cache(), utilization=utilization),
         year,
         month,
         delete_bucket_data,
         measurement,
         measurement_type,
+        incremental,
+        utilization=utilization,
     )
-    # cleanup
-    logger.info("Cleaning up the folder...")
-    shutil.rmtree(last_month_folder)
     logger.info("Writing finished successfully.")
+    return utilization.summary()
 
 
 def main():
+    start_metrics_server()
     try:
-        write_last_month_data("10min", "10m", True)
-        # write also daily rainfall
-        write_last_month_data("daily", "dly", False, "SRA")
+        with job_metrics(JOB, logger) as summary:
+            summary["workers"] = {}
+            # the month is reconciled instead of being deleted and written again
+            summary["workers"]["10m"] = write_last_month_data(
+                "10min", "10m", False, incremental=True
+            )
+            # write also daily rainfall
+            summary["workers"]["dly"] = write_last_month_data(
+                "daily", "dly", False, "SRA", incremental=True
+            )
     except Exception as e:
         logger.error(f"Error during data writing: {e}", exc_info=True)
 
@@ -2,19 +2,43 @@ import json
 import logging
 import os
 import shutil
+import time
 from datetime import datetime, timedelta, timezone
 
-import requests
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
 from dateutil.relativedelta import relativedelta
-from influxdb_client import InfluxDBClient, WriteOptions
-from sqlalchemy import create_engine, select
+from influxdb_client import InfluxDBClient
 from sqlalchemy.orm import Session
 
-from config import DB_CONNECTION_STRING, config
-from parsing_tools import process_metadata
-from ws_db_models import Measurement1H, Measurement10M, MeasurementDLY, WeatherStation
+from async_writer import check_written, create_write_api, failed_records
+from config import config
+from downloader import download_files, iter_downloads
+from http_cache import StagedCache, get_http_cache
+from line_protocol import (
+    MEASUREMENT_SUFFIXES,
+    WIDE_POINTS,
+    WidePointAggregator,
+    write_station_values,
+)
+from listing import ListingEntry, changed_entries, list_folder
+from metadata_db import create_metadata_engine
+from metadata_sync import sync_metadata
+from metrics import (
+    FILE_SECONDS,
+    FILES,
+    POINTS_WRITTEN,
+    ROWS_FILTERED,
+    ROWS_PARSED,
+    job_metrics,
+    stage,
+    start_metrics_server,
+    timed_iter,
+)
+from parsing_tools import iter_station_values, process_metadata
+from station_index import get_station_index, refresh_station_index
+from watermarks import HighWaterMarks
 
 # logging setup
 logger = logging.getLogger("realtime_logger")
@@ -24,6 +48,41 @@ file_handler.setFormatter(
     logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 )
 logger.addHandler(file_handler)
+# the shared modules log into the same file
+logging.getLogger("chmi").setLevel(logging.INFO)
+logging.getLogger("chmi").addHandler(file_handler)
+
+# job name in the metrics
+JOB = "realtime"
+
+# the maximum time the writer catches up after a downtime
+MAX_CATCHUP = timedelta(
+    hours=config.getint("realtime", "max_catchup_hours", fallback=72)
+)
+
+# write only the verified values (zero quality flag), by default all the values
+# of the window are written and the month reconcile writes the verified ones
+VERIFIED_ONLY = config.getboolean("realtime", "verified_only", fallback=False)
+
+# measurement type (file prefix) -> (measurement filter, default window in hours)
+# the window applies to the stations and measurements without a high-water mark
+REALTIME_RESOLUTIONS = {
+    "10m": (None, 1),
+    "1h": (None, 3),
+    # only the daily rainfall is written, like in the monthly job
+    "dly": ("SRA", 48),
+}
+# measurement types ingested by the realtime writer
+RESOLUTIONS = [
+    measurement_type.strip()
+    for measurement_type in config.get(
+        "realtime", "resolutions", fallback=", ".join(REALTIME_RESOLUTIONS)
+    ).split(",")
+    if measurement_type.strip()
+]
+for measurement_type in RESOLUTIONS:
+    if measurement_type not in REALTIME_RESOLUTIONS:
+        raise ValueError(f"Unknown realtime resolution: {measurement_type}")
 
 
 def get_utc_date() -> str:
@@ -38,149 +97,53 @@ def get_utc_date() -> str:
     return now.date().strftime("%Y%m%d")
 
 
-def get_data_urls(folder_url: str, measurement_type: str = "10m") -> list[str]:
-    current_date = get_utc_date()
-    response = requests.get(folder_url)
-    if response.status_code == 200:
-        html_text = response.text
-        file_urls = [
-            folder_url + line.split('"')[1]
-            for line in html_text.splitlines()
-            if ".json" in line
-            and 'href="' in line
-            and measurement_type in line
-            and current_date in line
-        ]
-        return file_urls
-    else:
-        logger.warning(f"Failed to access folder {folder_url}: {response.status_code}")
-        return []
+def get_catchup_dates(
+    watermarks: HighWaterMarks,
+    start_time: datetime,
+    measurement_type: str | None = None,
+) -> list[str]:
+    """Get the dates of the data files needed to catch up with the high-water marks.
 
+    Args:
+        watermarks (HighWaterMarks): High-water marks of the previous runs.
+        start_time (datetime): Start of the default window of stations without marks.
+        measurement_type (str | None): Catch up only with the marks of this
+            measurement type, with all marks if None.
 
-def get_metadata_urls(folder_url: str) -> list[str]:
-    response = requests.get(folder_url)
-    if response.status_code == 200:
-        html_text = response.text
-        return [
-            folder_url + line.split('"')[1]
-            for line in html_text.splitlines()
-            if ".json" in line and 'href="' in line
-        ]
-    else:
-        logger.warning(f"Failed to access folder {folder_url}: {response.status_code}")
-        return []
-
-
-def download_file(file_url: str, data_folder: str) -> None:
-    local_file_path = os.path.join(data_folder, os.path.basename(file_url))
-    response = requests.get(file_url, stream=True)
-    if response.status_code == 200:
-        with open(local_file_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
-    else:
-        logger.warning(f"Failed to download {file_url}: {response.status_code}")
-
-
-def update_measurements_db(
-    session: Session,
-    measurements: list[list],
-    measurement_type: Measurement10M | Measurement1H | MeasurementDLY,
-) -> None:
-    logger.info(f"Updating the {measurement_type.__tablename__} table...")
-    for measurement in measurements:
-        measurement_db = session.scalar(
-            select(measurement_type).where(
-                measurement_type.abbreviation == measurement[0]
-            )
-        )
-        if not measurement_db:
-            measurement_db = measurement_type(
-                abbreviation=measurement[0], name=measurement[1], unit=measurement[2]
-            )
-            logger.info(f"Created new measurement named: {measurement[1]}")
-
-
-def update_ws_measurements(
-    session: Session,
-    ws: WeatherStation,
-    measurement_list: list[list],
-    measurement_type: Measurement10M | Measurement1H | MeasurementDLY,
-) -> None:
-    for measurement in measurement_list:
-        measurement_db = session.scalar(
-            select(measurement_type).where(
-                measurement_type.abbreviation == measurement[0]
-            )
-        )
-        if measurement_db and measurement_type == Measurement10M:
-            if measurement_db in ws.measurements_10m:
-                continue
-            else:
-                ws.measurements_10m.append(measurement_db)
-                logger.info(
-                    f"Updated 10m measurements of the weather station: {ws.full_name}"
-                )
-        elif measurement_db and measurement_type == Measurement1H:
-            if measurement_db in ws.measurements_1h:
-                continue
-            else:
-                ws.measurements_1h.append(measurement_db)
-                logger.info(
-                    f"Updated 1h measurements of the weather station: {ws.full_name}"
-                )
-        elif measurement_db and measurement_type == MeasurementDLY:
-            if measurement_db in ws.measurements_dly:
-                continue
-            else:
-                ws.measurements_dly.append(measurement_db)
-                logger.info(
-                    f"Updated dly measurements of the weather station: {ws.full_name}"
-                )
+    Returns:
+        list[str]: Date strings in the YYYYMMDD format, from the oldest to today.
+    """
+    now = datetime.now(timezone.utc)
+    oldest = watermarks.oldest(measurement_type)
+    if oldest is not None:
+        oldest_time = datetime.fromtimestamp(oldest / 1e9, tz=timezone.utc)
+        start_time = min(start_time, max(oldest_time, now - MAX_CATCHUP))
+    dates = []
+    date = start_time.date()
+    while date <= now.date():
+        dates.append(date.strftime("%Y%m%d"))
+        date += timedelta(days=1)
+    return dates
 
 
-def update_weather_stations_db(session: Session, weather_stations: dict):
-    logger.info(f"Updating the weather_stations table...")
-    for wsi in weather_stations:
-        weather_station = weather_stations[wsi]
-        has_10m = "10M" in weather_station
-        has_1h = "1H" in weather_station
-        has_dly = "DLY" in weather_station
-        has_measurements = has_10m or has_1h or has_dly
-        if has_measurements:
-            # try to find existing weather station
-            weather_station_db = session.scalar(
-                select(WeatherStation).where(WeatherStation.wsi == wsi)
-            )
-            # if it does not exist, create it in the db
-            if not weather_station_db:
-                weather_station_db = WeatherStation(
-                    wsi=wsi,
-                    gh_id=weather_station["GH_ID"],
-                    full_name=weather_station["FULL_NAME"],
-                    X=weather_station["GEOGR1"],
-                    Y=weather_station["GEOGR2"],
-                    elevation=weather_station["ELEVATION"],
-                )
-                session.add(weather_station_db)
-                logger.info(
-                    f"Created new weather station named: {weather_station_db.full_name}"
-                )
-            # if the ws has 10m measurements, update them
-            if has_10m:
-                update_ws_measurements(
-                    session, weather_station_db, weather_station["10M"], Measurement10M
-                )
-            # if the ws has 1h measurements, update them
-            if has_1h:
-                update_ws_measurements(
-                    session, weather_station_db, weather_station["1H"], Measurement1H
-                )
-            # if the ws has dly measurements, update them
-            if has_dly:
-                update_ws_measurements(
-                    session, weather_station_db, weather_station["DLY"], MeasurementDLY
-                )
+def get_window_start(utc_now: datetime, hours: int) -> datetime:
+    """Get the start of a window of the given hours, at the hour mark."""
+    start_time = utc_now - timedelta(hours=hours)
+    return start_time.replace(minute=0, second=0, microsecond=0)
+
+
+def get_data_files(
+    folder_url: str,
+    measurement_type: str | tuple[str, ...] = "10m",
+    dates: list[str] | None = None,
+) -> list[ListingEntry]:
+    dates = dates or [get_utc_date()]
+    # a single scan of the listing for all the measurement types and dates
+    return list_folder(folder_url, measurement_type, dates=dates)
+
+
+def get_metadata_urls(folder_url: str) -> list[str]:
+    return [entry.url for entry in list_folder(folder_url)]
 
 
 def update_metadata(session: Session) -> None:
@@ -200,110 +163,207 @@ def update_metadata(session: Session) -> None:
             logger.info(f"CHMI metadata was not ready.")
             return
     # download the metadata files
-    for file_url in file_urls:
-        download_file(file_url, local_folder)
+    download_files(file_urls, local_folder, cache=get_http_cache())
     ws_dict, m10, m1h, mdly = process_metadata(local_folder, year, month)
-    # this will add potential new measurements to the db
-    update_measurements_db(session, m10, Measurement10M)
-    update_measurements_db(session, m1h, Measurement1H)
-    update_measurements_db(session, mdly, MeasurementDLY)
-    # this will update the weather stations and their measurements
-    update_weather_stations_db(session, ws_dict)
+    # add the new weather stations, measurements and their links in bulk
+    sync_metadata(session, ws_dict, m10, m1h, mdly)
     # commit the potential changes
     session.commit()
+    # the new station index replaces the old one only when it is loaded
+    refresh_station_index(session)
     logger.info(f"DB update complete.")
 
 
-def write_latest_data() -> None:
+def refresh_metadata() -> None:
+    """Update the metadata db, runs separately from the realtime writer."""
+    try:
+        engine = create_metadata_engine()
+        with Session(engine) as session:
+            update_metadata(session)
+        engine.dispose()
+    except Exception as e:
+        logger.error(f"Error in metadata refresh: {e}", exc_info=True)
+
+
+def _write_latest_data(cache: StagedCache | None) -> None:
+    logger.info("Connecting to the DBs...")
+    # influxdb connection
+    client = InfluxDBClient(
+        url=config.get("influxdb", "url"),
+        token=config.get("influxdb", "token"),
+        org="vut",
+    )
+    write_api = create_write_api(client)
+    failed = failed_records()
+    # metadata db connection
+    engine = create_metadata_engine()
+    session = Session(engine)
     try:
-        logger.info("Connecting to the DBs...")
-        # influxdb connection
-        client = InfluxDBClient(
-            url=config.get("influxdb", "url"),
-            token=config.get("influxdb", "token"),
-            org="vut",
-        )
-        write_api = client.write_api(write_options=WriteOptions(batch_size=5000))
-        # mariadb connection
-        engine = create_engine(DB_CONNECTION_STRING)
-        session = Session(engine)
         # utc now date
         utc_now = datetime.now(timezone.utc)
-        # subtract one hour from current utc time
-        start_time = utc_now - timedelta(hours=1)
-        # start at the hour mark
-        start_time = start_time.replace(minute=0, second=0, microsecond=0)
-        # set the end time (HH:50)
-        end_time = start_time + timedelta(minutes=50)
-        # update the mariadb once a month (15th day between 02:00 and 03:00)
-        if utc_now.day == 15 and utc_now.hour == 2:
-            update_metadata(session)
+        # every resolution has its own window, e.g. the previous hour of the 10m
+        # data and the previous days of the daily data
+        start_times = {
+            measurement_type: get_window_start(
+                utc_now,
+                config.getint(
+                    "realtime",
+                    f"window_{measurement_type}_hours",
+                    fallback=REALTIME_RESOLUTIONS[measurement_type][1],
+                ),
+            )
+            for measurement_type in RESOLUTIONS
+        }
+        default_starts = {
+            measurement_type: int(start_time.timestamp() * 1e9)
+            for measurement_type, start_time in start_times.items()
+        }
+        # only the values newer than the high-water marks are written
+        watermarks = HighWaterMarks()
+        # all weather stations are resolved from memory instead of per-file queries
+        with stage(JOB, "lookup"):
+            station_index = get_station_index(session)
 
-        # delete the realtime folder and its contents
-        realtime_folder = config.get("folders", "realtime_folder")
-        if os.path.exists(realtime_folder):
-            shutil.rmtree(realtime_folder)
-        # create it again
-        os.makedirs(realtime_folder, exist_ok=True)
-        # get the file urls to download
-        file_urls = get_data_urls(config.get("folders", "chmi_now_folder"))
-        logger.info("Downloading latest data from CHMI...")
-        for file_url in file_urls:
-            download_file(file_url, realtime_folder)
-        data_files = os.listdir(realtime_folder)
-        logger.info(f"Parsing data from {len(data_files)} weather stations.")
-        for data_file in data_files:
-            # sometimes the json cannot be opened
+        # get the file urls of all the resolutions to download
+        # the files of older days are needed to catch up after a downtime, every
+        # resolution needs only the days of its own window and marks
+        dates = {
+            measurement_type: get_catchup_dates(
+                watermarks, start_time, measurement_type
+            )
+            for measurement_type, start_time in start_times.items()
+        }
+        now_folder = config.get("folders", "chmi_now_folder")
+        with stage(JOB, "listing"):
+            entries = get_data_files(
+                now_folder, tuple(RESOLUTIONS), sorted(set().union(*dates.values()))
+            )
+        entries = [
+            entry for entry in entries if entry.date in dates[entry.measurement_type]
+        ]
+        # the files with the size and time of their cached copy are not requested
+        changed = changed_entries(entries, cache)
+        FILES.inc(len(entries) - len(changed), job=JOB, status="skipped")
+        file_urls = [entry.url for entry in changed]
+        size = sum(entry.size or 0 for entry in changed)
+        logger.info(
+            f"Downloading and parsing data from {len(file_urls)} files "
+            f"({size / 1e6:.1f} MB)..."
+        )
+        # optionally merge the values of all stations into wide points
+        aggregator = WidePointAggregator() if WIDE_POINTS else None
+        # each file is parsed and written as soon as its download completes
+        # the files that did not change since the last run are skipped
+        downloads = iter_downloads(file_urls, cache=cache, skip_unchanged=True)
+        for file_url, content in timed_iter(downloads, JOB, "download"):
+            started = time.perf_counter()
+            data_file = os.path.basename(file_url)
+            # get the measurement type and weather station id (WSI)
+            # from <type>-<WSI>-<YYYYMMDD>.json
+            measurement_type, name = data_file.split("-", 1)
+            wsi = name.rsplit("-", 1)[0]
+            station = station_index.get(wsi)
+            # if the current weather station is not in the db, don't write any data
+            if not station:
+                FILES.inc(job=JOB, status="unknown_station")
+                continue
+            gh_id = station.gh_id
+            key = f"{measurement_type}-{wsi}"
+            measurement = REALTIME_RESOLUTIONS[measurement_type][0]
+            suffix = MEASUREMENT_SUFFIXES.get(measurement_type, "")
+            # the file is parsed in chunks, sometimes the json cannot be opened
             try:
-                with open(
-                    os.path.join(realtime_folder, data_file), "r", encoding="utf-8"
-                ) as file:
-                    data = json.load(file)
+                chunks = iter_station_values(content)
+                for station_values in timed_iter(chunks, JOB, "decode"):
+                    with stage(JOB, "filter"):
+                        # get the values that were not written yet (without a mark
+                        # the values of the window of the resolution)
+                        mask = station_values.mask(
+                            measurement=measurement, valid_only=VERIFIED_ONLY
+                        ) & watermarks.newer(
+                            key,
+                            station_values.measurements,
+                            station_values.times,
+                            default_starts[measurement_type],
+                        )
+                        measurements, _, times = station_values.select(mask)
+                        watermarks.update(key, measurements, times)
+                    with stage(JOB, "write"):
+                        write_station_values(
+                            write_api,
+                            gh_id,
+                            station_values,
+                            mask,
+                            aggregator,
+                            measurement_suffix=suffix,
+                        )
+                    selected = len(times)
+                    ROWS_PARSED.inc(len(station_values), job=JOB)
+                    ROWS_FILTERED.inc(len(station_values) - selected, job=JOB)
+                    POINTS_WRITTEN.inc(selected, job=JOB)
             except json.JSONDecodeError:
                 logger.error(f"Could not decode file: {data_file}, skipping...")
+                FILES.inc(job=JOB, status="failed")
                 continue
-            date_string = start_time.strftime("%Y%m%d")
-            # get current weather station id (WSI)
-            wsi = data_file.removeprefix("10m-").removesuffix(f"-{date_string}.json")
-            ws_db = session.scalar(
-                select(WeatherStation).where(WeatherStation.wsi == wsi)
-            )
-            # if the current weather station is not in the db, don't write any data
-            if not ws_db:
-                continue
-            gh_id = ws_db.gh_id
-            values = data["data"]["data"]["values"]
-            data_to_write = []
-            for value in values:
-                dt = datetime.strptime(value[-4], "%Y-%m-%dT%H:%M:%SZ").replace(
-                    tzinfo=timezone.utc
+            FILES.inc(job=JOB, status="processed")
+            FILE_SECONDS.observe(time.perf_counter() - started, job=JOB)
+        if aggregator is not None:
+            with stage(JOB, "flush"):
+                logger.info(f"Writing {len(aggregator)} values as wide points...")
+                write_api.write(
+                    bucket="chmi_data",
+                    record=aggregator.flush(),
+                    write_precision="ns",
                 )
-                # get the last hour data only (typically 6 values for each measurement)
-                if type(value[-3]) == float and dt >= start_time and dt <= end_time:
-                    data_to_write.append(
-                        {
-                            "measurement": value[1],
-                            "fields": {gh_id: value[-3]},
-                            "time": int(dt.timestamp() * 1e9),
-                        },
-                    )
-            write_api.write(
-                bucket="chmi_data", record=data_to_write, write_precision="ns"
-            )
-        logger.info("Disconnecting from the DBs...")
-        write_api.close()
-        client.close()
-        session.close()
-        engine.dispose()
-        logger.info("Connection closed.")
+    finally:
+        # the connections are closed also when the job or the write API fails
+        try:
+            with stage(JOB, "flush"):
+                logger.info("Disconnecting from the DBs...")
+                write_api.close()
+        finally:
+            client.close()
+            session.close()
+            engine.dispose()
+            logger.info("Connection closed.")
+    # the marks are saved only after all the data was flushed and written
+    check_written(failed)
+    # the marks older than the catch-up range are never used again
+    dropped = watermarks.prune(int((utc_now - MAX_CATCHUP).timestamp() * 1e9))
+    if dropped:
+        logger.info(f"Dropped {dropped} high-water marks older than the catch-up.")
+    watermarks.save()
+    # the downloaded files count as processed only from now on
+    if cache is not None:
+        cache.commit()
+
+
+def write_latest_data() -> None:
+    # the new downloads replace their cached copies only when the job succeeds,
+    # otherwise the next run downloads and writes the files again
+    http_cache = get_http_cache()
+    cache = StagedCache(http_cache) if http_cache is not None else None
+    try:
+        with job_metrics(JOB, logger):
+            _write_latest_data(cache)
     except Exception as e:
         logger.error(f"Error in job execution: {e}", exc_info=True)
+    finally:
+        if cache is not None:
+            cache.discard()
 
 
 def main():
     logger.info("CHMI InfluxDB writer started.")
+    start_metrics_server()
     logger.info("Starting scheduler...")
-    scheduler = BlockingScheduler()
+    # the metadata refresh has its own executor, so it never delays the data
+    scheduler = BlockingScheduler(
+        executors={
+            "default": ThreadPoolExecutor(1),
+            "metadata": ThreadPoolExecutor(1),
+        }
+    )
     scheduler.add_job(
         write_latest_data,
         trigger=CronTrigger(minute=30, timezone=timezone.utc),
@@ -311,6 +371,15 @@ def main():
         replace_existing=True,
         misfire_grace_time=300,
     )
+    # update the metadata db once a month (15th day at 02:00)
+    scheduler.add_job(
+        refresh_metadata,
+        trigger=CronTrigger(day=15, hour=2, timezone=timezone.utc),
+        id="metadata_refresh",
+        executor="metadata",
+        replace_existing=True,
+        misfire_grace_time=3600,
+    )
     try:
         logger.info("Scheduler started. Press Ctrl+C to exit.")
         scheduler.start()
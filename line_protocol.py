@@ -0,0 +1,278 @@
+import math
+from collections.abc import Iterable
+
+import numpy as np
+
+from config import config
+
+# direct InfluxDB line protocol encoder for the CHMI station values
+# the output matches the serialization of the influxdb-client dict points
+
+# the old dict points can be used instead for comparison
+USE_LINE_PROTOCOL = config.getboolean("influxdb", "line_protocol", fallback=True)
+# merge the values of all stations into one line per measurement and time
+WIDE_POINTS = config.getboolean("influxdb", "wide_points", fallback=False)
+# maximum number of station fields in a single wide line
+MAX_FIELDS = config.getint("influxdb", "max_fields", fallback=200)
+# the wide points are written whenever this many values are collected, so a
+# job never holds all its values (and their lines) in memory
+MAX_WIDE_VALUES = config.getint("influxdb", "max_wide_values", fallback=500_000)
+# measurement type -> suffix of the written measurement names, the hourly files
+# repeat the elements of the 10m files at the full hours, e.g. T is written as
+# T_1h, so the hourly values never overwrite the 10m ones
+MEASUREMENT_SUFFIXES = {"1h": "_1h"}
+
+_ESCAPE_MEASUREMENT = str.maketrans(
+    {",": r"\,", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"}
+)
+_ESCAPE_KEY = str.maketrans(
+    {",": r"\,", "=": r"\=", " ": r"\ ", "\n": r"\n", "\t": r"\t", "\r": r"\r"}
+)
+# nanoseconds in one unit of the write precision
+PRECISION_DIVISORS = {"ns": 1, "us": 1_000, "ms": 1_000_000, "s": 1_000_000_000}
+
+
+def escape_measurement(measurement: str) -> str:
+    return measurement.translate(_ESCAPE_MEASUREMENT)
+
+
+def escape_key(key: str) -> str:
+    return key.translate(_ESCAPE_KEY)
+
+
+def format_float(value: float) -> str | None:
+    """Format a float field value the same way as the influxdb-client.
+
+    Returns:
+        str | None: Formatted value or None for values InfluxDB cannot store.
+    """
+    if not math.isfinite(value):
+        return None
+    s = str(value)
+    # whole numbers are written without the trailing ".0"
+    if s.endswith(".0"):
+        s = s[:-2]
+    return s
+
+
+def encode_station(
+    gh_id: str,
+    rows: Iterable[tuple[str, float, int]],
+    precision: str = "ns",
+) -> list[bytes]:
+    """Encode the values of a single weather station into line protocol.
+
+    Args:
+        gh_id (str): GH_ID of the weather station, used as the field key.
+        rows (Iterable[tuple[str, float, int]]): Measurement, value and time in ns.
+        precision (str): Write precision of the timestamps (ns, us, ms or s).
+
+    Returns:
+        list[bytes]: One line protocol line per value.
+    """
+    divisor = PRECISION_DIVISORS[precision]
+    field_key = escape_key(gh_id)
+    # measurement -> "measurement field_key="
+    prefixes = {}
+    lines = []
+    for measurement, value, time_ns in rows:
+        s = format_float(value)
+        if s is None:
+            continue
+        prefix = prefixes.get(measurement)
+        if prefix is None:
+            prefix = prefixes[measurement] = (
+                f"{escape_measurement(measurement)} {field_key}="
+            )
+        lines.append(f"{prefix}{s} {time_ns // divisor}".encode())
+    return lines
+
+
+def station_points(gh_id: str, rows: Iterable[tuple[str, float, int]]) -> list[dict]:
+    """Create the influxdb-client dict points of a single weather station.
+
+    Args:
+        gh_id (str): GH_ID of the weather station, used as the field key.
+        rows (Iterable[tuple[str, float, int]]): Measurement, value and time in ns.
+
+    Returns:
+        list[dict]: One point per value, the time is in ns.
+    """
+    return [
+        {"measurement": measurement, "fields": {gh_id: value}, "time": time_ns}
+        for measurement, value, time_ns in rows
+    ]
+
+
+def station_records(
+    gh_id: str, rows: Iterable[tuple[str, float, int]]
+) -> list[bytes] | list[dict]:
+    """Create the records of a single weather station for write_api.write in ns."""
+    if USE_LINE_PROTOCOL:
+        return encode_station(gh_id, rows)
+    return station_points(gh_id, rows)
+
+
+def write_station_values(
+    write_api,
+    gh_id: str,
+    station_values,
+    mask: np.ndarray,
+    aggregator: "WidePointAggregator | None" = None,
+    bucket: str = "chmi_data",
+    measurement_suffix: str = "",
+) -> None:
+    """Write the selected values of a station or add them to the aggregator.
+
+    Args:
+        write_api: InfluxDB write API.
+        gh_id (str): GH_ID of the weather station, used as the field key.
+        station_values (StationValues): Parsed values of the station.
+        mask (np.ndarray): Values selected to be written.
+        aggregator (WidePointAggregator | None): Aggregator of the wide points.
+        bucket (str): Destination bucket.
+        measurement_suffix (str): Suffix of the written measurement names, see
+            MEASUREMENT_SUFFIXES.
+    """
+    if aggregator is not None:
+        measurements, values, times = station_values.select(mask)
+        if measurement_suffix:
+            measurements = measurements + measurement_suffix
+        aggregator.add(gh_id, measurements, values, times)
+        if aggregator.is_full():
+            write_api.write(
+                bucket=bucket, record=aggregator.flush(), write_precision="ns"
+            )
+        return
+    rows = station_values.rows(mask)
+    if measurement_suffix:
+        rows = (
+            (measurement + measurement_suffix, value, time_ns)
+            for measurement, value, time_ns in rows
+        )
+    # must write in ns
+    write_api.write(
+        bucket=bucket,
+        record=station_records(gh_id, rows),
+        write_precision="ns",
+    )
+
+
+class WidePointAggregator:
+    """Merge the values of many weather stations into wide points.
+
+    All stations reporting the same measurement at the same time end up in a
+    single line with one field per GH_ID (at most max_fields fields per line).
+    InfluxDB stores exactly the same series and values as with one point per
+    station, the values are only sent in far fewer lines.
+
+    The collected values are flushed in batches of about max_values values.
+    The lines of the same measurement and time from different batches carry
+    different fields, InfluxDB merges them into the same points.
+    """
+
+    def __init__(
+        self, max_fields: int = MAX_FIELDS, max_values: int = MAX_WIDE_VALUES
+    ) -> None:
+        self.max_fields = max_fields
+        self.max_values = max_values
+        self.gh_ids = []
+        # GH_ID -> index in gh_ids
+        self._stations = {}
+        self._chunks = []
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def is_full(self) -> bool:
+        return self._size >= self.max_values
+
+    def flush(self, precision: str = "ns") -> list[bytes]:
+        """Encode the collected values into line protocol and drop them."""
+        lines = self.lines(precision)
+        self._chunks = []
+        self._size = 0
+        return lines
+
+    def add(
+        self,
+        gh_id: str,
+        measurements: np.ndarray,
+        values: np.ndarray,
+        times: np.ndarray,
+    ) -> None:
+        """Add the values (times in ns) of a single weather station."""
+        if not len(times):
+            return
+        if gh_id not in self._stations:
+            self._stations[gh_id] = len(self.gh_ids)
+            self.gh_ids.append(gh_id)
+        station = np.full(len(times), self._stations[gh_id], dtype=np.int32)
+        self._chunks.append((station, measurements, values, times))
+        self._size += len(times)
+
+    def lines(self, precision: str = "ns") -> list[bytes]:
+        """Encode the collected values into line protocol.
+
+        Args:
+            precision (str): Write precision of the timestamps (ns, us, ms or s).
+
+        Returns:
+            list[bytes]: One line per measurement, time and max_fields stations.
+        """
+        if not self._chunks:
+            return []
+        divisor = PRECISION_DIVISORS[precision]
+        stations, measurements, values, times = (
+            np.concatenate(column) for column in zip(*self._chunks)
+        )
+        finite = np.isfinite(values)
+        stations, measurements = stations[finite], measurements[finite]
+        values, times = values[finite], times[finite]
+        if not len(times):
+            return []
+        names, measurements = np.unique(measurements, return_inverse=True)
+        # the fields are sorted by their key like in the influxdb-client
+        gh_ids = np.array(self.gh_ids, dtype=object)
+        rank = np.empty(len(gh_ids), dtype=np.int64)
+        rank[np.argsort(gh_ids, kind="stable")] = np.arange(len(gh_ids))
+        station_rank = rank[stations]
+        order = np.lexsort((station_rank, times, measurements))
+        station_rank, measurements = station_rank[order], measurements[order]
+        values, times, stations = values[order], times[order], stations[order]
+        # the same station can report the same value twice, the last one is kept
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (
+            (station_rank[1:] != station_rank[:-1])
+            | (times[1:] != times[:-1])
+            | (measurements[1:] != measurements[:-1])
+        )
+        stations, measurements = stations[last], measurements[last]
+        values, times = values[last], times[last]
+        # start index of every measurement/time group
+        group_starts = np.flatnonzero(
+            np.concatenate(
+                (
+                    [True],
+                    (times[1:] != times[:-1])
+                    | (measurements[1:] != measurements[:-1]),
+                )
+            )
+        ).tolist()
+        group_starts.append(len(times))
+        field_keys = [escape_key(gh_id) for gh_id in self.gh_ids]
+        fields = [
+            f"{field_keys[station]}={format_float(value)}"
+            for station, value in zip(stations.tolist(), values.tolist())
+        ]
+        prefixes = [f"{escape_measurement(name)} " for name in names.tolist()]
+        measurements, times = measurements.tolist(), times.tolist()
+        lines = []
+        for start, end in zip(group_starts, group_starts[1:]):
+            prefix = prefixes[measurements[start]]
+            suffix = f" {times[start] // divisor}"
+            for i in range(start, end, self.max_fields):
+                line_fields = ",".join(fields[i : min(i + self.max_fields, end)])
+                lines.append(f"{prefix}{line_fields}{suffix}".encode())
+        return lines
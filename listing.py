@@ -0,0 +1,192 @@
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import urljoin
+
+from downloader import fetch_file
+from http_cache import StagedCache, get_http_cache
+
+# parser of the directory listings (autoindex pages) of the CHMI open data server
+# the names, sizes and modification times of the files are read in a single pass
+
+logger = logging.getLogger("chmi.listing")
+
+# a link followed by the modification time and size, on the same line (nginx) or
+# in the next cells of the table (apache), the time is validated when parsed
+_SEPARATOR = r"[ \t]*(?:</td><td[^>]*>[ \t]*)?"
+_ENTRY = (
+    r'<a href="((?:[^"]*/)?({name}))"[^>]*>[^<]*</a>'
+    + _SEPARATOR
+    + r"(?:([0-9][0-9A-Za-z-]{{9,10}} [0-9:]{{5,8}})"
+    + _SEPARATOR
+    + r"([0-9.]+[KMGT]?|-)?)?"
+)
+_SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+_MTIME_FORMATS = (
+    "%d-%b-%Y %H:%M",
+    "%d-%b-%Y %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+)
+
+
+@dataclass
+class ListingEntry:
+    name: str
+    url: str
+    # size in bytes, approximate for the sizes shown with a unit (1.4M)
+    size: int | None
+    # modification time shown in the listing, UTC with a minute precision
+    mtime: datetime | None
+    # parts of the name <type>-<WSI>-<date>.json, the metadata files have no WSI
+    measurement_type: str
+    wsi: str | None
+    date: str
+
+
+def _alternatives(values, default: str) -> str:
+    if not values:
+        return default
+    if isinstance(values, str):
+        values = (values,)
+    return "|".join(map(re.escape, values))
+
+
+def file_pattern(
+    measurement_types: str | tuple[str, ...] | list[str] | None = None,
+    wsis: list[str] | None = None,
+    dates: list[str] | None = None,
+) -> re.Pattern:
+    """Compile the pattern of the file names <type>-<WSI>-<date>.json.
+
+    Args:
+        measurement_types: Allowed prefixes of the names (10m, 1h, dly, meta1),
+            all if None.
+        wsis (list[str] | None): Allowed WSI of the weather stations, all if None.
+        dates (list[str] | None): Allowed dates (YYYYMMDD or YYYYMM), all if None.
+
+    Returns:
+        re.Pattern: Pattern with the type, wsi and date groups.
+    """
+    wsi = f"(?P<wsi>{_alternatives(wsis, '[^/]+')})-"
+    return re.compile(
+        f"(?P<type>{_alternatives(measurement_types, '[A-Za-z0-9]+')})-"
+        + (wsi if wsis else f"(?:{wsi})?")
+        + f"(?P<date>{_alternatives(dates, '[0-9]{6}(?:[0-9]{2})?')})"
+        + r"\.json"
+    )
+
+
+FILE_PATTERN = file_pattern()
+
+
+@lru_cache(maxsize=64)
+def _entry_pattern(pattern: re.Pattern) -> re.Pattern:
+    # the names are matched by the scan of the page, the other links are skipped
+    return re.compile(_ENTRY.format(name=pattern.pattern))
+
+
+@lru_cache(maxsize=4096)
+def _parse_mtime(text: str) -> datetime | None:
+    # the entries of a listing share a few distinct times, they are parsed once
+    for mtime_format in _MTIME_FORMATS:
+        try:
+            return datetime.strptime(text, mtime_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_size(text: str | None) -> int | None:
+    if not text or text == "-":
+        return None
+    unit = _SIZE_UNITS.get(text[-1], 1)
+    try:
+        return int(float(text.rstrip("KMGT")) * unit)
+    except ValueError:
+        return None
+
+
+def parse_listing(
+    content: bytes | str, base_url: str = "", pattern: re.Pattern = FILE_PATTERN
+) -> list[ListingEntry]:
+    """Parse the files of a directory listing matching the pattern.
+
+    The links are found anywhere in the page, also several on a single line,
+    the links of the parent folder and of the sorting are skipped.
+
+    Args:
+        content (bytes | str): HTML of the listing.
+        base_url (str): URL of the folder the links are relative to.
+        pattern (re.Pattern): Pattern of the names from file_pattern.
+
+    Returns:
+        list[ListingEntry]: Matching files in the order of the listing.
+    """
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", errors="replace")
+    entries = []
+    for href, name, measurement_type, wsi, date, mtime, size in _entry_pattern(
+        pattern
+    ).findall(content):
+        entries.append(
+            ListingEntry(
+                name,
+                base_url + href if "/" not in href else urljoin(base_url, href),
+                int(size) if size.isdigit() else _parse_size(size),
+                _parse_mtime(mtime) if mtime else None,
+                measurement_type,
+                wsi or None,
+                date,
+            )
+        )
+    return entries
+
+
+def list_folder(
+    folder_url: str,
+    measurement_types: str | tuple[str, ...] | list[str] | None = None,
+    wsis: list[str] | None = None,
+    dates: list[str] | None = None,
+) -> list[ListingEntry]:
+    """Get the files of a remote folder filtered by their type, WSI and date.
+
+    The listing is cached as well, unchanged listings are not downloaded again.
+
+    Returns:
+        list[ListingEntry]: Matching files, empty if the folder is not available.
+    """
+    response = fetch_file(folder_url, cache=get_http_cache())
+    if response is None:
+        logger.warning(f"Failed to access folder {folder_url}")
+        return []
+    return parse_listing(
+        response.content, folder_url, file_pattern(measurement_types, wsis, dates)
+    )
+
+
+def changed_entries(
+    entries: list[ListingEntry], cache: StagedCache | None
+) -> list[ListingEntry]:
+    """Drop the files whose cached copy has the size and time of the listing.
+
+    The dropped files are not requested at all, not even revalidated. The
+    cache is the staged cache of the job, a cached copy is replaced only after
+    its values were written, so a file of a failed run is never dropped.
+    """
+    if cache is None:
+        return entries
+    changed = [
+        entry
+        for entry in entries
+        if entry.size is None
+        or entry.mtime is None
+        or not cache.is_current(entry.url, entry.size, entry.mtime)
+    ]
+    if len(changed) < len(entries):
+        logger.info(
+            f"Skipped {len(entries) - len(changed)} files unchanged in the listing."
+        )
+    return changed
@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from config import config
+from parsing_tools import StationValues
+
+# local manifest of the station data written for a single month
+# it allows rewriting only the station files and measurements that changed
+
+MANIFEST_FOLDER = config.get("folders", "manifest_folder", fallback="manifests")
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+class MonthManifest:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # wsi -> {"hash": file hash, "measurements": {measurement: summary}}
+        self.stations = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as file:
+                self.stations = json.load(file)
+
+    @classmethod
+    def for_month(
+        cls,
+        year: int,
+        month: int,
+        measurement_type: str = "10m",
+        measurement: str | None = None,
+        folder: str = MANIFEST_FOLDER,
+    ) -> "MonthManifest":
+        name = f"{measurement_type}-{year}{month:02d}"
+        # a single measurement is tracked separately from the whole files
+        if measurement:
+            name += f"-{measurement}"
+        return cls(os.path.join(folder, f"{name}.json"))
+
+    def is_unchanged(self, wsi: str, file_hash: str) -> bool:
+        return self.stations.get(wsi, {}).get("hash") == file_hash
+
+    def update(
+        self,
+        wsi: str,
+        file_hash: str,
+        station_values: StationValues,
+        mask: np.ndarray,
+    ) -> np.ndarray:
+        """Record the selected values of a station and find the ones to rewrite.
+
+        Args:
+            wsi (str): Weather station id.
+            file_hash (str): Hash of the station data file.
+            station_values (StationValues): Parsed values of the station.
+            mask (np.ndarray): Values selected to be written.
+
+        Returns:
+            np.ndarray: Mask of the selected values of the measurements that
+                are new or changed since the last run.
+        """
+        previous = self.stations.get(wsi, {}).get("measurements", {})
+        summaries = {}
+        changed = np.zeros(len(mask), dtype=bool)
+        names, codes = np.unique(station_values.measurements, return_inverse=True)
+        for code, name in enumerate(names.tolist()):
+            measurement_mask = mask & (codes == code)
+            if not measurement_mask.any():
+                continue
+            times = station_values.times[measurement_mask]
+            values = station_values.values[measurement_mask]
+            summary = {
+                "count": int(len(times)),
+                "min_time": int(times.min()),
+                "max_time": int(times.max()),
+                "hash": content_hash(times.tobytes() + values.tobytes()),
+            }
+            summaries[name] = summary
+            if previous.get(name) != summary:
+                changed |= measurement_mask
+        self.stations[wsi] = {"hash": file_hash, "measurements": summaries}
+        return changed
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self.stations, file)
+        os.replace(tmp_path, self.path)
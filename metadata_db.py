@@ -0,0 +1,138 @@
+import logging
+import os
+
+from sqlalchemy import Connection, Engine, create_engine, event, text
+from sqlalchemy.engine import make_url
+
+from config import DB_CONNECTION_STRING
+from ws_db_models import RESOLUTIONS
+
+# engine and views of the metadata db, either mariadb or a local sqlite file
+
+logger = logging.getLogger("chmi.metadata_db")
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    # readers (the writers' lookups) do not block the metadata refresh and vice versa
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # sqlite does not check the foreign keys by default
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
+
+
+def create_metadata_engine(url: str = DB_CONNECTION_STRING) -> Engine:
+    """Create the engine of the metadata db given by the connection string.
+
+    A sqlite db is opened in the WAL mode with the foreign keys enforced,
+    its folder is created when missing.
+    """
+    engine_url = make_url(url)
+    if engine_url.get_backend_name() != "sqlite":
+        return create_engine(url)
+    database = engine_url.database
+    if database and database != ":memory:":
+        folder = os.path.dirname(os.path.abspath(database))
+        os.makedirs(folder, exist_ok=True)
+    engine = create_engine(url)
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+def remove_sqlite_db(url: str) -> None:
+    """Remove a sqlite db file with its WAL files, if it exists."""
+    database = make_url(url).database
+    if not database or database == ":memory:":
+        return
+    for path in (database, f"{database}-wal", f"{database}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _create_view(conn: Connection, name: str, query: str) -> None:
+    if conn.dialect.name == "sqlite":
+        # sqlite cannot replace a view
+        conn.execute(text(f"DROP VIEW IF EXISTS {name}"))
+        conn.execute(text(f"CREATE VIEW {name} AS {query}"))
+    else:
+        conn.execute(text(f"CREATE OR REPLACE VIEW {name} AS {query}"))
+
+
+def create_views(conn: Connection) -> None:
+    """Define the SQL views of the weather stations and their measurements.
+
+    The views measurements_<resolution> and weather_station_measurements_<resolution>
+    keep the old per-resolution tables available to the existing queries.
+    """
+    dialect = conn.dialect.name
+    if dialect not in ("mysql", "mariadb", "sqlite"):
+        logger.info(f"The views are not defined for {dialect}.")
+        return
+    for resolution in RESOLUTIONS:
+        m = resolution.lower()
+        _create_view(
+            conn,
+            f"measurements_{m}",
+            f"""
+            SELECT id, abbreviation, name, unit
+            FROM measurements
+            WHERE resolution = '{resolution}'
+            """,
+        )
+        _create_view(
+            conn,
+            f"weather_station_measurements_{m}",
+            f"""
+            SELECT wsm.weather_station_id, wsm.measurement_id AS measurement_{m}_id
+            FROM weather_station_measurements wsm
+            JOIN measurements m ON wsm.measurement_id = m.id
+            WHERE m.resolution = '{resolution}'
+            """,
+        )
+        if dialect == "sqlite":
+            # group_concat of sqlite has no DISTINCT with a separator nor ORDER BY,
+            # the distinct measurements are sorted in the subquery instead
+            query = f"""
+            SELECT
+                ws.id,
+                ws.wsi,
+                ws.gh_id,
+                ws.full_name,
+                ws.X,
+                ws.Y,
+                ws.elevation,
+                GROUP_CONCAT(wsm.measurement, ', ') AS measurements_{m}
+            FROM weather_stations ws
+            JOIN (
+                SELECT DISTINCT
+                    wsm.weather_station_id,
+                    m.name,
+                    m.name || ' [' || m.unit || ']' AS measurement
+                FROM weather_station_measurements wsm
+                JOIN measurements m ON wsm.measurement_id = m.id
+                WHERE m.resolution = '{resolution}'
+                ORDER BY wsm.weather_station_id, m.name, measurement
+            ) wsm ON ws.id = wsm.weather_station_id
+            GROUP BY ws.id, ws.wsi, ws.gh_id, ws.full_name, ws.X, ws.Y, ws.elevation
+            """
+        else:
+            query = f"""
+            SELECT
+                ws.id,
+                ws.wsi,
+                ws.gh_id,
+                ws.full_name,
+                ws.X,
+                ws.Y,
+                ws.elevation,
+                GROUP_CONCAT(DISTINCT CONCAT(m.name, ' [', m.unit, ']') ORDER BY m.name SEPARATOR ', ') AS measurements_{m}
+            FROM weather_stations ws
+            JOIN weather_station_measurements wsm ON ws.id = wsm.weather_station_id
+            JOIN measurements m ON wsm.measurement_id = m.id
+            WHERE m.resolution = '{resolution}'
+            GROUP BY ws.id, ws.wsi, ws.gh_id, ws.full_name, ws.X, ws.Y, ws.elevation
+            """
+        # only the weather stations with the measurements of the resolution
+        _create_view(conn, f"show_weather_stations_{m}", query)
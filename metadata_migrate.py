@@ -0,0 +1,200 @@
+import logging
+
+from sqlalchemy import Column, Engine, Table, delete, inspect, select, text
+from sqlalchemy.orm import Session
+
+from metadata_db import create_metadata_engine, create_views
+from metadata_sync import insert_ignore
+from ws_db_models import (
+    RESOLUTIONS,
+    Base,
+    Measurement,
+    WeatherStation,
+    weather_station_measurements,
+)
+
+# migration of an existing metadata db to the current schema
+# - the measurements of the old per-resolution tables are moved to one table
+# - the duplicate rows are merged into the first one (the one .first() returned)
+# - the missing indexes and the views are created
+
+logger = logging.getLogger("chmi.metadata_migrate")
+
+
+def merge_duplicates(
+    session: Session,
+    table: Table,
+    keys: list[Column],
+    links: list[tuple[Table, Column]],
+) -> int:
+    """Merge the rows with the same keys into the row with the lowest id.
+
+    The links of the duplicate rows are moved to the kept row.
+
+    Args:
+        session (Session): Session of the metadata db.
+        table (Table): Table with the duplicate rows.
+        keys (list[Column]): Columns that should be unique together.
+        links (list[tuple[Table, Column]]): Junction tables and their columns
+            referencing the table.
+
+    Returns:
+        int: Number of the removed duplicate rows.
+    """
+    kept = {}
+    duplicates = {}
+    for row_id, *values in session.execute(
+        select(table.c.id, *keys).order_by(table.c.id)
+    ).all():
+        value = tuple(values)
+        if value in kept:
+            duplicates[row_id] = kept[value]
+        else:
+            kept[value] = row_id
+    if not duplicates:
+        return 0
+    for junction, column in links:
+        (other,) = [c for c in junction.c if c is not column]
+        rows = session.execute(
+            select(other, column).where(column.in_(duplicates))
+        ).all()
+        moved = {(other_id, duplicates[row_id]) for other_id, row_id in rows}
+        if moved:
+            session.execute(
+                insert_ignore(session, junction),
+                [
+                    {other.name: other_id, column.name: row_id}
+                    for other_id, row_id in sorted(moved)
+                ],
+            )
+        session.execute(delete(junction).where(column.in_(duplicates)))
+    session.execute(delete(table).where(table.c.id.in_(duplicates)))
+    logger.info(f"Merged {len(duplicates)} duplicate rows of {table.name}.")
+    return len(duplicates)
+
+
+def merge_resolution_tables(session: Session, tables: set[str]) -> int:
+    """Move the measurements of the old per-resolution tables to one table.
+
+    The old measurements_<resolution> and weather_station_measurements_<resolution>
+    tables are dropped, they are replaced by the compatibility views.
+
+    Args:
+        session (Session): Session of the metadata db with the new tables.
+        tables (set[str]): Names of the existing tables.
+
+    Returns:
+        int: Number of the moved measurements.
+    """
+    moved = 0
+    for resolution in RESOLUTIONS:
+        m = resolution.lower()
+        if f"measurements_{m}" not in tables:
+            continue
+        old_measurements = session.execute(
+            text(
+                f"SELECT id, abbreviation, name, unit FROM measurements_{m} "
+                "ORDER BY id"
+            )
+        ).all()
+        # the first of the duplicate abbreviations is kept
+        rows = {}
+        for _, abbreviation, name, unit in old_measurements:
+            rows.setdefault(
+                abbreviation,
+                {
+                    "resolution": resolution,
+                    "abbreviation": abbreviation,
+                    "name": name,
+                    "unit": unit,
+                },
+            )
+        if rows:
+            session.execute(
+                insert_ignore(session, Measurement.__table__), list(rows.values())
+            )
+        ids = dict(
+            session.execute(
+                select(Measurement.abbreviation, Measurement.id).where(
+                    Measurement.resolution == resolution
+                )
+            ).all()
+        )
+        new_ids = {
+            old_id: ids[abbreviation] for old_id, abbreviation, *_ in old_measurements
+        }
+        if f"weather_station_measurements_{m}" in tables:
+            old_links = session.execute(
+                text(
+                    f"SELECT weather_station_id, measurement_{m}_id "
+                    f"FROM weather_station_measurements_{m}"
+                )
+            ).all()
+            links = {(ws_id, new_ids[old_id]) for ws_id, old_id in old_links}
+            if links:
+                session.execute(
+                    insert_ignore(session, weather_station_measurements),
+                    [
+                        {"weather_station_id": ws_id, "measurement_id": m_id}
+                        for ws_id, m_id in sorted(links)
+                    ],
+                )
+            session.execute(text(f"DROP TABLE weather_station_measurements_{m}"))
+        session.execute(text(f"DROP TABLE measurements_{m}"))
+        logger.info(f"Moved {len(rows)} measurements of measurements_{m}.")
+        moved += len(rows)
+    return moved
+
+
+def migrate_metadata(engine: Engine) -> dict[str, int]:
+    """Migrate the metadata db to the current schema.
+
+    The migration can be run repeatedly, the existing indexes are kept.
+
+    Returns:
+        dict[str, int]: Numbers of the moved measurements and of the removed
+            duplicate rows.
+    """
+    # the missing tables are created with their indexes
+    Base.metadata.create_all(engine)
+    weather_stations = WeatherStation.__table__
+    measurements = Measurement.__table__
+    junction = weather_station_measurements
+    counts = {}
+    with Session(engine) as session:
+        tables = set(inspect(session.connection()).get_table_names())
+        counts["moved_measurements"] = merge_resolution_tables(session, tables)
+        counts[weather_stations.name] = merge_duplicates(
+            session,
+            weather_stations,
+            [weather_stations.c.wsi],
+            [(junction, junction.c.weather_station_id)],
+        )
+        counts[measurements.name] = merge_duplicates(
+            session,
+            measurements,
+            [measurements.c.resolution, measurements.c.abbreviation],
+            [(junction, junction.c.measurement_id)],
+        )
+        session.commit()
+    # the indexes can only be created without the duplicates
+    existing = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            names = {index["name"] for index in existing.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in names:
+                    index.create(conn)
+                    logger.info(f"Created index {index.name}.")
+        create_views(conn)
+    return counts
+
+
+def main():
+    engine = create_metadata_engine()
+    print(migrate_metadata(engine))
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
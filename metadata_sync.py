@@ -0,0 +1,195 @@
+import logging
+
+from sqlalchemy import Table, insert, select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+
+from ws_db_models import (
+    RESOLUTIONS,
+    Measurement,
+    WeatherStation,
+    weather_station_measurements,
+)
+
+# set-based sync of the processed CHMI metadata into the metadata db
+# the rows are upserted on the unique WSI and (resolution, abbreviation) columns
+
+logger = logging.getLogger("chmi.metadata_sync")
+
+
+def insert_ignore(session: Session, table: Table):
+    """Create an insert skipping the rows that already exist."""
+    dialect = session.get_bind().dialect.name
+    if dialect in ("mysql", "mariadb"):
+        return insert(table).prefix_with("IGNORE")
+    if dialect == "sqlite":
+        return insert(table).prefix_with("OR IGNORE")
+    return insert(table)
+
+
+def upsert(session: Session, table: Table, keys: list[str], columns: list[str]):
+    """Create an insert updating the columns of the rows with existing keys.
+
+    Args:
+        session (Session): Session of the metadata db.
+        table (Table): Table with a unique index on the key columns.
+        keys (list[str]): Names of the columns of the unique index.
+        columns (list[str]): Names of the columns updated on a conflict.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect in ("mysql", "mariadb"):
+        query = mysql.insert(table)
+        return query.on_duplicate_key_update(
+            {column: query.inserted[column] for column in columns}
+        )
+    if dialect == "sqlite":
+        query = sqlite.insert(table)
+        return query.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: query.excluded[column] for column in columns},
+        )
+    return insert(table)
+
+
+def sync_measurements(
+    session: Session, measurements: dict[str, list[list]]
+) -> tuple[dict[tuple[str, str], int], int]:
+    """Upsert the measurements of all resolutions, updating their name and unit.
+
+    Args:
+        session (Session): Session of the metadata db.
+        measurements (dict[str, list[list]]): Measurements as
+            [abbreviation, name, unit] by their resolution (10M, 1H, DLY).
+
+    Returns:
+        tuple[dict[tuple[str, str], int], int]: Ids of all the measurements by
+            their resolution and abbreviation and the number of the inserted
+            measurements.
+    """
+    query = select(Measurement.resolution, Measurement.abbreviation, Measurement.id)
+    existing = {(r, a): i for r, a, i in session.execute(query).all()}
+    rows = {}
+    for resolution, resolution_measurements in measurements.items():
+        for measurement in resolution_measurements:
+            key = (resolution, measurement[0])
+            if key not in rows:
+                rows[key] = {
+                    "resolution": resolution,
+                    "abbreviation": measurement[0],
+                    "name": measurement[1],
+                    "unit": measurement[2],
+                }
+    if not rows:
+        return existing, 0
+    session.execute(
+        upsert(
+            session,
+            Measurement.__table__,
+            ["resolution", "abbreviation"],
+            ["name", "unit"],
+        ),
+        list(rows.values()),
+    )
+    inserted = [row for key, row in rows.items() if key not in existing]
+    for row in inserted:
+        logger.info(
+            f"Created new {row['resolution']} measurement named: {row['name']}"
+        )
+    ids = {(r, a): i for r, a, i in session.execute(query).all()}
+    return ids, len(inserted)
+
+
+def sync_weather_stations(
+    session: Session, weather_stations: dict
+) -> tuple[dict[str, int], int]:
+    """Upsert the weather stations with at least one measurement.
+
+    The existing weather stations are updated with the latest metadata.
+
+    Returns:
+        tuple[dict[str, int], int]: Ids of all the weather stations by their WSI
+            and the number of the inserted weather stations.
+    """
+    query = select(WeatherStation.wsi, WeatherStation.id)
+    existing = dict(session.execute(query).all())
+    rows = [
+        {
+            "wsi": wsi,
+            "gh_id": weather_station["GH_ID"],
+            "full_name": weather_station["FULL_NAME"],
+            "X": weather_station["GEOGR1"],
+            "Y": weather_station["GEOGR2"],
+            "elevation": weather_station["ELEVATION"],
+        }
+        for wsi, weather_station in weather_stations.items()
+        if any(key in weather_station for key in RESOLUTIONS)
+    ]
+    if not rows:
+        return existing, 0
+    session.execute(
+        upsert(
+            session,
+            WeatherStation.__table__,
+            ["wsi"],
+            ["gh_id", "full_name", "X", "Y", "elevation"],
+        ),
+        rows,
+    )
+    inserted = [row for row in rows if row["wsi"] not in existing]
+    for row in inserted:
+        logger.info(f"Created new weather station named: {row['full_name']}")
+    ids = dict(session.execute(query).all())
+    return ids, len(inserted)
+
+
+def sync_metadata(
+    session: Session,
+    weather_stations: dict,
+    m10: list[list],
+    m1h: list[list],
+    mdly: list[list],
+) -> dict[str, int]:
+    """Sync the weather stations, measurements and their links with the db.
+
+    All the resolutions are synced together, with one statement per table.
+    The changes are not committed.
+
+    Args:
+        session (Session): Session of the metadata db.
+        weather_stations (dict): Weather stations from process_metadata.
+        m10 (list[list]): 10m measurements from process_metadata.
+        m1h (list[list]): 1h measurements from process_metadata.
+        mdly (list[list]): Daily measurements from process_metadata.
+
+    Returns:
+        dict[str, int]: Numbers of the inserted rows.
+    """
+    counts = {}
+    ws_ids, counts["weather_stations"] = sync_weather_stations(
+        session, weather_stations
+    )
+    measurement_ids, counts["measurements"] = sync_measurements(
+        session, dict(zip(RESOLUTIONS, (m10, m1h, mdly)))
+    )
+    ws_column, measurement_column = weather_station_measurements.c
+    rows = session.execute(select(ws_column, measurement_column))
+    existing = set(map(tuple, rows))
+    links = {
+        (ws_ids[wsi], measurement_ids[resolution, measurement[0]])
+        for wsi, weather_station in weather_stations.items()
+        if wsi in ws_ids
+        for resolution in RESOLUTIONS
+        for measurement in weather_station.get(resolution, [])
+        if (resolution, measurement[0]) in measurement_ids
+    }
+    new_links = [
+        {ws_column.name: ws_id, measurement_column.name: measurement_id}
+        for ws_id, measurement_id in sorted(links - existing)
+    ]
+    if new_links:
+        session.execute(
+            insert_ignore(session, weather_station_measurements), new_links
+        )
+    counts[weather_station_measurements.name] = len(new_links)
+    logger.info(f"Inserted metadata rows: {counts}")
+    return counts
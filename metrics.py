@@ -0,0 +1,316 @@
+import json
+import logging
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import config
+
+# pipeline metrics of the writers (stage timers, counters and histograms)
+# exposed in the Prometheus text format and summarized in a log line per job
+
+logger = logging.getLogger("chmi.metrics")
+
+# the HTTP endpoint is disabled when the port is 0
+METRICS_HOST = config.get("metrics", "host", fallback="127.0.0.1")
+METRICS_PORT = config.getint("metrics", "port", fallback=0)
+# upper bounds of the latency histograms (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+_ESCAPE_LABEL = str.maketrans({"\\": r"\\", '"': r"\"", "\n": r"\n"})
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    labels = ",".join(
+        f'{name}="{str(value).translate(_ESCAPE_LABEL)}"'
+        for name, value in zip(names, values)
+    )
+    return f"{{{labels}}}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, _format_labels(self.labels, key), value
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = (*sorted(buckets), float("inf"))
+        # label values -> (bucket counts, sum, count)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0)
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        """Get the sum and count samples, the buckets are only rendered."""
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, (_, total, count) in values:
+            labels = _format_labels(self.labels, key)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total, count))
+                for key, (counts, total, count) in self._values.items()
+            )
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    (*self.labels, "le"), (*key, _format_value(bound))
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(
+        self, name: str, documentation: str, labels: tuple = (), **kwargs
+    ) -> Histogram:
+        metric = Histogram(name, documentation, labels, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Render all the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict[str, float]:
+        """Get the current values of the counters and histogram sums and counts."""
+        return {
+            f"{name}{labels}": value
+            for metric in self.metrics
+            for name, labels, value in metric.samples()
+        }
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.counter(
+    "chmi_stage_seconds_total",
+    "Time spent in the pipeline stages.",
+    ("job", "stage"),
+)
+FILES = REGISTRY.counter(
+    "chmi_files_total", "Station data files by their outcome.", ("job", "status")
+)
+ROWS_PARSED = REGISTRY.counter(
+    "chmi_rows_parsed_total", "Value rows parsed from the data files.", ("job",)
+)
+ROWS_FILTERED = REGISTRY.counter(
+    "chmi_rows_filtered_total",
+    "Parsed value rows dropped by the filters (window, marks, measurement).",
+    ("job",),
+)
+POINTS_WRITTEN = REGISTRY.counter(
+    "chmi_points_written_total", "Values handed to the InfluxDB write API.", ("job",)
+)
+FILE_SECONDS = REGISTRY.histogram(
+    "chmi_file_seconds",
+    "Time to parse, filter and write a single data file.",
+    ("job",),
+)
+DOWNLOADS = REGISTRY.counter(
+    "chmi_downloads_total",
+    "HTTP downloads by their outcome (ok, not_modified, failed).",
+    ("status",),
+)
+DOWNLOAD_BYTES = REGISTRY.counter(
+    "chmi_download_bytes_total", "Bytes of the downloaded files."
+)
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    "chmi_download_seconds", "Latency of the HTTP downloads."
+)
+WRITE_RECORDS = REGISTRY.counter(
+    "chmi_write_records_total", "Records written to InfluxDB.", ("status",)
+)
+WRITE_RETRIES = REGISTRY.counter(
+    "chmi_write_retries_total", "Retried InfluxDB write requests."
+)
+JOB_SECONDS = REGISTRY.histogram(
+    "chmi_job_seconds",
+    "Duration of the jobs.",
+    ("job",),
+    buckets=(1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0),
+)
+JOBS = REGISTRY.counter("chmi_jobs_total", "Finished jobs.", ("job", "status"))
+
+
+@contextmanager
+def stage(job: str, name: str):
+    """Add the time of the block to the time of a pipeline stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.inc(time.perf_counter() - started, job=job, stage=name)
+
+
+def timed_iter(iterable: Iterable, job: str, name: str) -> Iterator:
+    """Add the time spent waiting for every item to the time of a stage."""
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            STAGE_SECONDS.inc(time.perf_counter() - started, job=job, stage=name)
+        yield item
+
+
+@contextmanager
+def job_metrics(job: str, job_logger: logging.Logger = logger):
+    """Time a job and log the summary of its metrics as a single JSON line.
+
+    The summary contains the changes of all the metrics of the process during
+    the job, including the jobs running at the same time. The job can add its
+    own details to the yielded dict.
+    """
+    before = REGISTRY.snapshot()
+    started = time.perf_counter()
+    status = "failed"
+    details = {}
+    try:
+        yield details
+        status = "ok"
+    finally:
+        duration = time.perf_counter() - started
+        JOB_SECONDS.observe(duration, job=job)
+        JOBS.inc(job=job, status=status)
+        after = REGISTRY.snapshot()
+        changes = {
+            key: round(value - before.get(key, 0), 6)
+            for key, value in after.items()
+            if value != before.get(key, 0) and not key.startswith("chmi_job")
+        }
+        summary = {
+            "job": job,
+            "status": status,
+            "duration_s": round(duration, 3),
+            "metrics": changes,
+            **details,
+        }
+        job_logger.info(f"Job summary: {json.dumps(summary, sort_keys=True)}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(
+    port: int = METRICS_PORT, host: str = METRICS_HOST
+) -> ThreadingHTTPServer | None:
+    """Serve the metrics on http://<host>:<port>/metrics in a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer | None: Server of the process, None when disabled.
+    """
+    global _server
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+            logger.info(f"Serving the metrics on http://{host}:{port}/metrics")
+        return _server
@@ -1,6 +1,14 @@
+import io
 import json
+import re
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import datetime
+from typing import BinaryIO, TextIO
 
-import pandas as pd
+import numpy as np
+
+from dedup import sorted_unique_rows, unique_rows
 
 
 def extract_chmi_metadata(path: str) -> tuple[list, list]:
@@ -11,25 +19,49 @@ def extract_chmi_metadata(path: str) -> tuple[list, list]:
     return headers, values
 
 
-def add_measurements(
-    ws_dict: dict, values: list, meas: str = "10M"
-) -> tuple[dict, list]:
-    prev_wsi = None
-    measurements = []
+# observation types of the measurements in meta2, in the order of the station keys
+MEASUREMENT_TYPES = ("10M", "1H", "DLY")
+
+
+def add_measurements(ws_dict: dict, values: list) -> tuple[list, list, list]:
+    """Add the 10M, 1H and DLY measurements of meta2 to the weather stations.
+
+    The values are scanned once, the result is the same as of the former
+    separate scan for every measurement type: the list of a station starts
+    again whenever the station changes, and a measurement type stops at the
+    first unknown station.
+
+    Args:
+        ws_dict (dict): Weather stations from meta1, updated in place.
+        values (list): Unique rows of meta2.
+
+    Returns:
+        tuple[list, list, list]: Sorted unique 10m, 1h and daily measurements.
+    """
+    # measurement type -> WSI -> measurements of the station
+    station_lists = {meas: {} for meas in MEASUREMENT_TYPES}
+    measurements = {meas: [] for meas in MEASUREMENT_TYPES}
+    prev_wsi = dict.fromkeys(MEASUREMENT_TYPES)
+    stopped = set()
     for value in values:
-        if meas in value:
+        for meas in MEASUREMENT_TYPES:
+            if meas in stopped or meas not in value:
+                continue
             current_wsi = value[1]
-            try:
-                if current_wsi != prev_wsi:
-                    ws_dict[current_wsi][meas] = []
-                ws_dict[current_wsi][meas].append(value[2:-1])
-                measurements.append(value[2:-1])
-            except KeyError:
+            if current_wsi not in ws_dict:
                 print(f"WSI {current_wsi} not found.")
-                break
-            prev_wsi = current_wsi
-    measurements_df = pd.DataFrame(measurements).drop_duplicates()
-    return ws_dict, sorted(measurements_df.values.tolist())
+                stopped.add(meas)
+                continue
+            if current_wsi != prev_wsi[meas]:
+                station_lists[meas][current_wsi] = []
+            station_lists[meas][current_wsi].append(value[2:-1])
+            measurements[meas].append(value[2:-1])
+            prev_wsi[meas] = current_wsi
+    # the station keys are added in the same order as before (10M, 1H, DLY)
+    for meas in MEASUREMENT_TYPES:
+        for wsi, station_measurements in station_lists[meas].items():
+            ws_dict[wsi][meas] = station_measurements
+    return tuple(sorted_unique_rows(measurements[meas]) for meas in MEASUREMENT_TYPES)
 
 
 def process_metadata(input_dir, year, month) -> tuple[dict, list, list, list]:
@@ -44,10 +76,204 @@ def process_metadata(input_dir, year, month) -> tuple[dict, list, list, list]:
     meta2 = f"{input_dir}/meta2-{year}{month:02d}.json"
     headers, values = extract_chmi_metadata(meta2)
     # sometimes there are duplicate weather stations
-    values_df = pd.DataFrame(values).drop_duplicates()
-    # convert back to a list of lists
-    values = values_df.values.tolist()
-    ws_dict, m10 = add_measurements(ws_dict, values, meas="10M")
-    ws_dict, m1h = add_measurements(ws_dict, values, meas="1H")
-    ws_dict, mdly = add_measurements(ws_dict, values, meas="DLY")
+    values = unique_rows(values)
+    m10, m1h, mdly = add_measurements(ws_dict, values)
     return ws_dict, m10, m1h, mdly
+
+
+# columnar parsing of the station data files, the rows of data["data"]["data"]["values"]
+# are [STATION, ELEMENT, DT, VAL, FLAG, QUALITY]
+
+# number of value rows parsed at once from the station data files
+CHUNK_ROWS = 10000
+_VALUES_KEY = re.compile(r'"values"\s*:\s*\[')
+_WHITESPACE = " \t\r\n,"
+
+
+@dataclass
+class StationValues:
+    measurements: np.ndarray
+    values: np.ndarray
+    quality: np.ndarray
+    # int64 timestamps in ns
+    times: np.ndarray
+    # only float values are written, strings and ints are skipped
+    numeric: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def mask(
+        self,
+        start_time: datetime | None = None,
+        end_time: datetime | None = None,
+        measurement: str | None = None,
+        valid_only: bool = True,
+    ) -> np.ndarray:
+        """Select the values to be written.
+
+        Args:
+            start_time (datetime | None): Keep only values at or after this time.
+            end_time (datetime | None): Keep only values at or before this time.
+            measurement (str | None): Keep only this measurement.
+            valid_only (bool): Keep only values with zero quality flag.
+
+        Returns:
+            np.ndarray: Boolean mask of the selected values.
+        """
+        mask = self.numeric.copy()
+        if valid_only:
+            mask &= self.quality == 0.0
+        if start_time is not None:
+            mask &= self.times >= int(start_time.timestamp() * 1e9)
+        if end_time is not None:
+            mask &= self.times <= int(end_time.timestamp() * 1e9)
+        if measurement:
+            mask &= self.measurements == measurement
+        return mask
+
+    def select(
+        self, mask: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Get the measurement, value and time (ns) columns selected by the mask."""
+        if mask is None:
+            mask = self.numeric
+        return self.measurements[mask], self.values[mask], self.times[mask]
+
+    def rows(self, mask: np.ndarray | None = None) -> Iterator[tuple[str, float, int]]:
+        """Get the (measurement, value, time in ns) rows selected by the mask."""
+        return zip(*(column.tolist() for column in self.select(mask)))
+
+
+def parse_station_values(values: list[list]) -> StationValues:
+    """Convert the value rows of a station data file into columnar arrays.
+
+    Args:
+        values (list[list]): Rows of data["data"]["data"]["values"].
+
+    Returns:
+        StationValues: Measurement, value, quality and time columns.
+    """
+    if not values:
+        return StationValues(
+            measurements=np.empty(0, dtype=object),
+            values=np.empty(0, dtype=np.float64),
+            quality=np.empty(0, dtype=object),
+            times=np.empty(0, dtype=np.int64),
+            numeric=np.empty(0, dtype=bool),
+        )
+    columns = list(zip(*values))
+    raw_values = np.array(columns[-3], dtype=object)
+    numeric = np.array(list(map(type, columns[-3])), dtype=object) == float
+    # the timestamps have the fixed YYYY-MM-DDTHH:MM:SSZ format, drop the Z
+    times = np.array(columns[-4]).astype("U19").astype("datetime64[s]")
+    return StationValues(
+        measurements=np.array(columns[1], dtype=object),
+        values=np.where(numeric, raw_values, np.nan).astype(np.float64),
+        quality=np.array(columns[-1], dtype=object),
+        times=times.astype(np.int64) * 1_000_000_000,
+        numeric=numeric,
+    )
+
+
+def concat_station_values(parts: list[StationValues]) -> StationValues:
+    if len(parts) == 1:
+        return parts[0]
+    if not parts:
+        return parse_station_values([])
+    return StationValues(
+        measurements=np.concatenate([part.measurements for part in parts]),
+        values=np.concatenate([part.values for part in parts]),
+        quality=np.concatenate([part.quality for part in parts]),
+        times=np.concatenate([part.times for part in parts]),
+        numeric=np.concatenate([part.numeric for part in parts]),
+    )
+
+
+def iter_value_rows(file: TextIO, read_size: int = 65536) -> Iterator[list]:
+    """Incrementally parse the value rows of a station data file.
+
+    Only the "values" array is decoded, one row at a time, so the memory does
+    not depend on the size of the file.
+
+    Args:
+        file (TextIO): Station data file opened in text mode.
+        read_size (int): Number of characters read from the file at once.
+
+    Yields:
+        list: Single row of data["data"]["data"]["values"].
+
+    Raises:
+        json.JSONDecodeError: If there is no values array or it is not valid.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+
+    def read_more() -> bool:
+        nonlocal buffer, pos, eof
+        chunk = file.read(read_size)
+        if not chunk:
+            eof = True
+            return False
+        # drop the already parsed part of the buffer
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    # find the start of the values array
+    while True:
+        match = _VALUES_KEY.search(buffer, pos)
+        if match:
+            pos = match.end()
+            break
+        # keep the end of the buffer, the key can be split between two reads
+        pos = max(len(buffer) - 32, 0)
+        if not read_more():
+            # e.g. an HTML error page instead of the data file
+            raise json.JSONDecodeError("Expecting the values array", buffer, pos)
+    while True:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+        if pos == len(buffer):
+            if not read_more():
+                raise json.JSONDecodeError("Unterminated values array", buffer, pos)
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            row, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the row continues in the next part of the file
+            if eof or not read_more():
+                raise
+            continue
+        yield row
+        pos = end
+
+
+def iter_station_values(
+    content: bytes | BinaryIO, chunk_rows: int = CHUNK_ROWS
+) -> Iterator[StationValues]:
+    """Parse a station data file into columnar chunks of at most chunk_rows rows.
+
+    Args:
+        content (bytes | BinaryIO): Content of the file or the file opened in
+            binary mode.
+        chunk_rows (int): Maximum number of rows in a single chunk.
+
+    Yields:
+        StationValues: Columns of the parsed rows.
+    """
+    if isinstance(content, bytes):
+        content = io.BytesIO(content)
+    file = io.TextIOWrapper(content, encoding="utf-8")
+    rows = []
+    for row in iter_value_rows(file):
+        rows.append(row)
+        if len(rows) >= chunk_rows:
+            yield parse_station_values(rows)
+            rows = []
+    if rows:
+        yield parse_station_values(rows)
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections.abc import Callable, Iterable
+from typing import TypeVar
+
+# size-aware ordering of the station files for the worker pools and the busy
+# time of the workers, the large files are started first so that no worker is
+# left with a large file at the end while the others are idle
+
+T = TypeVar("T")
+
+
+def largest_first(items: Iterable[T], size: Callable[[T], int | None]) -> list[T]:
+    """Order the items from the largest, the items of unknown size go last."""
+    return sorted(items, key=lambda item: size(item) or 0, reverse=True)
+
+
+def size_balanced_shards(
+    items: Iterable[tuple[T, int | None]], target_size: int, max_items: int
+) -> list[tuple[list[T], int]]:
+    """Split the items into shards of about the target size, from the largest.
+
+    The items are taken from the largest, so the first shards hold a few large
+    files and the last ones many small files. A single item larger than the
+    target is a shard on its own.
+
+    Args:
+        items (Iterable[tuple[T, int | None]]): Items and their sizes.
+        target_size (int): Total size of a shard.
+        max_items (int): Maximum number of items in a shard.
+
+    Returns:
+        list[tuple[list[T], int]]: Items and the total size of every shard.
+    """
+    shards = []
+    shard, shard_size = [], 0
+    for item, size in largest_first(items, lambda item: item[1]):
+        shard.append(item)
+        shard_size += size or 0
+        if shard_size >= target_size or len(shard) >= max_items:
+            shards.append((shard, shard_size))
+            shard, shard_size = [], 0
+    if shard:
+        shards.append((shard, shard_size))
+    return shards
+
+
+class WorkerUtilization:
+    """Busy time of the workers of a pool (threads or processes) during a job."""
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        # worker name -> [tasks, busy seconds, bytes]
+        self.workers = {}
+        self._lock = threading.Lock()
+
+    def add(self, worker: str, seconds: float, size: int = 0) -> None:
+        with self._lock:
+            stats = self.workers.setdefault(worker, [0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += size
+
+    def summary(self) -> dict:
+        """Get the tasks, busy time and utilization of every worker.
+
+        The utilization is the busy time of a worker divided by the time
+        since the start of the job.
+        """
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        with self._lock:
+            workers = {
+                worker: {
+                    "tasks": tasks,
+                    "busy_s": round(busy, 3),
+                    "bytes": size,
+                    "utilization": round(busy / elapsed, 3),
+                }
+                for worker, (tasks, busy, size) in sorted(self.workers.items())
+            }
+        busy = [stats["busy_s"] for stats in workers.values()]
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "mean_utilization": round(sum(busy) / len(busy) / elapsed, 3)
+            if busy
+            else 0.0,
+            "workers": workers,
+        }
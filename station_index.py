@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from config import config
+from ws_db_models import Measurement, WeatherStation, weather_station_measurements
+
+# in-memory WSI -> GH_ID index of the weather stations used by the writers
+
+logger = logging.getLogger("chmi.station_index")
+
+# optional local snapshot of the index, disabled when empty
+SNAPSHOT_PATH = config.get("station_index", "snapshot_path", fallback="")
+# the index (and its snapshot) is reloaded when it is older than this (seconds)
+MAX_AGE = config.getfloat("station_index", "max_age", fallback=86400.0)
+
+
+@dataclass
+class Station:
+    wsi: str
+    gh_id: str
+    # measurement type (10M, 1H, DLY) -> measurement abbreviations
+    measurements: dict[str, set[str]] = field(default_factory=dict)
+
+
+class StationIndex:
+    def __init__(self, stations: dict[str, Station] | None = None) -> None:
+        self.stations = stations if stations is not None else {}
+        self.loaded_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+    def __contains__(self, wsi: str) -> bool:
+        return wsi in self.stations
+
+    def get(self, wsi: str) -> Station | None:
+        return self.stations.get(wsi)
+
+    def is_stale(self, max_age: float = MAX_AGE) -> bool:
+        return time.time() - self.loaded_at > max_age
+
+    @classmethod
+    def from_db(cls, session: Session) -> "StationIndex":
+        """Load all weather stations and their measurements with a single query.
+
+        Args:
+            session (Session): Session connected to the metadata db.
+
+        Returns:
+            StationIndex: Index of all weather stations in the db.
+        """
+        query = (
+            select(
+                WeatherStation.wsi,
+                WeatherStation.gh_id,
+                Measurement.resolution,
+                Measurement.abbreviation,
+            )
+            .outerjoin(
+                weather_station_measurements,
+                weather_station_measurements.c.weather_station_id == WeatherStation.id,
+            )
+            .outerjoin(
+                Measurement,
+                Measurement.id == weather_station_measurements.c.measurement_id,
+            )
+        )
+        stations = {}
+        for wsi, gh_id, meas, abbreviation in session.execute(query):
+            station = stations.get(wsi)
+            if station is None:
+                station = stations[wsi] = Station(wsi, gh_id)
+            if abbreviation is not None:
+                station.measurements.setdefault(meas, set()).add(abbreviation)
+        return cls(stations)
+
+    @classmethod
+    def from_snapshot(cls, path: str) -> "StationIndex":
+        with open(path, "r", encoding="utf-8") as file:
+            snapshot = json.load(file)
+        stations = {
+            wsi: Station(
+                wsi,
+                station["gh_id"],
+                {meas: set(m) for meas, m in station["measurements"].items()},
+            )
+            for wsi, station in snapshot["stations"].items()
+        }
+        index = cls(stations)
+        index.loaded_at = snapshot["loaded_at"]
+        return index
+
+    def save_snapshot(self, path: str) -> None:
+        snapshot = {
+            "loaded_at": self.loaded_at,
+            "stations": {
+                wsi: {
+                    "gh_id": station.gh_id,
+                    "measurements": {
+                        meas: sorted(m) for meas, m in station.measurements.items()
+                    },
+                }
+                for wsi, station in self.stations.items()
+            },
+        }
+        # write to a temporary file first so that a crash never leaves a broken snapshot
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(snapshot, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+_station_index = None
+_station_index_lock = threading.Lock()
+
+
+def load_station_index(
+    session: Session, snapshot_path: str = SNAPSHOT_PATH
+) -> StationIndex:
+    """Load the station index from a fresh snapshot or from the metadata db.
+
+    The snapshot is preferred while it is not stale, so the writers can start
+    without waiting for the db. If the db cannot be reached, any existing
+    snapshot is used instead.
+
+    Args:
+        session (Session): Session connected to the metadata db.
+        snapshot_path (str): Path of the local snapshot, disabled when empty.
+
+    Returns:
+        StationIndex: Index of all weather stations.
+    """
+    has_snapshot = bool(snapshot_path) and os.path.exists(snapshot_path)
+    if has_snapshot:
+        index = StationIndex.from_snapshot(snapshot_path)
+        if not index.is_stale():
+            logger.info(f"Loaded {len(index)} weather stations from the snapshot.")
+            return index
+    try:
+        index = StationIndex.from_db(session)
+    except SQLAlchemyError as e:
+        if not has_snapshot:
+            raise
+        logger.warning(f"Could not load the weather stations from the db: {e}")
+        logger.warning("Using the stale station index snapshot.")
+        return StationIndex.from_snapshot(snapshot_path)
+    logger.info(f"Loaded {len(index)} weather stations from the db.")
+    if snapshot_path:
+        index.save_snapshot(snapshot_path)
+    return index
+
+
+def get_station_index(session: Session) -> StationIndex:
+    """Get the station index of the process, loading it only when needed."""
+    global _station_index
+    with _station_index_lock:
+        if _station_index is None or _station_index.is_stale():
+            _station_index = load_station_index(session)
+        return _station_index
+
+
+def refresh_station_index(
+    session: Session, snapshot_path: str = SNAPSHOT_PATH
+) -> StationIndex:
+    """Reload the station index from the metadata db and swap it in.
+
+    The old index is used by the running jobs until the new one is loaded.
+    """
+    global _station_index
+    index = StationIndex.from_db(session)
+    logger.info(f"Loaded {len(index)} weather stations from the db.")
+    if snapshot_path:
+        index.save_snapshot(snapshot_path)
+    with _station_index_lock:
+        _station_index = index
+    return index
+
@@ -11,7 +11,9 @@ from influxdb_client import InfluxDBClient, WriteOptions
 from tqdm import tqdm
 
 from config import config
-from influx_writer_realtime import download_file
+from downloader import download_file
+from line_protocol import write_station_values
+from parsing_tools import iter_station_values
 
 for month in range(1, 2):
     year = 2025
@@ -35,27 +37,11 @@ for month in range(1, 2):
     for data_file in tqdm(os.listdir(input_folder), ascii=True):
         wsi = data_file.removeprefix("10m-").removesuffix(f"-{year}{month_folder}.json")
         gh_id = meta[wsi]["GH_ID"]
-        with open(
-            f"./{year}/data/10min/{month_folder}/{data_file}", "r", encoding="utf-8"
-        ) as file:
-            data = json.load(file)
-        values = data["data"]["data"]["values"]
-        data_to_write = []
-        for value in values:
-            if value[-1] == 0.0 and type(value[-3]) == float:
-                dt = datetime.strptime(value[-4], "%Y-%m-%dT%H:%M:%SZ").replace(
-                    tzinfo=timezone.utc
-                )
-                data_to_write.append(
-                    {
-                        "measurement": value[1],
-                        "fields": {gh_id: value[-3]},
-                        # time in nanoseconds for efficiency
-                        "time": int(dt.timestamp() * 1e9),
-                    },
-                )
-        # must write in ns
-        write_api.write(bucket="chmi_data", record=data_to_write, write_precision="ns")
+        with open(f"./{year}/data/10min/{month_folder}/{data_file}", "rb") as file:
+            # the file is parsed in chunks
+            for station_values in iter_station_values(file):
+                mask = station_values.mask()
+                write_station_values(write_api, gh_id, station_values, mask)
 
     print("Closing connection.")
     write_api.close()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy.orm import Session
+
+# the modules read config.ini from the working directory when imported, so the
+# tests run in a temporary folder with the config of a local SQLite metadata db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# the synthetic CHMI data and the fake InfluxDB of the benchmarks
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+_cwd = os.getcwd()
+_folder = tempfile.mkdtemp(prefix="chmi-tests-")
+with open(os.path.join(_folder, "config.ini"), "w", encoding="utf-8") as file:
+    file.write(
+        "[metadata]\n"
+        "backend = sqlite\n"
+        f"sqlite_path = {os.path.join(_folder, 'metadata.db')}\n"
+        "[influxdb]\n"
+        "url = http://127.0.0.1:8086\n"
+        "token = test\n"
+        "org = vut\n"
+        "[download]\n"
+        "cache_folder =\n"
+        "[folders]\n"
+        "chmi_data_folder = http://127.0.0.1/\n"
+    )
+os.chdir(_folder)
+
+
+def pytest_unconfigure(config) -> None:
+    os.chdir(_cwd)
+    shutil.rmtree(_folder, ignore_errors=True)
+
+
+@pytest.fixture
+def station_db(monkeypatch):
+    """Metadata db of the config with a function adding weather stations.
+
+    The station index of the process is loaded again from the db.
+    """
+    import station_index
+    from metadata_db import create_metadata_engine
+    from ws_db_models import Base, WeatherStation
+
+    engine = create_metadata_engine()
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(station_index, "_station_index", None)
+
+    def add_stations(wsis: list[str]) -> None:
+        with Session(engine) as session:
+            session.add_all(
+                WeatherStation(
+                    wsi=wsi,
+                    gh_id=f"GH{wsi.replace('-', '')}",
+                    full_name=wsi,
+                    X=15.0,
+                    Y=49.0,
+                    elevation=200.0,
+                )
+                for wsi in wsis
+            )
+            session.commit()
+
+    yield engine, add_stations
+    Base.metadata.drop_all(engine)
+    engine.dispose()
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+from fixtures import FakeInfluxDB
+
+import async_writer
+from async_writer import AsyncWriteStage, WriteError
+
+
+@pytest.fixture(autouse=True)
+def short_retries(monkeypatch):
+    monkeypatch.setattr(async_writer, "RETRY_INTERVAL", 0.01)
+    monkeypatch.setattr(async_writer, "MAX_RETRY_DELAY", 0.05)
+
+
+@pytest.fixture
+def influx():
+    servers = []
+
+    def start(**kwargs) -> FakeInfluxDB:
+        server = FakeInfluxDB(**kwargs).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def lines(start: int, count: int) -> list[bytes]:
+    return [f"T GH{i % 7}={i} {i}".encode() for i in range(start, start + count)]
+
+
+def test_all_lines_arrive_despite_overload(influx):
+    server = influx(delay=0.02, failures=[429, 503, 429, 503, 503, 429])
+    stage = AsyncWriteStage(
+        server.url,
+        "test",
+        "vut",
+        batch_size=100,
+        flush_interval=0.2,
+        concurrency=3,
+        queue_size=4,
+        max_retries=5,
+    )
+    depths = []
+    for start in range(0, 10_000, 250):
+        stage.write("chmi_data", lines(start, 250), write_precision="ns")
+        depths.append(stage.queue_depth)
+    stage.close()
+    assert server.lines == 10_000
+    assert stage.stats["records"] == 10_000
+    assert stage.stats["retries"] == 6
+    assert stage.stats["failed_records"] == 0
+    # the writes were concurrent, but never more than the concurrency
+    assert 1 < server.max_in_flight <= 3
+    # the producer was blocked instead of queueing more batches
+    assert max(depths) <= 4
+    assert stage.stats["max_queue_depth"] <= 4
+    assert stage.stats["blocked_s"] > 0
+
+
+def test_partial_batch_is_flushed_on_close(influx):
+    server = influx()
+    stage = AsyncWriteStage(server.url, "test", "vut", batch_size=1000)
+    stage.write("chmi_data", lines(0, 10), write_precision="ns")
+    stage.write("chmi_data", lines(10, 1)[0], write_precision="ns")
+    stage.close()
+    assert server.lines == 11
+    assert server.requests == 1
+
+
+def test_close_raises_on_rejected_batches(influx):
+    server = influx(failures=[400])
+    stage = AsyncWriteStage(
+        server.url, "test", "vut", batch_size=100, concurrency=1, max_retries=5
+    )
+    stage.write("chmi_data", lines(0, 300), write_precision="ns")
+    with pytest.raises(WriteError):
+        stage.close()
+    # the rejected batch is not retried, the other ones are written
+    assert server.requests == 3
+    assert server.lines == 200
+    assert stage.stats["failed_records"] == 100
+    assert stage.stats["retries"] == 0
+
+
+def test_close_raises_when_retries_run_out(influx):
+    server = influx(failures=[503] * 3)
+    stage = AsyncWriteStage(server.url, "test", "vut", max_retries=2)
+    stage.write("chmi_data", lines(0, 5), write_precision="ns")
+    with pytest.raises(WriteError):
+        stage.close()
+    assert server.lines == 0
+    assert stage.stats["retries"] == 2
+
+
+def test_write_after_close_raises(influx):
+    server = influx()
+    stage = AsyncWriteStage(server.url, "test", "vut")
+    stage.close()
+    with pytest.raises(WriteError):
+        stage.write("chmi_data", lines(0, 1), write_precision="ns")
+    assert not [
+        thread for thread in threading.enumerate() if thread.name == "influx-writer"
+    ]
@@ -0,0 +1,180 @@
+import json
+import os
+import time
+
+import pytest
+from fixtures import FakeInfluxDB, generate_month, station_wsis
+
+import backfill
+from backfill import RateLimitedWriteAPI, RateLimiter, build_tasks
+from config import config
+from parsing_tools import iter_station_values
+
+STATIONS = 6
+
+
+@pytest.fixture
+def data_dir(tmp_path, station_db):
+    """Two months of the 10m files of a few stations in the local layout."""
+    _, add_stations = station_db
+    add_stations(station_wsis(STATIONS))
+    root = tmp_path / "data"
+    for month in (1, 2):
+        generate_month(str(root / "2024" / "data"), 2024, month, STATIONS, days=1)
+    return str(root)
+
+
+@pytest.fixture
+def influx(tmp_path, monkeypatch):
+    """Fake InfluxDB in the config read by the spawned worker processes."""
+    servers = []
+
+    def start(async_write: bool = True, **kwargs) -> FakeInfluxDB:
+        server = FakeInfluxDB(**kwargs).start()
+        servers.append(server)
+        folder = tmp_path / f"run{len(servers)}"
+        folder.mkdir()
+        (folder / "config.ini").write_text(
+            "[metadata]\n"
+            "backend = sqlite\n"
+            f"sqlite_path = {config.get('metadata', 'sqlite_path')}\n"
+            "[influxdb]\n"
+            f"url = {server.url}\n"
+            "token = test\n"
+            "org = vut\n"
+            f"async_write = {str(async_write).lower()}\n"
+            "retry_interval = 0.01\n"
+            "[download]\n"
+            "cache_folder =\n",
+            encoding="utf-8",
+        )
+        monkeypatch.chdir(folder)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def valid_values(data_dir: str) -> int:
+    count = 0
+    for folder, _, names in os.walk(data_dir):
+        for name in names:
+            if name.endswith(".json"):
+                with open(os.path.join(folder, name), "rb") as file:
+                    for station_values in iter_station_values(file.read()):
+                        count += int(station_values.mask().sum())
+    return count
+
+
+def run_backfill(data_dir: str, progress_path: str, **kwargs) -> dict:
+    return backfill.backfill(
+        "2024-01",
+        "2024-02",
+        ["10min"],
+        data_dir,
+        workers=2,
+        shard_size=2,
+        progress_path=progress_path,
+        **kwargs,
+    )
+
+
+def test_build_tasks():
+    months = {
+        ("10min", 2024, 1): [("a", 100), ("b", 10), ("c", 10), ("d", None)],
+        ("daily", 2024, 1): [("e", 50), ("f", 30)],
+    }
+    tasks = build_tasks(months, workers=2, shard_size=2, remote=False)
+    # the target size is 200 / (2 workers * 4 shards), the largest shards first
+    assert tasks == [
+        (("10min", 2024, 1, ["a"], False), 100),
+        (("daily", 2024, 1, ["e"], False), 50),
+        (("daily", 2024, 1, ["f"], False), 30),
+        (("10min", 2024, 1, ["b", "c"], False), 20),
+        (("10min", 2024, 1, ["d"], False), 0),
+    ]
+    # every file is in exactly one shard of its month
+    sources = sorted(source for task, _ in tasks for source in task[3])
+    assert sources == list("abcdef")
+
+
+def test_backfill_resumes_from_the_progress(data_dir, influx, tmp_path):
+    server = influx()
+    progress_path = str(tmp_path / "progress.jsonl")
+    files = sorted(
+        os.path.join(folder, name)
+        for folder, _, names in os.walk(data_dir)
+        for name in names
+        if name.endswith(".json")
+    )
+    # a file of an earlier run and a file outside the backfilled months
+    with open(progress_path, "w", encoding="utf-8") as file:
+        for source in (files[0], "/elsewhere/10m-0-1-202301.json"):
+            file.write(json.dumps(source) + "\n")
+    summary = run_backfill(data_dir, progress_path)
+    assert summary["files"] == 2 * STATIONS - 1
+    assert summary["skipped_files"] == 1
+    assert summary["failed_tasks"] == summary["failed_files"] == 0
+    assert summary["values"] == server.lines > 0
+    assert backfill.load_progress(progress_path) == set(files) | {
+        "/elsewhere/10m-0-1-202301.json"
+    }
+    # nothing is left to write
+    summary = run_backfill(data_dir, progress_path)
+    assert (summary["files"], summary["skipped_files"]) == (0, 2 * STATIONS)
+
+
+@pytest.mark.parametrize("async_write", [False, True])
+def test_rejected_writes_are_not_recorded(data_dir, influx, tmp_path, async_write):
+    # every write request is rejected
+    influx(async_write=async_write, failures=[400] * 1000)
+    progress_path = str(tmp_path / "progress.jsonl")
+    summary = run_backfill(data_dir, progress_path)
+    assert summary["failed_tasks"] == summary["tasks"] > 0
+    assert summary["values"] == 0
+    assert backfill.load_progress(progress_path) == set()
+    # the resumed backfill writes all the files
+    server = influx()
+    summary = run_backfill(data_dir, progress_path)
+    assert summary["files"] == 2 * STATIONS
+    assert summary["failed_tasks"] == 0
+    assert summary["values"] == server.lines == valid_values(data_dir)
+
+
+def test_rate_limiter():
+    rate_limiter = RateLimiter(10_000)
+    started = time.perf_counter()
+    # the bucket is full at the start, the next batches wait for the tokens
+    for _ in range(4):
+        rate_limiter.acquire(1000)
+    assert time.perf_counter() - started < 0.05
+    for _ in range(4):
+        rate_limiter.acquire(5000)
+    # a batch passes while any tokens are left, the last one after 19000 values
+    # of which 10000 were in the bucket
+    assert 0.85 < time.perf_counter() - started < 1.5
+    # no limit
+    started = time.perf_counter()
+    RateLimiter(0).acquire(10**9)
+    assert time.perf_counter() - started < 0.05
+
+
+def test_rate_limited_write_api_counts_the_records():
+    class RecordingRateLimiter:
+        def __init__(self) -> None:
+            self.acquired = []
+
+        def acquire(self, n: int) -> None:
+            self.acquired.append(n)
+
+    class NullWriteApi:
+        def write(self, bucket, record, **kwargs) -> None:
+            pass
+
+    rate_limiter = RecordingRateLimiter()
+    write_api = RateLimitedWriteAPI(NullWriteApi(), rate_limiter)
+    write_api.write("chmi_data", [b"a", b"b", b"c"], write_precision="ns")
+    write_api.write("chmi_data", b"a", write_precision="ns")
+    assert rate_limiter.acquired == [3, 1]
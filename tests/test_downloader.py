@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from downloader import create_session, download_files, fetch_file, iter_downloads
+from metrics import DOWNLOADS
+
+
+class FileServer(ThreadingHTTPServer):
+    """Files served from memory, with failing and slow paths."""
+
+    def __init__(self, files: dict[str, bytes]) -> None:
+        super().__init__(("127.0.0.1", 0), _FileHandler)
+        self.files = files
+        # path -> status codes of its next requests, then 200
+        self.failures = {}
+        # path -> seconds before the response
+        self.delays = {}
+        self.requests = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/{path}"
+
+    @property
+    def started(self) -> int:
+        with self.lock:
+            return sum(self.requests.values())
+
+
+class _FileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        server = self.server
+        path = self.path.lstrip("/")
+        with server.lock:
+            server.requests[path] += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            failures = server.failures.get(path)
+            status = failures.pop(0) if failures else 200
+        try:
+            time.sleep(server.delays.get(path, 0.0))
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        if path not in server.files:
+            status = 404
+        body = server.files[path] if status == 200 else b""
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def server():
+    files = {f"{i}.json": f'{{"file": {i}}}'.encode() * (i + 1) for i in range(20)}
+    server = FileServer(files)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_retries_server_errors(server):
+    server.failures["1.json"] = [503, 500]
+    session = create_session(retries=2, backoff_factor=0)
+    response = fetch_file(server.url("1.json"), session)
+    assert response.content == server.files["1.json"]
+    assert server.requests["1.json"] == 3
+
+
+def test_failed_download_is_reported(server, caplog):
+    server.failures["1.json"] = [503] * 3
+    session = create_session(retries=1, backoff_factor=0)
+    failed = DOWNLOADS.value(status="failed")
+    with caplog.at_level("WARNING", logger="chmi.downloader"):
+        assert fetch_file(server.url("1.json"), session) is None
+        # a missing file is not retried
+        assert fetch_file(server.url("missing.json"), session) is None
+    assert server.requests["1.json"] == 2
+    assert server.requests["missing.json"] == 1
+    assert DOWNLOADS.value(status="failed") == failed + 2
+    assert f"Failed to download {server.url('1.json')}: 503" in caplog.text
+    assert f"Failed to download {server.url('missing.json')}: 404" in caplog.text
+
+
+def test_iter_downloads_yields_every_file_as_it_completes(server):
+    server.delays["0.json"] = 0.3
+    server.failures["5.json"] = [503] * 10
+    paths = list(server.files)
+    session = create_session(retries=1, backoff_factor=0)
+    downloads = list(
+        iter_downloads(map(server.url, paths), max_workers=4, session=session)
+    )
+    # the failed file is left out, the others are complete
+    assert dict(downloads) == {
+        server.url(path): content
+        for path, content in server.files.items()
+        if path != "5.json"
+    }
+    # the slow first file does not hold back the others
+    assert downloads[0][0] != server.url("0.json")
+    assert downloads[-1][0] == server.url("0.json")
+    assert server.max_in_flight <= 4
+
+
+def test_iter_downloads_limits_the_files_in_flight(server):
+    for path in server.files:
+        server.delays[path] = 0.02
+    session = create_session(retries=0)
+    downloads = iter_downloads(
+        map(server.url, server.files), max_workers=2, queue_size=3, session=session
+    )
+    next(downloads)
+    # the consumer holds the first file, only the queue is refilled once
+    time.sleep(0.3)
+    assert server.started <= 4
+    assert len(list(downloads)) == len(server.files) - 1
+    assert server.max_in_flight <= 2
+
+
+def test_download_files(server, tmp_path):
+    server.failures["2.json"] = [404]
+    paths = download_files(
+        [server.url(path) for path in ("1.json", "2.json", "3.json")],
+        str(tmp_path),
+        max_workers=2,
+        session=create_session(retries=0),
+    )
+    assert sorted(paths) == [str(tmp_path / "1.json"), str(tmp_path / "3.json")]
+    assert (tmp_path / "3.json").read_bytes() == server.files["3.json"]
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+import requests
+from fixtures import serve_folder
+
+from http_cache import HttpCache, StagedCache
+
+
+@pytest.fixture
+def server(tmp_path):
+    folder = tmp_path / "srv"
+    folder.mkdir()
+    server, url = serve_folder(str(folder))
+    yield folder, url
+    server.shutdown()
+    server.server_close()
+
+
+def write_file(path, content: bytes, mtime: float) -> None:
+    path.write_bytes(content)
+    os.utime(path, (mtime, mtime))
+
+
+def test_fetch_revalidates_the_cached_copy(server, tmp_path):
+    folder, url = server
+    write_file(folder / "a.json", b"first", 1_700_000_000)
+    cache = HttpCache(str(tmp_path / "cache"))
+    with requests.Session() as session:
+        response = cache.fetch(f"{url}a.json", session)
+        assert (response.content, response.modified) == (b"first", True)
+        response = cache.fetch(f"{url}a.json", session)
+        assert (response.content, response.modified) == (b"first", False)
+
+
+def test_staged_download_is_discarded(server, tmp_path):
+    folder, url = server
+    write_file(folder / "a.json", b"first", 1_700_000_000)
+    cache = HttpCache(str(tmp_path / "cache"))
+    with requests.Session() as session:
+        staged = StagedCache(cache)
+        assert staged.fetch(f"{url}a.json", session).modified
+        staged.discard()
+        # nothing was cached, the file is downloaded again
+        assert cache.fetch(f"{url}a.json", session).modified
+    assert sorted(os.listdir(tmp_path / "cache")) == sorted(
+        os.path.basename(path) for path in cache._paths(f"{url}a.json")
+    )
+
+
+def test_staged_download_is_committed(server, tmp_path):
+    folder, url = server
+    write_file(folder / "a.json", b"first", 1_700_000_000)
+    cache = HttpCache(str(tmp_path / "cache"))
+    with requests.Session() as session:
+        cache.fetch(f"{url}a.json", session)
+        write_file(folder / "a.json", b"second", 1_700_000_600)
+        staged = StagedCache(cache)
+        response = staged.fetch(f"{url}a.json", session)
+        assert (response.content, response.modified) == (b"second", True)
+        # the cached copy is the old one until the commit
+        assert cache._read(f"{url}a.json")[1] == b"first"
+        staged.commit()
+        assert cache._read(f"{url}a.json")[1] == b"second"
+        assert not cache.fetch(f"{url}a.json", session).modified
+    assert cache._size == len(b"second")
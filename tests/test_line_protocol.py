@@ -0,0 +1,163 @@
+import math
+import random
+
+import pytest
+from influxdb_client import Point
+
+from line_protocol import (
+    WidePointAggregator,
+    encode_station,
+    station_points,
+    write_station_values,
+)
+from parsing_tools import parse_station_values
+
+MEASUREMENTS = ["T", "SRA", "T 05", "a,b", "x=y", "tab\there", "new\nline"]
+GH_IDS = ["O1MOSN01", "GH 1", "GH,2", "GH=3", "GH\\4", "GH\t5"]
+SPECIAL_VALUES = [
+    0.0,
+    -0.0,
+    1.0,
+    -12.0,
+    0.1,
+    1e-07,
+    1e16,
+    1e20,
+    -3.4e-300,
+    123456789.123,
+    float("nan"),
+    float("inf"),
+    float("-inf"),
+]
+
+
+def client_lines(gh_id: str, rows: list[tuple[str, float, int]]) -> list[bytes]:
+    """Serialize the rows as dict points with the influxdb-client."""
+    lines = []
+    for point in station_points(gh_id, rows):
+        line = Point.from_dict(point).to_line_protocol()
+        # the points without a finite value are not written by the client
+        if line:
+            lines.append(line.encode())
+    return lines
+
+
+def random_rows(rng: random.Random, count: int) -> list[tuple[str, float, int]]:
+    rows = []
+    for _ in range(count):
+        if rng.random() < 0.2:
+            value = rng.choice(SPECIAL_VALUES)
+        else:
+            value = round(rng.uniform(-1000, 1000), rng.randint(0, 3))
+        time_ns = rng.randint(0, 2_000_000_000) * 1_000_000_000
+        rows.append((rng.choice(MEASUREMENTS), value, time_ns))
+    return rows
+
+
+@pytest.mark.parametrize("gh_id", GH_IDS)
+def test_encode_station_matches_client(gh_id):
+    rows = random_rows(random.Random(gh_id), 2000)
+    assert encode_station(gh_id, rows) == client_lines(gh_id, rows)
+
+
+def test_encode_station_special_values():
+    rows = [("T", value, 1_700_000_000_000_000_000) for value in SPECIAL_VALUES]
+    lines = encode_station("GH 1", rows)
+    assert lines == client_lines("GH 1", rows)
+    # NaN and infinities are dropped
+    assert len(lines) == sum(math.isfinite(value) for value in SPECIAL_VALUES)
+    assert lines[:3] == [
+        b"T GH\\ 1=0 1700000000000000000",
+        b"T GH\\ 1=-0 1700000000000000000",
+        b"T GH\\ 1=1 1700000000000000000",
+    ]
+
+
+def test_encode_station_escaping():
+    rows = [("a b,c", 1.5, 10), ("x=y", 2.0, 20)]
+    assert encode_station("GH=1 x,y", rows) == [
+        b"a\\ b\\,c GH\\=1\\ x\\,y=1.5 10",
+        b"x=y GH\\=1\\ x\\,y=2 20",
+    ]
+    assert encode_station("GH=1 x,y", rows) == client_lines("GH=1 x,y", rows)
+
+
+def test_encode_station_precision():
+    rows = [("T", 1.0, 1_700_000_000_123_456_789)]
+    assert encode_station("G", rows, "s") == [b"T G=1 1700000000"]
+    assert encode_station("G", rows, "ms") == [b"T G=1 1700000000123"]
+
+
+class RecordingWriteApi:
+    def __init__(self) -> None:
+        self.records = []
+
+    def write(self, bucket, record, write_precision) -> None:
+        self.records.extend(record)
+
+
+def test_write_station_values_measurement_suffix():
+    station_values = parse_station_values(
+        [
+            ["0-1", "T", "2024-01-01T10:00:00Z", 1.5, None, 0.0],
+            ["0-1", "H", "2024-01-01T10:00:00Z", 80.0, None, 0.0],
+        ]
+    )
+    mask = station_values.mask()
+    write_api = RecordingWriteApi()
+    write_station_values(
+        write_api, "GH1", station_values, mask, measurement_suffix="_1h"
+    )
+    assert write_api.records == [
+        b"T_1h GH1=1.5 1704103200000000000",
+        b"H_1h GH1=80 1704103200000000000",
+    ]
+    aggregator = WidePointAggregator()
+    write_station_values(
+        None, "GH1", station_values, mask, aggregator, measurement_suffix="_1h"
+    )
+    assert aggregator.lines() == [
+        b"H_1h GH1=80 1704103200000000000",
+        b"T_1h GH1=1.5 1704103200000000000",
+    ]
+
+
+def wide_points(lines: list[bytes]) -> set[tuple[str, str, str, str]]:
+    points = set()
+    for line in lines:
+        measurement, fields, time_ns = line.decode().split(" ")
+        for field in fields.split(","):
+            key, value = field.split("=")
+            points.add((measurement, key, value, time_ns))
+    return points
+
+
+def test_wide_points_are_flushed_in_batches():
+    rng = random.Random(0)
+    stations = {}
+    for i in range(10):
+        rows = [
+            [f"0-{i}", rng.choice(["T", "H"]), f"2024-01-01T00:{m:02d}:00Z"]
+            + [round(rng.uniform(-10, 10), 1), None, 0.0]
+            for m in range(0, 60, 10)
+        ]
+        stations[f"GH{i}"] = parse_station_values(rows)
+    write_api = RecordingWriteApi()
+    aggregator = WidePointAggregator(max_fields=3, max_values=15)
+    sizes = []
+    for gh_id, station_values in stations.items():
+        mask = station_values.mask()
+        write_station_values(write_api, gh_id, station_values, mask, aggregator)
+        sizes.append(len(aggregator))
+    # the values are written while the stations are added, not only at the end
+    assert write_api.records
+    assert max(sizes) < 15 + 6
+    write_api.records.extend(aggregator.flush())
+    assert len(aggregator) == 0
+    expected = [
+        line
+        for gh_id, station_values in stations.items()
+        for line in encode_station(gh_id, station_values.rows())
+    ]
+    assert wide_points(write_api.records) == wide_points(expected)
+    assert len(write_api.records) < len(expected)
@@ -0,0 +1,56 @@
+import os
+
+import requests
+from fixtures import serve_folder, write_listing
+
+from http_cache import HttpCache, StagedCache
+from listing import FILE_PATTERN, changed_entries, file_pattern, parse_listing
+
+
+def list_files(folder: str, url: str, pattern=FILE_PATTERN):
+    write_listing(folder, "/now/")
+    with open(os.path.join(folder, "index.html"), "rb") as file:
+        return parse_listing(file.read(), url, pattern)
+
+
+def test_parse_listing(tmp_path):
+    folder = str(tmp_path)
+    for name in ("dly-0-20000-0-11500-20240101.json", "meta1-202401.json"):
+        with open(os.path.join(folder, name), "w", encoding="utf-8") as file:
+            file.write("{}")
+    entries = list_files(folder, "http://127.0.0.1/now/")
+    assert [(e.name, e.measurement_type, e.wsi, e.date, e.size) for e in entries] == [
+        ("dly-0-20000-0-11500-20240101.json", "dly", "0-20000-0-11500", "20240101", 2),
+        ("meta1-202401.json", "meta1", None, "202401", 2),
+    ]
+    assert entries[0].url == "http://127.0.0.1/now/dly-0-20000-0-11500-20240101.json"
+
+
+def test_changed_entries_skip_only_committed_files(tmp_path):
+    folder = tmp_path / "srv"
+    folder.mkdir()
+    (folder / "dly-0-20000-0-11500-20240101.json").write_bytes(b'{"a": 1}')
+    server, url = serve_folder(str(folder))
+    cache = HttpCache(str(tmp_path / "cache"))
+    try:
+        with requests.Session() as session:
+            entries = list_files(str(folder), url, file_pattern("dly"))
+            assert len(entries) == 1
+            # a failed run: the file is downloaded but its values not written
+            staged = StagedCache(cache)
+            assert changed_entries(entries, staged) == entries
+            staged.fetch(entries[0].url, session)
+            staged.discard()
+            staged = StagedCache(cache)
+            assert changed_entries(entries, staged) == entries
+            # a successful run
+            staged.fetch(entries[0].url, session)
+            staged.commit()
+            assert changed_entries(entries, StagedCache(cache)) == []
+            # the file changes in the listing
+            (folder / "dly-0-20000-0-11500-20240101.json").write_bytes(b'{"a": 12}')
+            entries = list_files(str(folder), url, file_pattern("dly"))
+            assert changed_entries(entries, StagedCache(cache)) == entries
+    finally:
+        server.shutdown()
+        server.server_close()
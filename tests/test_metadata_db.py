@@ -0,0 +1,211 @@
+import json
+
+import pytest
+from sqlalchemy import inspect, select, text
+
+from metadata_db import create_metadata_engine
+from metadata_migrate import migrate_metadata
+from ws_db_models import Measurement, WeatherStation, weather_station_measurements
+from ws_metadata_create_db import load_metadata
+
+T = ["T", "Temperature", "°C", 2.0]
+H = ["H", "Humidity", "%", 2.0]
+SRA = ["SRA", "Precipitation", "mm", 1.0]
+
+
+def station(gh_id: str, name: str, **measurements) -> dict:
+    return {
+        "GH_ID": gh_id,
+        "BEGIN_DATE": "2000-01-01T00:00Z",
+        "END_DATE": "3999-12-31T23:59Z",
+        "FULL_NAME": name,
+        "GEOGR1": 15.0,
+        "GEOGR2": 49.0,
+        "ELEVATION": 200.0,
+        **measurements,
+    }
+
+
+@pytest.fixture
+def data_db(tmp_path):
+    """Small output of ws_metadata_merge.py."""
+    folder = tmp_path / "data_db"
+    folder.mkdir()
+    files = {
+        "weather_stations.json": {
+            "0-1": station("GH1", "One", **{"10M": [T, H], "1H": [T], "DLY": [SRA]}),
+            "0-2": station("GH2", "Two", **{"10M": [SRA], "1H": [SRA, H]}),
+            # a station without measurements is not loaded
+            "0-3": station("GH3", "Three"),
+        },
+        "measurements_10m.json": [H, SRA, T],
+        "measurements_1h.json": [H, SRA, T],
+        "measurements_dly.json": [SRA],
+    }
+    for name, content in files.items():
+        (folder / name).write_text(json.dumps(content), encoding="utf-8")
+    return str(folder)
+
+
+def station_links(engine) -> set[tuple[str, str, str]]:
+    junction = weather_station_measurements
+    query = (
+        select(WeatherStation.wsi, Measurement.resolution, Measurement.abbreviation)
+        .join(junction, junction.c.weather_station_id == WeatherStation.id)
+        .join(Measurement, junction.c.measurement_id == Measurement.id)
+    )
+    with engine.connect() as conn:
+        return set(map(tuple, conn.execute(query)))
+
+
+def test_load_metadata_links_the_stations(data_db):
+    engine = create_metadata_engine("sqlite://")
+    counts = load_metadata(engine, data_db)
+    assert counts == {
+        "weather_stations": 2,
+        "measurements": 7,
+        "weather_station_measurements": 7,
+    }
+    assert station_links(engine) == {
+        ("0-1", "10M", "T"),
+        ("0-1", "10M", "H"),
+        ("0-1", "1H", "T"),
+        ("0-1", "DLY", "SRA"),
+        ("0-2", "10M", "SRA"),
+        ("0-2", "1H", "SRA"),
+        ("0-2", "1H", "H"),
+    }
+    with engine.connect() as conn:
+        # the compatibility views of the per-resolution tables
+        assert conn.execute(
+            text(
+                "SELECT wsi, measurements_1h FROM show_weather_stations_1h "
+                "ORDER BY wsi"
+            )
+        ).all() == [
+            ("0-1", "Temperature [°C]"),
+            ("0-2", "Humidity [%], Precipitation [mm]"),
+        ]
+    # loading the same metadata again inserts nothing
+    assert set(load_metadata(engine, data_db).values()) == {0}
+    engine.dispose()
+
+
+# the schema before the measurement catalog and the unique indexes
+BASELINE_SCHEMA = [
+    """
+    CREATE TABLE weather_stations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        wsi VARCHAR(255) NOT NULL,
+        gh_id VARCHAR(255) NOT NULL,
+        full_name VARCHAR(255) NOT NULL,
+        X FLOAT NOT NULL,
+        Y FLOAT NOT NULL,
+        elevation FLOAT NOT NULL
+    )
+    """,
+    *(
+        f"""
+        CREATE TABLE measurements_{m} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            abbreviation VARCHAR(255) NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            unit VARCHAR(255) NOT NULL
+        )
+        """
+        for m in ("10m", "1h", "dly")
+    ),
+    *(
+        f"""
+        CREATE TABLE weather_station_measurements_{m} (
+            weather_station_id INTEGER NOT NULL REFERENCES weather_stations (id),
+            measurement_{m}_id INTEGER NOT NULL REFERENCES measurements_{m} (id),
+            PRIMARY KEY (weather_station_id, measurement_{m}_id)
+        )
+        """
+        for m in ("10m", "1h", "dly")
+    ),
+]
+
+
+def create_baseline_db(engine) -> None:
+    with engine.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(
+            text(
+                "INSERT INTO weather_stations VALUES "
+                "(1, '0-1', 'GH1', 'One', 15, 49, 200), "
+                "(2, '0-2', 'GH2', 'Two', 15, 49, 300), "
+                # a duplicate station, its links move to the first one
+                "(3, '0-1', 'GH1', 'One', 15, 49, 200)"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO measurements_10m VALUES "
+                "(1, 'T', 'Temperature', '°C'), "
+                "(2, 'H', 'Humidity', '%'), "
+                # a duplicate abbreviation, merged into the first one
+                "(3, 'T', 'Temperature', '°C')"
+            )
+        )
+        conn.execute(
+            text("INSERT INTO measurements_1h VALUES (1, 'T', 'Temperature', '°C')")
+        )
+        conn.execute(
+            text(
+                "INSERT INTO measurements_dly VALUES "
+                "(1, 'SRA', 'Precipitation', 'mm')"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO weather_station_measurements_10m VALUES "
+                "(1, 1), (2, 1), (3, 2), (3, 3)"
+            )
+        )
+        conn.execute(text("INSERT INTO weather_station_measurements_1h VALUES (2, 1)"))
+        conn.execute(text("INSERT INTO weather_station_measurements_dly VALUES (1, 1)"))
+
+
+def test_migrate_metadata_from_the_baseline_schema(tmp_path):
+    engine = create_metadata_engine(f"sqlite:///{tmp_path / 'metadata.db'}")
+    create_baseline_db(engine)
+    counts = migrate_metadata(engine)
+    assert counts == {
+        "moved_measurements": 4,
+        "weather_stations": 1,
+        "measurements": 0,
+    }
+    assert station_links(engine) == {
+        ("0-1", "10M", "T"),
+        ("0-1", "10M", "H"),
+        ("0-1", "DLY", "SRA"),
+        ("0-2", "10M", "T"),
+        ("0-2", "1H", "T"),
+    }
+    with engine.connect() as conn:
+        assert conn.execute(
+            select(WeatherStation.id, WeatherStation.wsi).order_by(WeatherStation.id)
+        ).all() == [(1, "0-1"), (2, "0-2")]
+        # the old tables are replaced by the views
+        assert conn.execute(
+            text("SELECT abbreviation FROM measurements_10m ORDER BY abbreviation")
+        ).all() == [("H",), ("T",)]
+        assert conn.execute(
+            text(
+                "SELECT COUNT(*) FROM weather_station_measurements_10m "
+                "WHERE weather_station_id = 1"
+            )
+        ).scalar() == 2
+    tables = inspect(engine).get_table_names()
+    assert not [table for table in tables if table.endswith(("_10m", "_1h", "_dly"))]
+    indexes = {
+        index["name"]: index["unique"]
+        for index in inspect(engine).get_indexes("weather_stations")
+    }
+    assert indexes["ix_weather_stations_wsi"]
+    # the migration can be run again
+    assert set(migrate_metadata(engine).values()) == {0}
+    engine.dispose()
@@ -0,0 +1,139 @@
+import json
+import logging
+import socket
+
+import pytest
+import requests
+
+import metrics
+from metrics import JOBS, Counter, Histogram, Registry, job_metrics, stage
+
+
+def test_counter_labels():
+    counter = Counter("c_total", "Doc.", ("job", "status"))
+    counter.inc(job="a", status="ok")
+    counter.inc(2.5, job="a", status="ok")
+    counter.inc(job="b", status="failed")
+    assert counter.value(job="a", status="ok") == 3.5
+    assert counter.value(job="a", status="failed") == 0
+    with pytest.raises(KeyError):
+        counter.inc(job="a")
+    assert list(counter.samples()) == [
+        ("c_total", '{job="a",status="ok"}', 3.5),
+        ("c_total", '{job="b",status="failed"}', 1),
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter("c_total", "Doc.", ("path",))
+    counter.inc(path='a\\b"c\nd')
+    assert counter.render()[-1] == 'c_total{path="a\\\\b\\"c\\nd"} 1'
+
+
+def test_histogram_buckets():
+    histogram = Histogram("h_seconds", "Doc.", ("job",), buckets=(1.0, 0.1))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, job="a")
+    assert histogram.render() == [
+        "# HELP h_seconds Doc.",
+        "# TYPE h_seconds histogram",
+        # the bounds are sorted and cumulative, the values at a bound are in it
+        'h_seconds_bucket{job="a",le="0.1"} 2',
+        'h_seconds_bucket{job="a",le="1.0"} 3',
+        'h_seconds_bucket{job="a",le="+Inf"} 4',
+        'h_seconds_sum{job="a"} 3.65',
+        'h_seconds_count{job="a"} 4',
+    ]
+    assert list(histogram.samples()) == [
+        ("h_seconds_sum", '{job="a"}', 3.65),
+        ("h_seconds_count", '{job="a"}', 4),
+    ]
+
+
+def test_registry_text_format():
+    registry = Registry()
+    counter = registry.counter("files_total", "Files.", ("status",))
+    histogram = registry.histogram("latency_seconds", "Latency.", buckets=(1.0,))
+    registry.counter("empty_total", "Never incremented.")
+    counter.inc(status="ok")
+    histogram.observe(0.25)
+    assert registry.render() == (
+        "# HELP files_total Files.\n"
+        "# TYPE files_total counter\n"
+        'files_total{status="ok"} 1\n'
+        "# HELP latency_seconds Latency.\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="1.0"} 1\n'
+        'latency_seconds_bucket{le="+Inf"} 1\n'
+        "latency_seconds_sum 0.25\n"
+        "latency_seconds_count 1\n"
+        "# HELP empty_total Never incremented.\n"
+        "# TYPE empty_total counter\n"
+    )
+    assert registry.snapshot() == {
+        'files_total{status="ok"}': 1,
+        "latency_seconds_sum": 0.25,
+        "latency_seconds_count": 1,
+    }
+
+
+def job_summary(caplog) -> dict:
+    (message,) = [
+        record.getMessage()
+        for record in caplog.records
+        if record.getMessage().startswith("Job summary: ")
+    ]
+    return json.loads(message.removeprefix("Job summary: "))
+
+
+def test_job_summary(caplog):
+    job_logger = logging.getLogger("chmi.test_job")
+    with caplog.at_level(logging.INFO, logger="chmi.test_job"):
+        with job_metrics("test_ok", job_logger) as details:
+            metrics.FILES.inc(3, job="test_ok", status="processed")
+            details["workers"] = 2
+    summary = job_summary(caplog)
+    assert summary["status"] == "ok"
+    assert summary["workers"] == 2
+    assert summary["metrics"] == {
+        'chmi_files_total{job="test_ok",status="processed"}': 3
+    }
+
+
+def test_job_summary_is_logged_when_the_job_raises(caplog):
+    job_logger = logging.getLogger("chmi.test_job")
+    failed = JOBS.value(job="test_failed", status="failed")
+    with caplog.at_level(logging.INFO, logger="chmi.test_job"):
+        with pytest.raises(RuntimeError):
+            with job_metrics("test_failed", job_logger):
+                with stage("test_failed", "write"):
+                    metrics.POINTS_WRITTEN.inc(10, job="test_failed")
+                    raise RuntimeError("write failed")
+    summary = job_summary(caplog)
+    assert summary["job"] == "test_failed"
+    assert summary["status"] == "failed"
+    assert summary["metrics"]['chmi_points_written_total{job="test_failed"}'] == 10
+    # the stage is timed also when it raises
+    assert 'chmi_stage_seconds_total{job="test_failed",stage="write"}' in (
+        summary["metrics"]
+    )
+    assert JOBS.value(job="test_failed", status="failed") == failed + 1
+
+
+def test_metrics_endpoint(monkeypatch):
+    monkeypatch.setattr(metrics, "_server", None)
+    assert metrics.start_metrics_server(port=0) is None
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = metrics.start_metrics_server(port=port)
+    try:
+        assert metrics.start_metrics_server(port=port) is server
+        response = requests.get(f"http://127.0.0.1:{port}/metrics", timeout=5)
+        assert response.status_code == 200
+        assert "# TYPE chmi_jobs_total counter" in response.text
+        response = requests.get(f"http://127.0.0.1:{port}/other", timeout=5)
+        assert response.status_code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
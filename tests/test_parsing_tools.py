@@ -0,0 +1,213 @@
+import io
+import json
+
+import numpy as np
+import pytest
+from fixtures import STATION_HEADER, write_chmi_file
+
+from dedup import sorted_unique_rows, unique_rows
+from parsing_tools import (
+    concat_station_values,
+    iter_station_values,
+    iter_value_rows,
+    parse_station_values,
+    process_metadata,
+)
+
+NAN = float("nan")
+META1_HEADER = "WSI,GH_ID,BEGIN_DATE,END_DATE,FULL_NAME,GEOGR1,GEOGR2,ELEVATION"
+META2_HEADER = "OBS_TYPE,WSI,EG_EL_ABBREVIATION,NAME,UNIT,HEIGHT,SCHEDULE"
+BEGIN, END = "2000-01-01T00:00Z", "3999-12-31T23:59Z"
+
+T = ["T", "Temperature", "°C", 2.0]
+H = ["H", "Humidity", "%", 2.0]
+SRA = ["SRA", "Precipitation", "mm", 1.0]
+
+
+def station(gh_id: str, name: str, elevation: float) -> dict:
+    return {
+        "GH_ID": gh_id,
+        "BEGIN_DATE": BEGIN,
+        "END_DATE": END,
+        "FULL_NAME": name,
+        "GEOGR1": 15.0,
+        "GEOGR2": 49.0,
+        "ELEVATION": elevation,
+    }
+
+
+def write_metadata(folder: str) -> None:
+    write_chmi_file(
+        f"{folder}/meta1-202401.json",
+        META1_HEADER,
+        [
+            ["0-1", "GH1", BEGIN, END, "One", 15.0, 49.0, 200.0],
+            ["0-2", "GH2", BEGIN, END, "Two", 15.0, 49.0, 300.0],
+            # a duplicate station, the first row is kept
+            ["0-1", "GHX", BEGIN, END, "Duplicate", 15.0, 49.0, 0.0],
+            ["0 -3", "GH3", BEGIN, END, "Three", 15.0, 49.0, 400.0],
+        ],
+    )
+    write_chmi_file(
+        f"{folder}/meta2-202401.json",
+        META2_HEADER,
+        [
+            ["10M", "0-1", *T, "10M"],
+            ["10M", "0-1", *H, "10M"],
+            ["10M", "0-1", *T, "10M"],
+            ["1H", "0-1", *T, "1H"],
+            # a row carrying two types
+            ["10M", "0-2", *SRA, "1H"],
+            ["DLY", "0-2", *SRA, "DLY"],
+            # an unknown station stops the 10M measurements
+            ["10M", "0-9", *T, "10M"],
+            ["10M", "0-1", "P", "Pressure", "hPa", None, "10M"],
+            ["DLY", "0-1", *SRA, "DLY"],
+            ["1H", "0-2", "H", "Humidity", "%", None, "1H"],
+        ],
+    )
+
+
+def test_process_metadata(tmp_path, capsys):
+    write_metadata(str(tmp_path))
+    ws_dict, m10, m1h, mdly = process_metadata(str(tmp_path), 2024, 1)
+    assert capsys.readouterr().out == "WSI 0-9 not found.\n"
+    humidity_1h = ["H", "Humidity", "%", NAN]
+    expected = {
+        "0-1": {
+            **station("GH1", "One", 200.0),
+            "10M": [T, H],
+            "1H": [T],
+            "DLY": [SRA],
+        },
+        "0-2": {
+            **station("GH2", "Two", 300.0),
+            "10M": [SRA],
+            "1H": [SRA, humidity_1h],
+            "DLY": [SRA],
+        },
+        "0-3": station("GH3", "Three", 400.0),
+    }
+    # compared as json to check the key order and the NaN values
+    assert json.dumps(ws_dict) == json.dumps(expected)
+    assert json.dumps(m10) == json.dumps([H, SRA, T])
+    assert json.dumps(m1h) == json.dumps([humidity_1h, SRA, T])
+    assert json.dumps(mdly) == json.dumps([SRA])
+
+
+@pytest.mark.parametrize(
+    "rows, expected",
+    [
+        ([[1, 2], [1, 2], [1, None]], [[1.0, 2.0], [1.0, NAN]]),
+        ([["a", None], ["a", NAN], ["b", 1]], [["a", NAN], ["b", 1.0]]),
+        ([["x", 1], ["x", 1.0], ["y", 2]], [["x", 1.0], ["y", 2.0]]),
+        ([[1, "a"], [1, "a", 3]], [[1, "a", NAN], [1, "a", 3.0]]),
+        ([[True, 1], [True, 1], [False, 2]], [[True, 1], [False, 2]]),
+        ([[2**70, "a"], [2**70, "a"]], [[2**70, "a"]]),
+        ([1, None, NAN, 1], [[1.0], [NAN]]),
+        ([None, None], [[None]]),
+        ([[], []], [[], []]),
+        ([], []),
+    ],
+)
+def test_unique_rows(rows, expected):
+    result = unique_rows(rows)
+    # repr keeps the types apart (1 and 1.0, True and 1) and compares NaN
+    assert repr(result) == repr(expected)
+
+
+def test_sorted_unique_rows():
+    rows = [["T", 2.0], ["H", 2.0], ["T", 2.0], ["H", 1.0]]
+    assert sorted_unique_rows(rows) == [["H", 1.0], ["H", 2.0], ["T", 2.0]]
+
+
+# rows with multibyte characters, strings, missing values and nested lists
+VALUE_ROWS = [
+    ["0-1", "T", "2024-01-01T00:00:00Z", 1.5, None, 0.0],
+    ["0-1", "Teplota °C", "2024-01-01T00:10:00Z", -2.25, "ěščř", 1.0],
+    ["0-1", "H", "2024-01-01T00:20:00Z", None, "N", 3.0],
+    ["0-1", "ÚHEL", "2024-01-01T00:30:00Z", "žádná", [1, "ü"], 0.0],
+    ["0-1", "SRA", "2024-01-01T00:40:00Z", 1e-07, None, 0.0],
+]
+
+
+def data_file(rows: list[list]) -> bytes:
+    data = {
+        "data": {
+            "type": "DataCollection",
+            "data": {"header": STATION_HEADER, "values": rows},
+        }
+    }
+    # the CHMI files have no spaces after the separators
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def value_rows(content: bytes, read_size: int) -> list[list]:
+    file = io.TextIOWrapper(io.BytesIO(content), encoding="utf-8")
+    return list(iter_value_rows(file, read_size))
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 3, 7, 31, 65536])
+def test_value_rows_split_between_reads(read_size):
+    for content in (
+        data_file(VALUE_ROWS),
+        json.dumps(json.loads(data_file(VALUE_ROWS)), indent=2).encode(),
+    ):
+        assert value_rows(content, read_size) == VALUE_ROWS
+
+
+def test_value_rows_empty_array():
+    assert value_rows(data_file([]), 5) == []
+
+
+@pytest.mark.parametrize("cut", [-1, -3, -60])
+def test_truncated_values_array_raises(cut):
+    content = data_file(VALUE_ROWS)
+    content = content[: content.index(b"]]") + 2 + cut]
+    with pytest.raises(json.JSONDecodeError):
+        value_rows(content, 16)
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        b"<html><body>502 Bad Gateway</body></html>",
+        b'{"data": {"data": {"header": "STATION", "rows": []}}}',
+        b"",
+    ],
+)
+def test_missing_values_key_raises(content):
+    with pytest.raises(json.JSONDecodeError):
+        value_rows(content, 8)
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_station_values(content))
+
+
+def chunk_columns(chunks) -> list:
+    station_values = concat_station_values(chunks)
+    return [
+        station_values.measurements.tolist(),
+        station_values.values.tolist(),
+        station_values.quality.tolist(),
+        station_values.times.tolist(),
+        station_values.numeric.tolist(),
+    ]
+
+
+@pytest.mark.parametrize("count, chunk_rows", [(7, 3), (6, 3), (1, 3), (3, 1)])
+def test_station_values_chunk_boundaries(count, chunk_rows):
+    rows = [
+        ["0-1", "T", f"2024-01-01T00:{i:02d}:00Z", float(i), None, 0.0]
+        for i in range(count)
+    ]
+    chunks = list(iter_station_values(data_file(rows), chunk_rows))
+    # full chunks and the rest, never an empty chunk
+    assert [len(chunk) for chunk in chunks] == [
+        min(chunk_rows, count - i) for i in range(0, count, chunk_rows)
+    ]
+    assert chunk_columns(chunks) == chunk_columns([parse_station_values(rows)])
+    assert np.array_equal(chunks[0].times[:1], [1704067200 * 10**9])
+
+
+def test_station_values_without_rows():
+    assert list(iter_station_values(data_file([]))) == []
@@ -0,0 +1,79 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+import influx_writer_realtime
+from async_writer import WriteError
+from influx_writer_realtime import get_catchup_dates
+from watermarks import HighWaterMarks
+
+
+def mark(watermarks: HighWaterMarks, key: str, measurement: str, time: datetime):
+    watermarks.update(
+        key,
+        np.array([measurement], dtype=object),
+        np.array([int(time.timestamp() * 1e9)], dtype=np.int64),
+    )
+
+
+def test_catchup_dates_of_every_resolution(tmp_path):
+    now = datetime.now(timezone.utc)
+    watermarks = HighWaterMarks(str(tmp_path / "marks.json.gz"))
+    mark(watermarks, "10m-A", "T", now)
+    # the daily values are three days behind
+    mark(watermarks, "dly-A", "SRA", now - timedelta(days=3))
+    watermarks.save()
+    watermarks = HighWaterMarks(watermarks.path)
+    today = now.strftime("%Y%m%d")
+    days = [(now - timedelta(days=i)).strftime("%Y%m%d") for i in range(3, -1, -1)]
+    assert get_catchup_dates(watermarks, now, "10m") == [today]
+    assert get_catchup_dates(watermarks, now, "dly") == days
+    # the 1h files have no marks, only the window is listed
+    assert get_catchup_dates(watermarks, now - timedelta(days=1), "1h") == days[-2:]
+    assert get_catchup_dates(watermarks, now) == days
+
+
+class Closable:
+    def __init__(self, *args, **kwargs) -> None:
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+    dispose = close
+
+
+class FailingWriteApi(Closable):
+    def close(self) -> None:
+        super().close()
+        raise WriteError("Failed to write 10 records.")
+
+
+def test_connections_are_closed_when_the_write_api_fails(tmp_path, monkeypatch):
+    opened = {}
+
+    def track(name, cls):
+        def create(*args, **kwargs):
+            opened[name] = cls()
+            return opened[name]
+
+        monkeypatch.setattr(influx_writer_realtime, name, create)
+
+    track("InfluxDBClient", Closable)
+    track("create_write_api", FailingWriteApi)
+    track("create_metadata_engine", Closable)
+    track("Session", Closable)
+    path = str(tmp_path / "marks.json.gz")
+    monkeypatch.setattr(
+        influx_writer_realtime, "HighWaterMarks", lambda: HighWaterMarks(path)
+    )
+    monkeypatch.setattr(influx_writer_realtime, "get_station_index", lambda s: {})
+    monkeypatch.setattr(influx_writer_realtime, "get_data_files", lambda *a: [])
+    with pytest.raises(WriteError):
+        influx_writer_realtime._write_latest_data(None)
+    assert all(resource.closed for resource in opened.values())
+    assert len(opened) == 4
+    # the marks are not saved
+    assert not os.path.exists(path)
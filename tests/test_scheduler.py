@@ -0,0 +1,91 @@
+import random
+import threading
+
+import pytest
+
+import scheduler
+from scheduler import WorkerUtilization, largest_first, size_balanced_shards
+
+
+def test_largest_first():
+    items = [("a", 10), ("b", None), ("c", 30), ("d", 10), ("e", 0)]
+    ordered = largest_first(items, lambda item: item[1])
+    # the unknown sizes go last, equal sizes keep their order
+    assert [name for name, _ in ordered] == ["c", "a", "d", "b", "e"]
+
+
+def check_shards(items, shards, target_size, max_items) -> None:
+    sizes = dict(items)
+    # every item lands in exactly one shard
+    sharded = [item for shard, _ in shards for item in shard]
+    assert sorted(sharded) == sorted(sizes)
+    for i, (shard, shard_size) in enumerate(shards):
+        assert 0 < len(shard) <= max_items
+        assert shard_size == sum(sizes[item] or 0 for item in shard)
+        # a shard is closed as soon as it reaches the target size
+        assert sum(sizes[item] or 0 for item in shard[:-1]) < target_size
+        if i < len(shards) - 1:
+            assert shard_size >= target_size or len(shard) == max_items
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_shards_of_skewed_sizes(seed):
+    rng = random.Random(seed)
+    # a few huge files and many small ones, like the CHMI station files
+    items = [(f"f{i}", int(rng.paretovariate(1.1) * 1000)) for i in range(500)]
+    total = sum(size for _, size in items)
+    target_size = total // 32
+    shards = size_balanced_shards(items, target_size, max_items=50)
+    check_shards(items, shards, target_size, 50)
+    for shard, shard_size in shards:
+        # only a single file can make a shard larger than twice the target, the
+        # files are added from the largest, so they are all below the target
+        if len(shard) > 1:
+            assert shard_size < 2 * target_size
+    # the large files are in the first shards, on their own
+    assert shards[0] == ([max(items, key=lambda item: item[1])[0]], shards[0][1])
+
+
+def test_shards_of_unknown_sizes():
+    items = [("a", 100), ("b", None), ("c", 50), ("d", None), ("e", None)]
+    shards = size_balanced_shards(items, target_size=120, max_items=2)
+    check_shards(items, shards, 120, 2)
+    assert shards == [(["a", "c"], 150), (["b", "d"], 0), (["e"], 0)]
+
+
+def test_shards_of_no_items():
+    assert size_balanced_shards([], target_size=10, max_items=5) == []
+
+
+def test_utilization_summary(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(scheduler.time, "perf_counter", lambda: clock[0])
+    utilization = WorkerUtilization()
+    threads = [
+        threading.Thread(
+            target=lambda worker=worker: [
+                utilization.add(worker, 0.5, 1000) for _ in range(100)
+            ]
+        )
+        for worker in ("w1", "w2")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    utilization.add("w0", 25.0)
+    clock[0] = 200.0
+    assert utilization.summary() == {
+        "elapsed_s": 100.0,
+        "mean_utilization": 0.417,
+        "workers": {
+            "w0": {"tasks": 1, "busy_s": 25.0, "bytes": 0, "utilization": 0.25},
+            "w1": {"tasks": 100, "busy_s": 50.0, "bytes": 100_000, "utilization": 0.5},
+            "w2": {"tasks": 100, "busy_s": 50.0, "bytes": 100_000, "utilization": 0.5},
+        },
+    }
+
+
+def test_utilization_without_tasks():
+    summary = WorkerUtilization().summary()
+    assert (summary["mean_utilization"], summary["workers"]) == (0.0, {})
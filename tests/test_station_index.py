@@ -0,0 +1,116 @@
+import json
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+import station_index
+from station_index import (
+    Station,
+    StationIndex,
+    get_station_index,
+    load_station_index,
+    refresh_station_index,
+)
+from ws_db_models import Measurement, WeatherStation
+
+WSIS = ["0-20000-0-11406", "0-20000-0-11414", "0-203-0-11433"]
+
+
+@pytest.fixture
+def engine(station_db):
+    engine, add_stations = station_db
+    add_stations(WSIS)
+    with Session(engine) as session:
+        station = session.query(WeatherStation).filter_by(wsi=WSIS[0]).one()
+        station.measurements = [
+            Measurement(resolution="10M", abbreviation="T", name="T", unit="°C"),
+            Measurement(resolution="10M", abbreviation="H", name="H", unit="%"),
+            Measurement(resolution="DLY", abbreviation="SRA", name="S", unit="mm"),
+        ]
+        session.commit()
+    return engine
+
+
+@pytest.fixture
+def broken_session(tmp_path):
+    # the folder of the db does not exist, so every query fails
+    engine = create_engine(f"sqlite:///{tmp_path / 'missing' / 'metadata.db'}")
+    with Session(engine) as session:
+        yield session
+    engine.dispose()
+
+
+def test_resolve_wsis(engine):
+    with Session(engine) as session:
+        index = get_station_index(session)
+    assert len(index) == 3
+    assert index.get(WSIS[0]) == Station(
+        WSIS[0], "GH020000011406", {"10M": {"T", "H"}, "DLY": {"SRA"}}
+    )
+    # a station without measurements
+    assert index.get(WSIS[2]) == Station(WSIS[2], "GH0203011433", {})
+    assert "0-20000-0-99999" not in index
+    assert index.get("0-20000-0-99999") is None
+
+
+def test_snapshot_round_trip(engine, tmp_path):
+    path = str(tmp_path / "stations.json")
+    with Session(engine) as session:
+        index = StationIndex.from_db(session)
+    index.save_snapshot(path)
+    loaded = StationIndex.from_snapshot(path)
+    assert loaded.stations == index.stations
+    assert loaded.loaded_at == index.loaded_at
+
+
+def test_fresh_snapshot_is_preferred(engine, tmp_path):
+    path = str(tmp_path / "stations.json")
+    StationIndex({"0-1": Station("0-1", "GH1")}).save_snapshot(path)
+    with Session(engine) as session:
+        index = load_station_index(session, path)
+    assert list(index.stations) == ["0-1"]
+
+
+def test_stale_snapshot_is_reloaded_from_the_db(engine, tmp_path):
+    path = str(tmp_path / "stations.json")
+    stale = StationIndex({"0-1": Station("0-1", "GH1")})
+    stale.loaded_at = 0.0
+    stale.save_snapshot(path)
+    with Session(engine) as session:
+        index = load_station_index(session, path)
+    assert sorted(index.stations) == WSIS
+    # the snapshot is replaced by the reloaded index
+    with open(path, encoding="utf-8") as file:
+        assert sorted(json.load(file)["stations"]) == WSIS
+
+
+def test_stale_snapshot_is_used_when_the_db_fails(broken_session, tmp_path, caplog):
+    path = str(tmp_path / "stations.json")
+    stale = StationIndex({"0-1": Station("0-1", "GH1", {"1H": {"T"}})})
+    stale.loaded_at = 0.0
+    stale.save_snapshot(path)
+    index = load_station_index(broken_session, path)
+    assert index.stations == stale.stations
+    assert "Using the stale station index snapshot." in caplog.text
+    # without a snapshot the error is raised
+    with pytest.raises(SQLAlchemyError):
+        load_station_index(broken_session, "")
+
+
+def test_refresh_picks_up_new_stations(station_db, engine, tmp_path):
+    _, add_stations = station_db
+    path = str(tmp_path / "stations.json")
+    with Session(engine) as session:
+        index = get_station_index(session)
+        add_stations(["0-20000-0-11500"])
+        # the index of the process is cached until it is refreshed
+        assert get_station_index(session) is index
+        assert "0-20000-0-11500" not in index
+        refreshed = refresh_station_index(session, path)
+        assert get_station_index(session) is refreshed
+    assert station_index._station_index is refreshed
+    assert refreshed.get("0-20000-0-11500").gh_id == "GH020000011500"
+    assert len(refreshed) == 4
+    assert len(StationIndex.from_snapshot(path)) == 4
@@ -0,0 +1,59 @@
+import numpy as np
+
+from watermarks import HighWaterMarks
+
+
+def marks_of(watermarks: HighWaterMarks, key: str, values: dict[str, int]) -> None:
+    watermarks.update(
+        key,
+        np.array(list(values), dtype=object),
+        np.array(list(values.values()), dtype=np.int64),
+    )
+
+
+def test_newer_values_are_compared_with_the_saved_marks(tmp_path):
+    path = str(tmp_path / "marks.json.gz")
+    watermarks = HighWaterMarks(path)
+    marks_of(watermarks, "10m-A", {"T": 200, "H": 100})
+    watermarks.save()
+    watermarks = HighWaterMarks(path)
+    measurements = np.array(["T", "T", "H", "P"], dtype=object)
+    times = np.array([200, 300, 150, 50], dtype=np.int64)
+    # P has no mark, the default start applies
+    assert watermarks.newer("10m-A", measurements, times, 50).tolist() == [
+        False,
+        True,
+        True,
+        True,
+    ]
+    assert watermarks.newer("10m-B", measurements, times, 200).tolist() == [
+        True,
+        True,
+        False,
+        False,
+    ]
+    assert watermarks.oldest() == 100
+
+
+def test_prune_drops_the_old_marks(tmp_path):
+    path = str(tmp_path / "marks.json.gz")
+    watermarks = HighWaterMarks(path)
+    marks_of(watermarks, "10m-A", {"T": 1000, "H": 100})
+    # a station that stopped reporting
+    marks_of(watermarks, "10m-B", {"T": 50})
+    assert watermarks.prune(500) == 2
+    watermarks.save()
+    assert HighWaterMarks(path).marks == {"10m-A": {"T": 1000}}
+    assert HighWaterMarks(path).oldest() == 1000
+
+
+def test_oldest_of_a_measurement_type(tmp_path):
+    watermarks = HighWaterMarks(str(tmp_path / "marks.json.gz"))
+    marks_of(watermarks, "10m-A", {"T": 1000})
+    marks_of(watermarks, "dly-A", {"SRA": 100})
+    watermarks.save()
+    watermarks = HighWaterMarks(watermarks.path)
+    assert watermarks.oldest() == 100
+    assert watermarks.oldest("10m") == 1000
+    assert watermarks.oldest("dly") == 100
+    assert watermarks.oldest("1h") is None
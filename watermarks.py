@@ -0,0 +1,110 @@
+import gzip
+import json
+import os
+
+import numpy as np
+
+from config import config
+
+# per-station and per-measurement high-water marks of the realtime writer
+# (the time of the last written value in ns), stored as a gzipped JSON
+
+WATERMARKS_PATH = config.get(
+    "folders", "watermarks_path", fallback="watermarks.json.gz"
+)
+
+
+class HighWaterMarks:
+    def __init__(self, path: str = WATERMARKS_PATH) -> None:
+        self.path = path
+        # station key -> measurement -> time of the last written value in ns
+        self.marks = {}
+        if os.path.exists(path):
+            with gzip.open(path, "rt", encoding="utf-8") as file:
+                self.marks = json.load(file)
+        # the values are always compared with the marks from the start of the run,
+        # so the files of one station can be processed in any order
+        self._previous = {key: dict(marks) for key, marks in self.marks.items()}
+
+    def oldest(self, measurement_type: str | None = None) -> int | None:
+        """Get the oldest high-water mark in ns or None if there are no marks.
+
+        Args:
+            measurement_type (str | None): Only the marks of the stations of this
+                measurement type (the prefix of the keys), all marks if None.
+        """
+        prefix = f"{measurement_type}-" if measurement_type else ""
+        return min(
+            (
+                min(marks.values())
+                for key, marks in self._previous.items()
+                if marks and key.startswith(prefix)
+            ),
+            default=None,
+        )
+
+    def newer(
+        self,
+        key: str,
+        measurements: np.ndarray,
+        times: np.ndarray,
+        default_start: int,
+    ) -> np.ndarray:
+        """Select the values newer than the high-water marks of a station.
+
+        Args:
+            key (str): Station key, e.g. 10m-<WSI>.
+            measurements (np.ndarray): Measurement of every value.
+            times (np.ndarray): Time of every value in ns.
+            default_start (int): Values at or after this time (ns) are selected
+                for measurements without a high-water mark.
+
+        Returns:
+            np.ndarray: Boolean mask of the newer values.
+        """
+        if not len(times):
+            return np.zeros(0, dtype=bool)
+        marks = self._previous.get(key, {})
+        names, codes = np.unique(measurements, return_inverse=True)
+        thresholds = np.array(
+            [marks.get(name, default_start - 1) for name in names.tolist()],
+            dtype=np.int64,
+        )
+        return times > thresholds[codes]
+
+    def update(self, key: str, measurements: np.ndarray, times: np.ndarray) -> None:
+        """Move the high-water marks of a station to the newest written values."""
+        if not len(times):
+            return
+        marks = self.marks.setdefault(key, {})
+        names, codes = np.unique(measurements, return_inverse=True)
+        newest = np.full(len(names), np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(newest, codes, times)
+        for name, time_ns in zip(names.tolist(), newest.tolist()):
+            marks[name] = max(marks.get(name, time_ns), time_ns)
+
+    def prune(self, oldest: int) -> int:
+        """Drop the marks older than the given time in ns.
+
+        The marks of the stations and measurements that stopped reporting would
+        otherwise keep the catch-up of every run at its longest range.
+
+        Returns:
+            int: Number of dropped marks.
+        """
+        dropped = 0
+        for key in list(self.marks):
+            marks = {name: t for name, t in self.marks[key].items() if t >= oldest}
+            dropped += len(self.marks[key]) - len(marks)
+            if marks:
+                self.marks[key] = marks
+            else:
+                del self.marks[key]
+        return dropped
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+            json.dump(self.marks, file, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
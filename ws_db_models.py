@@ -1,8 +1,11 @@
-from sqlalchemy import Column, Float, ForeignKey, Integer, String, Table
+from sqlalchemy import Column, Float, ForeignKey, Index, Integer, String, Table
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 # this file contains all table definitions for the chmi_metadata db
 
+# resolutions of the measurements, the same as the keys in the processed metadata
+RESOLUTIONS = ("10M", "1H", "DLY")
+
 
 # must define a base class for sqlalchemy
 # it is also used for creating the tables in the db
@@ -10,45 +13,9 @@ class Base(DeclarativeBase):
     pass
 
 
-# junction table for the weather stations and the 10m measurements
-weather_station_measurements_10m = Table(
-    "weather_station_measurements_10m",
-    Base.metadata,
-    Column(
-        "weather_station_id",
-        Integer,
-        ForeignKey("weather_stations.id"),
-        primary_key=True,
-    ),
-    Column(
-        "measurement_10m_id",
-        Integer,
-        ForeignKey("measurements_10m.id"),
-        primary_key=True,
-    ),
-)
-
-# junction table for the weather stations and the 1h measurements
-weather_station_measurements_1h = Table(
-    "weather_station_measurements_1h",
-    Base.metadata,
-    Column(
-        "weather_station_id",
-        Integer,
-        ForeignKey("weather_stations.id"),
-        primary_key=True,
-    ),
-    Column(
-        "measurement_1h_id",
-        Integer,
-        ForeignKey("measurements_1h.id"),
-        primary_key=True,
-    ),
-)
-
-# junction table for the weather stations and the daily measurements
-weather_station_measurements_dly = Table(
-    "weather_station_measurements_dly",
+# junction table for the weather stations and the measurements of all resolutions
+weather_station_measurements = Table(
+    "weather_station_measurements",
     Base.metadata,
     Column(
         "weather_station_id",
@@ -57,10 +24,12 @@ weather_station_measurements_dly = Table(
         primary_key=True,
     ),
     Column(
-        "measurement_dly_id",
+        "measurement_id",
         Integer,
-        ForeignKey("measurements_dly.id"),
+        ForeignKey("measurements.id"),
         primary_key=True,
+        # the primary key only covers the lookups by the weather station
+        index=True,
     ),
 )
 
@@ -69,70 +38,44 @@ class WeatherStation(Base):
     __tablename__ = "weather_stations"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    wsi: Mapped[str] = mapped_column(String(255), nullable=False)
+    # every lookup filters on the WSI, the unique index also prevents duplicates
+    wsi: Mapped[str] = mapped_column(
+        String(255), nullable=False, unique=True, index=True
+    )
     gh_id: Mapped[str] = mapped_column(String(255), nullable=False)
     full_name: Mapped[str] = mapped_column(String(255), nullable=False)
     X: Mapped[float] = mapped_column(Float, nullable=False)
     Y: Mapped[float] = mapped_column(Float, nullable=False)
     elevation: Mapped[float] = mapped_column(Float, nullable=False)
-    # measurements
-    measurements_10m: Mapped[list["Measurement10M"]] = relationship(
-        "Measurement10M",
-        secondary=weather_station_measurements_10m,
-        back_populates="weather_stations",
-    )
-    measurements_1h: Mapped[list["Measurement1H"]] = relationship(
-        "Measurement1H",
-        secondary=weather_station_measurements_1h,
+    # measurements of all resolutions
+    measurements: Mapped[list["Measurement"]] = relationship(
+        "Measurement",
+        secondary=weather_station_measurements,
         back_populates="weather_stations",
     )
-    measurements_dly: Mapped[list["MeasurementDLY"]] = relationship(
-        "MeasurementDLY",
-        secondary=weather_station_measurements_dly,
-        back_populates="weather_stations",
-    )
-
-
-class Measurement10M(Base):
-    __tablename__ = "measurements_10m"
-
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    abbreviation: Mapped[str] = mapped_column(String(255), nullable=False)
-    name: Mapped[str] = mapped_column(String(255), nullable=False)
-    unit: Mapped[str] = mapped_column(String(255), nullable=False)
-
-    weather_stations: Mapped[list["WeatherStation"]] = relationship(
-        "WeatherStation",
-        secondary=weather_station_measurements_10m,
-        back_populates="measurements_10m",
-    )
-
 
-class Measurement1H(Base):
-    __tablename__ = "measurements_1h"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    abbreviation: Mapped[str] = mapped_column(String(255), nullable=False)
-    name: Mapped[str] = mapped_column(String(255), nullable=False)
-    unit: Mapped[str] = mapped_column(String(255), nullable=False)
-
-    weather_stations: Mapped[list["WeatherStation"]] = relationship(
-        "WeatherStation",
-        secondary=weather_station_measurements_1h,
-        back_populates="measurements_1h",
+class Measurement(Base):
+    __tablename__ = "measurements"
+    # the abbreviations are unique within a resolution
+    __table_args__ = (
+        Index(
+            "ix_measurements_resolution_abbreviation",
+            "resolution",
+            "abbreviation",
+            unique=True,
+        ),
     )
 
-
-class MeasurementDLY(Base):
-    __tablename__ = "measurements_dly"
-
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    # one of RESOLUTIONS
+    resolution: Mapped[str] = mapped_column(String(8), nullable=False)
     abbreviation: Mapped[str] = mapped_column(String(255), nullable=False)
     name: Mapped[str] = mapped_column(String(255), nullable=False)
     unit: Mapped[str] = mapped_column(String(255), nullable=False)
 
     weather_stations: Mapped[list["WeatherStation"]] = relationship(
         "WeatherStation",
-        secondary=weather_station_measurements_dly,
-        back_populates="measurements_dly",
+        secondary=weather_station_measurements,
+        back_populates="measurements",
     )
@@ -1,142 +1,90 @@
-import configparser
 import json
+import logging
+import os
+import time
 
-from sqlalchemy import create_engine, select, text
+from sqlalchemy import Engine, create_engine, text
 from sqlalchemy.orm import Session
 
-from config import DB_CONNECTION_STRING, DB_SERVER_CONNECTION_STRING
-from ws_db_models import (
-    Base,
-    Measurement1H,
-    Measurement10M,
-    MeasurementDLY,
-    WeatherStation,
+from config import (
+    DB_CONNECTION_STRING,
+    DB_SERVER_CONNECTION_STRING,
+    config,
+    db_backend,
 )
+from metadata_db import create_metadata_engine, create_views, remove_sqlite_db
+from metadata_sync import sync_metadata
+from ws_db_models import Base
 
 # create the chmi_metadata db from scratch
 
-engine = create_engine(DB_SERVER_CONNECTION_STRING)
-with engine.connect() as conn:
-    # drop the db if it already exists
-    conn.execute(text(f"DROP DATABASE IF EXISTS chmi_metadata"))
-    # proper character set and collation must be defined
-    conn.execute(
-        text(
-            f"CREATE DATABASE IF NOT EXISTS chmi_metadata CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci"
-        )
-    )
-    conn.commit()
-engine.dispose()
-
-# create all tables
-engine = create_engine(DB_CONNECTION_STRING)
-Base.metadata.create_all(engine)
-# create session for adding rows to tables
-session = Session(engine)
-
-
-def add_measurements_to_db(
-    measurements_json_path: str,
-    measurement_type: Measurement10M | Measurement1H | MeasurementDLY,
-) -> None:
-    # add measurements
-    with open(measurements_json_path, "r", encoding="utf-8") as file:
-        measurements = json.load(file)
-    for measurement in measurements:
-        measurement_db = measurement_type(
-            abbreviation=measurement[0], name=measurement[1], unit=measurement[2]
-        )
-        session.add(measurement_db)
-
-
-add_measurements_to_db("./data_db/measurements_10m.json", Measurement10M)
-add_measurements_to_db("./data_db/measurements_1h.json", Measurement1H)
-add_measurements_to_db("./data_db/measurements_dly.json", MeasurementDLY)
-
-# add weather stations and relations to measurements
-with open("./data_db/weather_stations.json", "r", encoding="utf-8") as file:
-    weather_stations = json.load(file)
-
-
-def assign_measurements_ws_db(
-    measurement_list: list[list],
-    measurement_type: Measurement10M | Measurement1H | MeasurementDLY,
-) -> list[Measurement10M | Measurement1H | MeasurementDLY]:
-    weather_station_measurements = []
-    # create list of measurements for current weather station
-    for measurement in measurement_list:
-        weather_station_measurements.append(
-            session.scalars(
-                select(measurement_type).where(
-                    measurement_type.abbreviation == measurement[0]
-                )
-            ).first()
-        )
-    return weather_station_measurements
-
-
-for wsi in weather_stations:
-    weather_station = weather_stations[wsi]
-    has_10m = "10M" in weather_station
-    has_1h = "1H" in weather_station
-    has_dly = "DLY" in weather_station
-    has_measurements = has_10m or has_1h or has_dly
-    if has_measurements:
-        weather_station_db = WeatherStation(
-            wsi=wsi,
-            gh_id=weather_station["GH_ID"],
-            full_name=weather_station["FULL_NAME"],
-            X=weather_station["GEOGR1"],
-            Y=weather_station["GEOGR2"],
-            elevation=weather_station["ELEVATION"],
-        )
-        session.add(weather_station_db)
-        if has_10m:
-            measurements_10m = assign_measurements_ws_db(
-                weather_station["10M"], Measurement10M
-            )
-            weather_station_db.measurements_10m = measurements_10m
-        if has_1h:
-            measurements_1h = assign_measurements_ws_db(
-                weather_station["1H"], Measurement1H
-            )
-            weather_station_db.measurements_1h = measurements_1h
-        if has_dly:
-            measurements_dly = assign_measurements_ws_db(
-                weather_station["DLY"], MeasurementDLY
-            )
-            weather_station_db.measurements_dly = measurements_dly
-
-# define the SQL views
-for m in ["10m", "1h", "dly"]:
-    SHOW_WEATHER_STATIONS = text(
-        f"""
-        CREATE OR REPLACE VIEW show_weather_stations_{m} AS
-        SELECT
-            ws.id,
-            ws.wsi,
-            ws.gh_id,
-            ws.full_name,
-            ws.X,
-            ws.Y,
-            ws.elevation,
-            GROUP_CONCAT(DISTINCT CONCAT(m.name, ' [', m.unit, ']') ORDER BY m.name SEPARATOR ', ') AS measurements_{m}
-        FROM weather_stations ws
-        LEFT JOIN weather_station_measurements_{m} wsm ON ws.id = wsm.weather_station_id
-        LEFT JOIN measurements_{m} m ON wsm.measurement_{m}_id = m.id
-        GROUP BY ws.id, ws.wsi, ws.gh_id, ws.full_name, ws.X, ws.Y, ws.elevation
-        HAVING measurements_{m} IS NOT NULL;
-        """
-    )
-    if not session.scalar(
-        text(
-            f"SELECT COUNT(*) FROM information_schema.views WHERE table_name = 'show_weather_stations_{m}'"
-        )
-    ):
-        session.execute(SHOW_WEATHER_STATIONS)
+logger = logging.getLogger("chmi.create_db")
 
 
-# commit changes and close the connection
-session.commit()
-session.close()
-engine.dispose()
+def create_database(server_connection_string: str, db_name: str) -> None:
+    """Drop and create the metadata database on the MariaDB server."""
+    engine = create_engine(server_connection_string)
+    with engine.connect() as conn:
+        # drop the db if it already exists
+        conn.execute(text(f"DROP DATABASE IF EXISTS {db_name}"))
+        # proper character set and collation must be defined
+        conn.execute(
+            text(
+                f"CREATE DATABASE IF NOT EXISTS {db_name} "
+                "CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci"
+            )
+        )
+        conn.commit()
+    engine.dispose()
+
+
+def read_json(path: str):
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def load_metadata(engine: Engine | str, data_folder: str = "./data_db") -> dict:
+    """Create the tables and load the merged metadata in bulk.
+
+    The measurements, weather stations and junction rows are each inserted
+    with a single executemany, the measurement ids are resolved in memory.
+
+    Args:
+        engine (Engine | str): Engine or connection string of an empty db.
+        data_folder (str): Folder with the output of ws_metadata_merge.py.
+
+    Returns:
+        dict: Numbers of the inserted rows.
+    """
+    if isinstance(engine, str):
+        engine = create_metadata_engine(engine)
+    started = time.perf_counter()
+    # create all tables
+    Base.metadata.create_all(engine)
+    weather_stations = read_json(os.path.join(data_folder, "weather_stations.json"))
+    measurements = [
+        read_json(os.path.join(data_folder, f"measurements_{m}.json"))
+        for m in ("10m", "1h", "dly")
+    ]
+    with Session(engine) as session:
+        counts = sync_metadata(session, weather_stations, *measurements)
+        create_views(session.connection())
+        # commit changes and close the connection
+        session.commit()
+    logger.info(f"Metadata loaded in {time.perf_counter() - started:.2f} s.")
+    return counts
+
+
+def main():
+    if db_backend == "sqlite":
+        # the local db file is created again from scratch
+        remove_sqlite_db(DB_CONNECTION_STRING)
+    else:
+        create_database(DB_SERVER_CONNECTION_STRING, config["mariadb"]["db_name"])
+    engine = create_metadata_engine()
+    print(load_metadata(engine))
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()